@@ -1,29 +1,29 @@
 import asyncio
 import json
-import socket
-import qrcode
 
 import signal
 import threading
 import time
-import base64
 import numpy as np
 from importlib import resources
 
-from .tools.lucy_client_module import LucyClientModule
-from .tools.spotify import LSpotifyClient
-from .tools.clock import LClockClient
+from .tools.registry import ToolRegistry, ToolContext
 
-from .sound import SoundManager, Sound, SpeechSound
+from .sound import SoundManager, Sound, SpeechSound, decode_speech_audio
+from .mixer_process import RemoteSoundManager
 
 from .socket_webview import SocketWebView
+from .qr_code import ConfigQRCode
 
 from .speech.detect_speech_provider.wake_word import DetectWakeWordProvider
 from .speech import VoiceAssistant
+from .speech.echo_cancel import EchoCanceller
 
 from .client import LucyWebSocketClient
 
-from .config import get_config, get_ws_url, start_flask_server, get_http_url
+from .config import get_config, get_ws_url, start_config_server, get_http_url, watch_config_file, METRICS_FILE, TRACES_FILE
+from . import metrics
+from .tracing import TRACER
 
 from rich.console import Console
 from rich.theme import Theme
@@ -43,6 +43,7 @@ console = Console(theme=custom_theme)
 
 lucy_webview = None
 va = None
+echo_canceller = None
 websocket_client = None
 
 sound_manager = None
@@ -52,59 +53,53 @@ main_loop_asyncio = None
 
 is_in_request = True
 
-client_modules = {}
+tool_registry = None
 
-def get_local_ip():
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    try:
-        # Doesn't need to be reachable, just forces routing table use
-        s.connect(("8.8.8.8", 80))
-        return s.getsockname()[0]
-    finally:
-        s.close()
+async def on_user_start_speaking(wake_word=None):
+    if speech_sound is not None and speech_sound.is_speaking:
+        console.print("Barge-in, interrupting the assistant.", style="audio")
+        speech_sound.interrupt()
 
-def get_qr_code_base64():
-    local_ip = get_local_ip()
-    qr_img = qrcode.make(f"http://{local_ip}:4812")
-    import base64
-    from io import BytesIO
-    buffer = BytesIO()
-    qr_img.save(buffer, format="PNG")
-    qr_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
-    return qr_base64
-
-async def on_user_start_speaking():
-    await websocket_client.send_wake_word_trigger()
+    # ends the interrupted answer's trace as abandoned
+    trace_id = TRACER.start("voice")
+    await websocket_client.send_wake_word_trigger(wake_word, trace_id=trace_id)
 
     sound = Sound.from_name("wake")
-    sound_manager.add_sound(sound)
+    sound_manager.add_sound(sound, bus="alert")
 
     await lucy_webview.set_volume(0)
-    sound_manager.set_volume(0.1)
+    # keep timers and effects down while the user talks
+    sound_manager.hold_duck("alert", True)
     await lucy_webview.set_state("listening")
     console.print("User started speaking. Wake word detected.", style="audio")
 
 async def on_user_end_speaking(transcription):
     await lucy_webview.set_volume(0.5)
-    sound_manager.set_volume(1.0)
+    sound_manager.hold_duck("alert", False)
 
     if transcription is None:
+        TRACER.finish("no_request")
         await lucy_webview.set_state("idle")
     else:
         sound = Sound.from_name("acknowledge")
-        sound_manager.add_sound(sound)
+        sound_manager.add_sound(sound, bus="alert")
 
         await lucy_webview.set_state("thinking")
         console.print(f"Sending transcription: {transcription}", style="websocket")
-        await websocket_client.send_request(transcription)
+        # typed requests have no wake word to start their trace
+        trace_id = TRACER.current_id() or TRACER.start("typed")
+        await websocket_client.send_request(transcription, trace_id=trace_id)
+        TRACER.mark("request_sent")
 
 async def on_assistant_start_speaking():
     await lucy_webview.set_state("speaking")
     await lucy_webview.set_volume(0.1)
-    sound_manager.set_volume(0.1)
+
+def on_assistant_playback_start():
+    TRACER.mark("playback_start", once=True)
 
 def on_assistant_end_speaking():
-    sound_manager.set_volume(1.0)
+    TRACER.finish("done")
 
     async def update_state():
         await lucy_webview.set_volume(0.5)
@@ -161,47 +156,59 @@ async def on_disconnect():
 async def on_message(message):
     global is_in_request, speech_sound
 
+    TRACER.mark("first_reply", once=True)
     if message["type"] == "tool":
+        TRACER.mark("tool", once=True)
         sound = Sound.from_name("use_tool")
-        sound_manager.add_sound(sound)
+        sound_manager.add_sound(sound, bus="alert")
     elif message["type"] == "assistant":
+        TRACER.mark("assistant", once=True)
         sound = Sound.from_name("complete")
-        sound_manager.add_sound(sound)
+        sound_manager.add_sound(sound, bus="alert")
 
         await lucy_webview.set_volume(0.1)
-        sound_manager.set_volume(0.1)
     elif message["type"] == "tool_message":
-        if message["tool"] in client_modules:
-            module = client_modules[message["tool"]]
+        module = await tool_registry.get(message["tool"]) if tool_registry is not None else None
+        if module is not None:
             await module.handle_message(message["data"])
     elif message["type"] == "end":
         console.print("End of conversation detected.", style="system")
         is_in_request = False
+        TRACER.mark("stream_end")
+        if not TRACER.has_mark("first_audio"):
+            # nothing to play, so no end of speech to wait for
+            TRACER.finish("no_speech")
+        speech_sound.end_stream()
     elif message["type"] == "speech_start":
+        TRACER.mark("tts_start", once=True)
+        speech_sound.start_stream()
         await on_assistant_start_speaking()
     elif message["type"] == "audio":
-        base64_data = message["data"]
-        audio_data = base64.b64decode(base64_data)
-        audio_array = np.frombuffer(audio_data, dtype=np.float32)
-        audio_array = (audio_array * 32767 * 32767).astype(np.int32)
-        speech_sound.add_audio_data(audio_array)
+        TRACER.mark("first_audio", once=True)
+        speech_sound.add_audio_data(decode_speech_audio(message["data"]))
 
 async def app():
-    global lucy_webview, va, main_loop_asyncio, is_in_request, websocket_client, sound_manager, speech_sound
+    global lucy_webview, va, echo_canceller, main_loop_asyncio, is_in_request, websocket_client, sound_manager, speech_sound, tool_registry
 
     main_loop_asyncio = asyncio.get_event_loop()
+    asyncio.create_task(metrics.monitor_event_loop_lag())
+    asyncio.create_task(metrics.dump_json_periodically(METRICS_FILE))
+    asyncio.create_task(TRACER.export_periodically(TRACES_FILE, max_bytes=get_config()["trace_file_max_mb"] * 2**20))
+    asyncio.create_task(watch_config_file())
 
-    console.print("Starting Flask Config Server...", style="system")
-    start_flask_server()
+    console.print("Starting Config Server...", style="system")
+    await start_config_server()
 
     console.print("Starting Lucy WebView...", style="webview")
     lucy_webview = SocketWebView()
-    lucy_webview.start_frontend_server()
     await lucy_webview.start()
     if args.open_ui:
         lucy_webview.open(args.browser_path, dev=args.dev)
     await lucy_webview.wait_for_connection()
-    await lucy_webview.update_ip_qr(f"{get_local_ip()}:4812", get_qr_code_base64())    
+    qr_code = ConfigQRCode(port=4812)
+    await qr_code.refresh()
+    await lucy_webview.update_ip_qr(qr_code)
+    asyncio.create_task(qr_code.watch(lucy_webview.update_ip_qr))
     await lucy_webview.set_connected(False)
     
     if get_config()["type_mode"] == True:
@@ -215,8 +222,17 @@ async def app():
                         time.sleep(0.1)
                         continue
                     is_in_request = True
-                    transcription = input("Enter your message: ")
-                    on_user_end_speaking(transcription.strip())
+                    transcription = input("Enter your message: ").strip()
+                    if not transcription:
+                        is_in_request = False
+                        continue
+                    # on the main loop, with everything else that talks to the server
+                    future = asyncio.run_coroutine_threadsafe(on_user_end_speaking(transcription), main_loop_asyncio)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        console.print(f"Sending the typed request failed: {e!r}", style="websocket")
+                        is_in_request = False
                 except KeyboardInterrupt:
                     break
                 except EOFError:
@@ -227,11 +243,21 @@ async def app():
     else:
         console.print("Starting Voice Assistant...", style="audio")
 
-        detect_speech_provider = DetectWakeWordProvider(wake_word_detection_callback=on_user_start_speaking)
+        if get_config()["echo_cancellation"]:
+            echo_canceller = EchoCanceller()
+
+        detect_speech_provider = DetectWakeWordProvider(wake_words=get_config()["wake_words"],
+                                                        wake_word_detection_callback=on_user_start_speaking,
+                                                        vad_gate=get_config()["vad_gate"],
+                                                        preroll_ms=get_config()["vad_preroll_ms"])
         va = VoiceAssistant(detect_speech_provider, 
                             mic_list=get_config()["microphones"],
                             start_speaking_callback=None, 
-                            end_speaking_callback=on_user_end_speaking)
+                            end_speaking_callback=on_user_end_speaking,
+                            echo_canceller=echo_canceller,
+                            speculative_transcription=get_config()["speculative_transcription"],
+                            speculative_pause_ms=get_config()["speculative_pause_ms"],
+                            microphone_mode=get_config()["microphone_mode"])
         await va.run()
 
     console.print("Connecting to Lucy Server...", style="websocket")
@@ -240,25 +266,31 @@ async def app():
         get_ws_url(),
         on_reconnect=on_reconnect,
         on_disconnect=on_disconnect,
-        on_message=on_message
+        on_message=on_message,
+        send_queue=get_config()["send_queue"]
     )
     await websocket_client.connect()
 
     console.print("Starting Sound Manager...", style="audio")
-    sound_manager = SoundManager()
+    if get_config()["mixer_process"]:
+        # mixing and audio output in their own process, away from our GIL
+        sound_manager = RemoteSoundManager()
+    else:
+        sound_manager = SoundManager()
+    if echo_canceller is not None:
+        sound_manager.add_output_listener(echo_canceller.push_reference)
 
     console.print("Adding Speech Sound...", style="audio")
-    speech_sound = SpeechSound(sample_rate=24000, volume_callback=on_assistant_speech_volume, done_speaking_callback=on_assistant_end_speaking)
-    sound_manager.add_sound(speech_sound)
+    speech_sound = sound_manager.add_sound(SpeechSound(sample_rate=24000, volume_callback=on_assistant_speech_volume, done_speaking_callback=on_assistant_end_speaking, start_speaking_callback=on_assistant_playback_start), bus="speech")
 
     console.print("Loading Client Modules...", style="system")
-    LucyClientModule.websocket_client = websocket_client
-    LucyClientModule.lucy_webview = lucy_webview
-    LucyClientModule.sound_manager = sound_manager
-    client_modules["spotify"] = LSpotifyClient()
-    client_modules["clock"] = LClockClient()
+    # built on their first message, see ToolRegistry
+    tool_registry = ToolRegistry(ToolContext(websocket_client, lucy_webview, sound_manager), allowed=get_config()["tools"])
 
     console.print("Setup Complete!", style="system")
+    tool_registry.start_warm_up()
+    # lets type mode ask for the first message
+    is_in_request = False
 
     # keep thread alive
     while True:
@@ -0,0 +1,5 @@
+"""
+Headless benchmarks for the hub. Each module is runnable on its own, e.g.
+
+    python -m lucyhubclient.bench.pipeline utterance.wav
+"""
@@ -0,0 +1,87 @@
+import argparse
+
+import numpy as np
+
+from ..sound import SpeechSound, AdaptiveJitterBuffer
+
+def simulate(jitter_ms, jitter_buffer, seconds=5, packet_ms=100, seed=0):
+    """
+    Feeds SpeechSound a synthetic 24 kHz TTS stream whose packets arrive late
+    by a random amount of up to jitter_ms, on a virtual clock so the run is
+    deterministic and much faster than real time.
+    """
+    clock = [0.0]
+    done_times = []
+    sound = SpeechSound(sample_rate=24000,
+                        done_speaking_callback=lambda: done_times.append(clock[0]),
+                        jitter_buffer=jitter_buffer,
+                        clock=lambda: clock[0])
+
+    rng = np.random.default_rng(seed)
+    num_packets = int(seconds * 1000 / packet_ms)
+    arrivals = np.arange(num_packets) * packet_ms / 1000 + rng.exponential(jitter_ms / 1000 / 3, num_packets) if jitter_ms else np.arange(num_packets) * packet_ms / 1000
+    arrivals = np.maximum.accumulate(arrivals)  # the websocket delivers in order
+
+    packet_samples = 24000 * packet_ms // 1000
+    t = np.arange(packet_samples * num_packets) / 24000
+    tone = (0.3 * np.sin(2 * np.pi * 220 * t) * 32767 * 32767).astype(np.int32)
+
+    block_period = 1024 / 48000
+    output = []
+    now = 0.0
+    next_packet = 0
+    end_sent_time = None
+    while now < arrivals[-1] + seconds:
+        while next_packet < num_packets and arrivals[next_packet] <= now:
+            clock[0] = arrivals[next_packet]
+            start = next_packet * packet_samples
+            sound.add_audio_data(tone[start:start + packet_samples])
+            next_packet += 1
+        if next_packet == num_packets and end_sent_time is None:
+            sound.end_stream()
+            end_sent_time = now
+
+        clock[0] = now
+        output.append(sound.get_next(1024)[:, 0])
+        now += block_period
+
+    output = np.concatenate(output).astype(np.float64) / 32768 / 32768
+    audible = np.flatnonzero(output)
+    first, last = audible[0], audible[-1]
+    played = output[first:last + 1]
+
+    # silent stretches inside the answer, at least 1 ms long
+    silent = (played == 0).astype(np.int8)
+    edges = np.diff(np.concatenate(([0], silent, [0])))
+    gap_lengths = np.flatnonzero(edges == -1) - np.flatnonzero(edges == 1)
+    gaps = int(np.sum(gap_lengths >= 48))
+
+    # a hard cut of the 0.3 amplitude tone jumps far more than any sine step
+    clicks = int(np.sum(np.abs(np.diff(played)) > 0.05))
+
+    return {
+        "start_delay_ms": 1000 * (first / 48000 - arrivals[0]),
+        "gaps": gaps,
+        "clicks": clicks,
+        "false_ends": sum(1 for t in done_times if t < end_sent_time),
+        "end_after_stream_ms": 1000 * (done_times[-1] - end_sent_time) if done_times else None,
+    }
+
+def main(args):
+    print(f"{'jitter':>8} {'buffer':>10} {'start ms':>9} {'gaps':>5} {'clicks':>7} {'false ends':>11}")
+    for jitter_ms in args.jitter:
+        for name, make_buffer in [("none", lambda: AdaptiveJitterBuffer(min_delay=0, max_delay=0)),
+                                  ("adaptive", AdaptiveJitterBuffer)]:
+            results = [simulate(jitter_ms, make_buffer(), seconds=args.seconds, seed=seed) for seed in range(args.runs)]
+            print(f"{jitter_ms:>6}ms {name:>10} "
+                  f"{np.mean([r['start_delay_ms'] for r in results]):>9.1f} "
+                  f"{np.mean([r['gaps'] for r in results]):>5.1f} "
+                  f"{np.mean([r['clicks'] for r in results]):>7.1f} "
+                  f"{np.sum([r['false_ends'] for r in results]):>11}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay synthetic jittery TTS streams through SpeechSound.")
+    parser.add_argument("--jitter", type=int, nargs="+", default=[0, 20, 50, 100, 200], help="Maximum packet lateness in ms")
+    parser.add_argument("--seconds", type=float, default=5, help="Length of each synthetic answer")
+    parser.add_argument("--runs", type=int, default=5)
+    main(parser.parse_args())
@@ -0,0 +1,59 @@
+import argparse
+import asyncio
+import gzip
+import re
+import time
+
+import aiohttp
+import numpy as np
+
+from ..socket_webview import SocketWebView
+
+async def load_page(session, cache):
+    """
+    Fetches the kiosk page and the frame it embeds the way a browser would,
+    honouring `cache` ({url: (etag, immutable)}). Returns (bytes, seconds).
+    """
+    start_time = time.perf_counter()
+    total_bytes = 0
+    urls = ["http://127.0.0.1:4814/"]
+    while urls:
+        url = urls.pop()
+        etag, immutable = cache.get(url, (None, False))
+        if immutable:
+            continue
+        headers = {"Accept-Encoding": "gzip"}
+        if etag:
+            headers["If-None-Match"] = etag
+        async with session.get(url, headers=headers) as response:
+            body = await response.read()
+            total_bytes += len(body)
+            if response.status == 200:
+                cache[url] = (response.headers.get("ETag"), "immutable" in response.headers.get("Cache-Control", ""))
+                text = (gzip.decompress(body) if response.headers.get("Content-Encoding") == "gzip" else body).decode()
+                urls += ["http://127.0.0.1:4814/" + src for src in re.findall(r'<iframe id="music-bg" src="([^"]+)"', text)]
+    return total_bytes, time.perf_counter() - start_time
+
+async def main(args):
+    webview = SocketWebView()
+    await webview.start()
+
+    async with aiohttp.ClientSession(auto_decompress=False) as session:
+        cold, reload = [], []
+        for _ in range(args.runs):
+            cache = {}
+            cold.append(await load_page(session, cache))
+            reload.append(await load_page(session, cache))
+
+    await webview.close()
+
+    for name, results in (("first load", cold), ("reload", reload)):
+        sizes = [r[0] for r in results]
+        times = [r[1] * 1000 for r in results]
+        print(f"{name:>10}: {int(np.median(sizes)):>6} bytes, median {np.median(times):.2f} ms, max {np.max(times):.2f} ms")
+    print("[BENCH] Browser first paint is reported by the kiosk as lucy_kiosk_first_paint_seconds")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure what the kiosk UI transfers on first load and on reload.")
+    parser.add_argument("--runs", type=int, default=20)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,215 @@
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+
+import aiohttp
+import numpy as np
+
+from ..client import LucyWebSocketClient
+from ..config import get_ws_url, get_http_url
+from ..speech.audio_source import WavFileSource
+from ..tracing import new_trace_id
+from .stub_server import StubLucyServer
+
+LATENCIES = ["transcribe_ms", "first_response_ms", "first_audio_ms", "complete_ms"]
+
+class VirtualHub:
+    """
+    One simulated hub: a real LucyWebSocketClient plus the transcribe
+    upload, replaying utterances one interaction at a time and timing each
+    one from the moment it sends the request.
+    """
+    def __init__(self, index, ws_url, http_url, session, utterances, args):
+        self.index = index
+        self.http_url = http_url
+        self.session = session
+        self.utterances = utterances
+        self.args = args
+        self.rng = random.Random(index)
+
+        self.latencies = {name: [] for name in LATENCIES}
+        self.completed = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.audio_bytes = 0
+
+        self.connected = asyncio.Event()
+        self.done = asyncio.Event()
+        self.request_time = None
+        self.trace_id = None
+        self.marks = {}
+        self.stale_messages = 0
+
+        self.client = LucyWebSocketClient(ws_url, on_reconnect=self._on_reconnect, on_disconnect=self._on_disconnect, on_message=self._on_message)
+
+    async def _on_reconnect(self):
+        self.connected.set()
+
+    async def _on_disconnect(self):
+        self.connected.clear()
+
+    async def _on_message(self, message):
+        if self.request_time is None:
+            return
+        # a late answer to an interaction that timed out must not finish
+        # this one; servers that don't echo trace_id can't be told apart
+        if message.get("trace_id", self.trace_id) != self.trace_id:
+            self.stale_messages += 1
+            return
+        now = time.monotonic()
+        self.marks.setdefault("first_response_ms", now)
+        if message["type"] == "audio":
+            self.marks.setdefault("first_audio_ms", now)
+            # counted, not decoded, so hundreds of hubs fit on one core
+            self.audio_bytes += len(message["data"]) * 3 // 4
+        elif message["type"] == "end":
+            self.marks["complete_ms"] = now
+            self.done.set()
+
+    async def _transcribe(self, audio, trace_id):
+        start_time = time.monotonic()
+        async with self.session.post(f"{self.http_url}/v1/meewhee/transcribe", data=audio.tobytes(),
+                                     headers={"Content-Type": "application/octet-stream", "X-Lucy-Trace-Id": trace_id}) as response:
+            result = await response.json()
+        self.latencies["transcribe_ms"].append((time.monotonic() - start_time) * 1000)
+        return result["transcription"]
+
+    async def _interact(self):
+        utterance = self.rng.choice(self.utterances)
+        # lets the server's spans for a slow interaction be found
+        trace_id = new_trace_id()
+        await self.client.send_wake_word_trigger("loadgen", trace_id=trace_id)
+        text = await self._transcribe(utterance, trace_id) if isinstance(utterance, np.ndarray) else utterance
+
+        self.marks = {}
+        self.done.clear()
+        self.trace_id = trace_id
+        self.request_time = time.monotonic()
+        await self.client.send_request(text, trace_id=trace_id)
+        try:
+            await asyncio.wait_for(self.done.wait(), self.args.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            return
+        finally:
+            request_time, self.request_time = self.request_time, None
+
+        for name, mark_time in self.marks.items():
+            self.latencies[name].append((mark_time - request_time) * 1000)
+        self.completed += 1
+
+    async def run(self, start_delay, end_time):
+        await asyncio.sleep(start_delay)
+        await self.client.connect()
+        try:
+            while time.monotonic() < end_time and (not self.args.interactions or self.completed + self.timeouts + self.errors < self.args.interactions):
+                await self.connected.wait()
+                try:
+                    await self._interact()
+                except Exception as e:
+                    self.errors += 1
+                    print(f"[LOADGEN] Hub {self.index}: {e!r}")
+                # exponential think time, like people asking at random
+                await asyncio.sleep(self.rng.expovariate(1 / self.args.think_seconds) if self.args.think_seconds > 0 else 0)
+        finally:
+            await self.client.close()
+
+def percentiles(values):
+    if not values:
+        return None
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50": float(p50), "p95": float(p95), "p99": float(p99), "n": len(values)}
+
+def load_utterances(args):
+    utterances = [WavFileSource(path, speed=0).audio_data for path in args.wav]
+    utterances += args.text
+    return utterances or ["what time is it"]
+
+async def run(args, ws_url, http_url):
+    utterances = load_utterances(args)
+    # one connection pool for every hub's uploads
+    connector = aiohttp.TCPConnector(limit=args.http_connections)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        hubs = [VirtualHub(i, ws_url, http_url, session, utterances, args) for i in range(args.hubs)]
+        start_time = time.monotonic()
+        end_time = start_time + args.ramp_seconds + args.duration
+        cpu_start = time.process_time()
+        await asyncio.gather(*(hub.run(args.ramp_seconds * i / args.hubs, end_time) for i, hub in enumerate(hubs)))
+        wall = time.monotonic() - start_time
+        cpu = time.process_time() - cpu_start
+
+    report = {
+        "hubs": args.hubs,
+        "seconds": wall,
+        "client_cpu_percent": 100 * cpu / wall,
+        "completed": sum(hub.completed for hub in hubs),
+        "timeouts": sum(hub.timeouts for hub in hubs),
+        "errors": sum(hub.errors for hub in hubs),
+        "stale_messages": sum(hub.stale_messages for hub in hubs),
+        "tts_audio_seconds": sum(hub.audio_bytes for hub in hubs) / 4 / 24000,
+        "overall": {name: percentiles([value for hub in hubs for value in hub.latencies[name]]) for name in LATENCIES},
+        "per_hub": [{name: percentiles(hub.latencies[name]) for name in LATENCIES} for hub in hubs],
+    }
+    return report
+
+def print_report(report):
+    print(f"[LOADGEN] {report['hubs']} hubs for {report['seconds']:.1f} s: {report['completed']} completed, "
+          f"{report['timeouts']} timed out, {report['errors']} failed, {report['stale_messages']} stale messages ignored, "
+          f"{report['completed'] / report['seconds']:.1f} interactions/s, client CPU {report['client_cpu_percent']:.0f}%")
+    print(f"{'latency (ms)':>20} {'p50':>8} {'p95':>8} {'p99':>8} {'n':>6}   per-hub p95 min / median / max")
+    for name, overall in report["overall"].items():
+        if overall is None:
+            continue
+        hub_p95 = [hub[name]["p95"] for hub in report["per_hub"] if hub[name] is not None]
+        print(f"{name:>20} {overall['p50']:8.1f} {overall['p95']:8.1f} {overall['p99']:8.1f} {overall['n']:6d}   "
+              f"{min(hub_p95):.1f} / {np.median(hub_p95):.1f} / {max(hub_p95):.1f}")
+
+async def main(args):
+    stub = None
+    if args.self_test:
+        stub = StubLucyServer(tts_seconds=args.tts_seconds)
+        await stub.start()
+        ws_url, http_url = stub.ws_url, stub.http_url
+    else:
+        ws_url, http_url = args.url or get_ws_url(), args.http_url or get_http_url()
+
+    try:
+        report = await run(args, ws_url, http_url)
+    finally:
+        if stub is not None:
+            await stub.close()
+
+    print_report(report)
+    if args.json_out:
+        with open(args.json_out, "w") as f:
+            json.dump(report, f, indent=4)
+
+    if args.self_test:
+        # every hub has to get through every interaction against the stub
+        expected = args.hubs * args.interactions if args.interactions else None
+        passed = report["timeouts"] == 0 and report["errors"] == 0 and report["completed"] > 0 \
+            and (expected is None or report["completed"] == expected)
+        print(f"[LOADGEN] Self-test {'passed' if passed else 'FAILED'}")
+        return 0 if passed else 1
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate many hubs against a Lucy server and report per-hub latency percentiles.")
+    parser.add_argument("--hubs", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=60, help="Seconds to keep interacting after the ramp up")
+    parser.add_argument("--interactions", type=int, default=0, help="Stop each hub after this many interactions, 0 for no limit")
+    parser.add_argument("--ramp-seconds", type=float, default=10, help="Hubs connect evenly spread over this long")
+    parser.add_argument("--think-seconds", type=float, default=5, help="Mean pause between a hub's interactions")
+    parser.add_argument("--wav", action="append", default=[], help="Utterance to upload for transcription, may be repeated")
+    parser.add_argument("--text", action="append", default=[], help="Request to send as typed text, may be repeated")
+    parser.add_argument("--url", type=str, default=None, help="Server websocket URL (default: from the config)")
+    parser.add_argument("--http-url", type=str, default=None, help="Server HTTP URL (default: from the config)")
+    parser.add_argument("--http-connections", type=int, default=100, help="Concurrent transcribe uploads across all hubs")
+    parser.add_argument("--timeout", type=float, default=30, help="Seconds before an interaction counts as timed out")
+    parser.add_argument("--self-test", action="store_true", help="Run against a local stub server and check every interaction completes")
+    parser.add_argument("--tts-seconds", type=float, default=1.0, help="Length of the stub server's answer with --self-test")
+    parser.add_argument("--json-out", type=str, default=None, help="Write the full report, per hub, to this file")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,75 @@
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import soundfile as sf
+
+from ..sound import SoundManager, Sound, NullSink, LoopPlaybackModifier
+
+def write_test_wav(path, minutes):
+    # written a second at a time so making the file doesn't skew the numbers
+    t = np.arange(48000) / 48000
+    second = (0.2 * np.sin(2 * np.pi * 440 * t) * 32767).astype(np.int16)
+    second = np.stack((second, second), axis=-1)
+    with sf.SoundFile(path, "w", samplerate=48000, channels=2, subtype="PCM_16") as f:
+        for _ in range(int(minutes * 60)):
+            f.write(second)
+
+def current_rss_mb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+def play(args):
+    sound_manager = SoundManager(sink=NullSink(), start_thread=False)
+    baseline = current_rss_mb()
+
+    cpu_start = time.process_time()
+    sound = Sound.from_wav(args.wav, stream=args.mode == "stream")
+    load_cpu = time.process_time() - cpu_start
+    frames = len(sound.audio_data)
+    # like the clock's alarm, loop the middle third
+    sound.add_playback_modifier(LoopPlaybackModifier(frames // 3, frames * 2 // 3))
+    sound_manager.add_sound(sound, bus="alarm")
+
+    # the whole file plus one more trip through the loop
+    num_blocks = (frames + frames // 3) // sound_manager.CHUNK_SIZE
+    rss = []
+    cpu_start = time.process_time()
+    for i in range(num_blocks):
+        sound_manager.render_block()
+        if i % 100 == 0:
+            rss.append(current_rss_mb() - baseline)
+    play_cpu = time.process_time() - cpu_start
+    sound_manager.stop()
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    audio_seconds = num_blocks * sound_manager.CHUNK_SIZE / sound_manager.SAMPLE_RATE
+    print(f"{args.mode:>8}: load {load_cpu * 1000:7.1f} ms CPU, play {play_cpu:.2f} s CPU for {audio_seconds:.0f} s "
+          f"({100 * play_cpu / audio_seconds:.2f}%), RSS over baseline median {np.median(rss):6.1f} MB max {max(rss):6.1f} MB, "
+          f"process peak {peak:.0f} MB")
+
+def main(args):
+    if args.mode is not None:
+        play(args)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        wav = args.wav or os.path.join(tmp_dir, "long.wav")
+        if args.wav is None:
+            write_test_wav(wav, args.minutes)
+        print(f"[BENCH] {os.path.getsize(wav) / 2**20:.0f} MB WAV")
+        # one process per mode so the peaks don't mix
+        for mode in ["memory", "stream"]:
+            subprocess.run([sys.executable, "-m", "lucyhubclient.bench.long_sound", "--mode", mode, "--wav", wav], check=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare RSS and CPU of playing a long WAV loaded into memory and streamed from disk.")
+    parser.add_argument("--minutes", type=float, default=10, help="Length of the generated test file")
+    parser.add_argument("--wav", type=str, default=None, help="Use this 48 kHz WAV instead of generating one")
+    parser.add_argument("--mode", choices=["memory", "stream"], default=None, help=argparse.SUPPRESS)
+    main(parser.parse_args())
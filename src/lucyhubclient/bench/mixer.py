@@ -0,0 +1,61 @@
+import argparse
+import time
+
+import numpy as np
+
+from ..sound import (SoundManager, Sound, SpeechSound, NullSink, WavFileSink,
+                     FadeInEffect, LoopPlaybackModifier, MIXER_VOICES_STOLEN, MIXER_VOICES_DROPPED)
+
+def build_scene(sound_manager, seconds, cues):
+    # TTS streamed in 100 ms packets at 24 kHz, like the server sends it
+    speech_sound = SpeechSound(sample_rate=24000, volume_callback=lambda data: None)
+    t = np.arange(int(24000 * seconds)) / 24000
+    speech = (0.3 * np.sin(2 * np.pi * 220 * t) * 32767 * 32767).astype(np.int32)
+    for start in range(0, len(speech), 2400):
+        speech_sound.add_audio_data(speech[start:start + 2400])
+    sound_manager.add_sound(speech_sound, bus="speech")
+
+    # a looping alarm with a fade in, like LClockClient
+    t = np.arange(48000 * 3) / 48000
+    alarm = (0.2 * np.sin(2 * np.pi * 880 * t) * 32767 * 32768).astype(np.int32)
+    alarm_sound = Sound(np.stack((alarm, alarm), axis=-1))
+    alarm_sound.add_effect(FadeInEffect(48000))
+    alarm_sound.add_playback_modifier(LoopPlaybackModifier(48000, 96000))
+    sound_manager.add_sound(alarm_sound, bus="alarm")
+
+    # more cues than there are voices, the voice limit takes the rest
+    names = ["wake", "acknowledge", "use_tool", "complete"]
+    for i in range(cues):
+        sound_manager.add_sound(Sound.from_name(names[i % len(names)]), bus="alert")
+
+def main(args):
+    sink = WavFileSink(args.wav_out) if args.wav_out else NullSink()
+    sound_manager = SoundManager(sink=sink, start_thread=False)
+    build_scene(sound_manager, args.seconds, args.cues)
+
+    num_blocks = int(args.seconds * sound_manager.SAMPLE_RATE / sound_manager.CHUNK_SIZE)
+    block_times = np.zeros(num_blocks)
+
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for i in range(num_blocks):
+        block_start = time.perf_counter()
+        sink.write(sound_manager.render_block())
+        block_times[i] = time.perf_counter() - block_start
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+
+    sound_manager.stop()
+
+    audio_seconds = num_blocks * sound_manager.CHUNK_SIZE / sound_manager.SAMPLE_RATE
+    block_period_ms = 1000 * sound_manager.CHUNK_SIZE / sound_manager.SAMPLE_RATE
+    print(f"[BENCH] Rendered {audio_seconds:.1f} s of audio in {wall:.3f} s ({audio_seconds / wall:.1f}x real time, {cpu:.3f} s CPU)")
+    print(f"[BENCH] {args.cues} cues, {sum(MIXER_VOICES_STOLEN.values.values())} voices stolen and {sum(MIXER_VOICES_DROPPED.values.values())} dropped at a limit of {sound_manager.max_voices}")
+    print(f"[BENCH] Block time: mean {block_times.mean() * 1000:.3f} ms, p99 {np.percentile(block_times, 99) * 1000:.3f} ms, max {block_times.max() * 1000:.3f} ms (budget {block_period_ms:.1f} ms)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure SoundManager render throughput without a sound card.")
+    parser.add_argument("--seconds", type=float, default=30, help="Seconds of audio to render")
+    parser.add_argument("--cues", type=int, default=4, help="Alert sounds started along with the speech and the alarm")
+    parser.add_argument("--wav-out", type=str, default=None, help="Write the mix to this WAV file instead of discarding it")
+    main(parser.parse_args())
@@ -0,0 +1,80 @@
+import argparse
+import asyncio
+import json
+import threading
+import time
+
+import numpy as np
+
+from ..sound import SoundManager, SpeechSound, NullSink
+from ..mixer_process import RemoteSoundManager
+
+class GapSink(NullSink):
+    """Real-time NullSink that reports how late blocks were written."""
+    def __init__(self, sample_rate=48000):
+        super().__init__(sample_rate, realtime=True)
+        self.write_times = []
+
+    def write(self, chunk):
+        self.write_times.append(time.perf_counter())
+        super().write(chunk)
+
+    def close(self):
+        gaps = np.diff(self.write_times) * 1000
+        period = 1000 * 1024 / self.sample_rate
+        late = np.count_nonzero(gaps > period * 1.5)
+        print(f"[BENCH] {len(gaps)} blocks, gap p99 {np.percentile(gaps, 99):.1f} ms, max {gaps.max():.1f} ms, "
+              f"{late} later than 1.5x the {period:.1f} ms period")
+
+def busy_thread(stop):
+    # pure Python work standing in for VAD, wake word scoring and the like
+    while not stop.is_set():
+        sum(i * i for i in range(20000))
+
+async def busy_loop(seconds):
+    # JSON decode bursts, like a run of large websocket messages
+    blob = json.dumps([{"type": "audio", "data": "x" * 1000, "n": i} for i in range(2000)])
+    end_time = time.monotonic() + seconds
+    while time.monotonic() < end_time:
+        for _ in range(5):
+            json.loads(blob)
+        await asyncio.sleep(0.01)
+
+async def run(mode, seconds, threads):
+    if mode == "process":
+        sound_manager = RemoteSoundManager(sink_factory=GapSink)
+    else:
+        sound_manager = SoundManager(sink=GapSink())
+
+    speech_sound = sound_manager.add_sound(SpeechSound(sample_rate=24000, volume_callback=lambda data: None), bus="speech")
+    t = np.arange(24000 * int(seconds)) / 24000
+    speech = (0.3 * np.sin(2 * np.pi * 220 * t) * 32767 * 32767).astype(np.int32)
+
+    stop = threading.Event()
+    workers = [threading.Thread(target=busy_thread, args=(stop,)) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+
+    async def feed():
+        # TTS packets of 100 ms, sent a little faster than real time
+        for start in range(0, len(speech), 2400):
+            speech_sound.add_audio_data(speech[start:start + 2400])
+            await asyncio.sleep(0.09)
+
+    await asyncio.gather(feed(), busy_loop(seconds))
+    stop.set()
+    for worker in workers:
+        worker.join()
+
+    print(f"[BENCH] mode={mode}, {threads} busy threads")
+    sound_manager.stop()
+    await asyncio.sleep(0.2)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare output block timing of the in-process mixer and the mixer process while this process is busy.")
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--threads", type=int, default=2, help="Busy Python threads competing for the GIL")
+    parser.add_argument("--mode", choices=["thread", "process", "both"], default="both")
+    args = parser.parse_args()
+    for mode in (["thread", "process"] if args.mode == "both" else [args.mode]):
+        asyncio.run(run(mode, args.seconds, args.threads))
@@ -0,0 +1,86 @@
+import argparse
+import asyncio
+import random
+import sys
+import threading
+import time
+
+import numpy as np
+
+from ..sound import SoundManager, Sound, SpeechSound, NullSink, FadeInEffect, FadeOutEffect
+
+async def hammer(sound_manager, speech_sound, seconds, max_interval, seed, counts):
+    """One coroutine issuing a random stream of mixer commands."""
+    rng = random.Random(seed)
+    tone = (0.05 * np.sin(np.arange(4800) / 10) * 32767 * 32768).astype(np.int32)
+    my_sounds = []
+    end_time = time.monotonic() + seconds
+    while time.monotonic() < end_time:
+        action = rng.random()
+        if action < 0.3:
+            sound = Sound(np.stack((tone, tone), axis=-1)[:rng.randint(1024, 4800)])
+            sound_manager.add_sound(sound)
+            my_sounds.append(sound.get_id())
+        elif action < 0.5 and my_sounds:
+            sound_manager.add_effect_to_sound(rng.choice(my_sounds), rng.choice([FadeInEffect, FadeOutEffect])(2400))
+        elif action < 0.65 and my_sounds:
+            sound_manager.remove_sound(my_sounds.pop(rng.randrange(len(my_sounds))))
+        elif action < 0.8:
+            sound_manager.set_volume(rng.random())
+        elif action < 0.95:
+            speech_sound.add_audio_data(tone[:2400] // 2)
+        else:
+            speech_sound.interrupt()
+            speech_sound.start_stream()
+        counts[0] += 1
+        await asyncio.sleep(rng.random() * max_interval)
+
+async def main(args):
+    # realtime NullSink so blocks are paced like a sound card
+    sink = NullSink(realtime=True)
+    sound_manager = SoundManager(sink=sink, start_thread=False)
+    speech_sound = SpeechSound(sample_rate=24000)
+    # on its own bus, or the voice limit steals it like any effect
+    sound_manager.add_sound(speech_sound, bus="speech")
+
+    errors = []
+    block_times = []
+    def mixer_thread():
+        try:
+            while not sound_manager.should_stop:
+                start_time = time.perf_counter()
+                chunk = sound_manager.render_block()
+                block_times.append(time.perf_counter() - start_time)
+                sink.write(chunk)
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=mixer_thread, name="SoundManager")
+    thread.start()
+
+    counts = [0]
+    await asyncio.gather(*(hammer(sound_manager, speech_sound, args.seconds, args.max_interval_ms / 1000, seed, counts) for seed in range(args.coroutines)))
+    await asyncio.sleep(0.5)  # let the mixer apply what's left
+
+    alive = thread.is_alive()
+    sound_manager.should_stop = True
+    thread.join()
+    sink.close()
+
+    block_times = np.array(block_times) * 1000
+
+    print(f"[BENCH] {counts[0]} commands from {args.coroutines} coroutines in {args.seconds:.0f} s ({counts[0] / args.seconds:.0f}/s)")
+    print(f"[BENCH] Mixer thread {'survived' if alive and not errors else 'DIED: ' + repr(errors)}, {len(sound_manager.commands)} commands left queued, {len(sound_manager.sounds)} sounds active")
+    print(f"[BENCH] Block time: mean {block_times.mean():.3f} ms, p99 {np.percentile(block_times, 99):.3f} ms, max {block_times.max():.3f} ms (budget {1000 * sound_manager.CHUNK_SIZE / sound_manager.SAMPLE_RATE:.1f} ms)")
+
+    if speech_sound.get_id() not in sound_manager.sounds:
+        print("[BENCH] ERROR: the speech sound was dropped during the run, SpeechSound wasn't stressed")
+        return 1
+    return 0 if alive and not errors else 1
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Hammer SoundManager with control commands from many coroutines while it mixes.")
+    parser.add_argument("--coroutines", type=int, default=200)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--max-interval-ms", type=float, default=200, help="Each coroutine waits up to this long between commands")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,82 @@
+import argparse
+import time
+
+import numpy as np
+
+from ..speech.audio_source import AudioSource, MultiMicSource, WavFileSource
+
+class ArraySource(AudioSource):
+    def __init__(self, audio):
+        self.audio = audio
+        self.position = 0
+
+    def read(self, num_frames):
+        chunk = self.audio[self.position:self.position + num_frames]
+        self.position += num_frames
+        if len(chunk) < num_frames:
+            chunk = np.pad(chunk, (0, num_frames - len(chunk)))
+        return chunk.tobytes()
+
+def simulate_room(clean, num_mics, noise_db, seed=0):
+    """
+    The same speech picked up by num_mics microphones at different distances:
+    each one hears it quieter and later, over its own independent noise. The
+    last microphone is the closest.
+    """
+    rng = np.random.default_rng(seed)
+    speech_rms = np.sqrt(np.mean(clean[np.abs(clean) > 0.01] ** 2))
+    noise_std = speech_rms * 10 ** (noise_db / 20)
+
+    mics = []
+    for i in range(num_mics):
+        gain = 1.0 / (1 + 2 * (num_mics - 1 - i))
+        delay = int(rng.integers(0, 80)) if i != num_mics - 1 else 0
+        signal = np.concatenate((np.zeros(delay), clean[:len(clean) - delay])) * gain
+        signal = signal + rng.normal(0, noise_std, len(clean))
+        mics.append(np.clip(signal * 32768, -32768, 32767).astype(np.int16))
+    return mics
+
+def output_snr(output, clean, max_lag):
+    # best scaled and shifted copy of the clean speech counts as signal
+    correlation = np.fft.irfft(np.fft.rfft(output, 2 * len(output)) * np.conj(np.fft.rfft(clean, 2 * len(output))))
+    lags = np.concatenate((correlation[:max_lag + 1], correlation[-max_lag:]))
+    lag = int(np.argmax(lags))
+    lag = lag if lag <= max_lag else lag - len(lags)
+    shifted = np.roll(clean, lag)
+    scale = np.dot(output, shifted) / np.dot(shifted, shifted)
+    residual = output - scale * shifted
+    return 10 * np.log10(np.sum((scale * shifted) ** 2) / np.sum(residual ** 2))
+
+def run(mics, mode, frame_size=1536):
+    source = MultiMicSource([ArraySource(mic) for mic in mics], mode=mode)
+    output = []
+    selected = []
+    cpu_start = time.process_time()
+    for _ in range(len(mics[0]) // frame_size):
+        output.append(np.frombuffer(source.read(frame_size), dtype=np.int16))
+        selected.append(source.selected)
+    cpu = time.process_time() - cpu_start
+    return np.concatenate(output).astype(np.float64) / 32768, np.repeat(selected, frame_size), cpu
+
+def main(args):
+    clean = np.concatenate([WavFileSource(path, speed=0).audio_data for path in args.wav]).astype(np.float64) / 32768
+    num_frames = len(clean) // 1536
+    speech = np.abs(clean[:num_frames * 1536]) > 0.01
+
+    print(f"[BENCH] {len(clean) / 16000:.1f} s of audio, noise {args.noise_db} dB below speech")
+    print(f"{'mics':>5} {'mode':>9} {'us/frame':>9} {'us/mic':>7} {'closest':>8} {'SNR dB':>7}")
+    for num_mics in args.mics:
+        mics = simulate_room(clean, num_mics, args.noise_db)
+        for mode in ("select", "beamform"):
+            output, selected, cpu = run(mics, mode)
+            us_per_frame = 1e6 * cpu / num_frames
+            closest = 100 * np.mean(selected[speech] == num_mics - 1)
+            snr = output_snr(output, clean[:len(output)], max_lag=400)
+            print(f"{num_mics:>5} {mode:>9} {us_per_frame:>9.1f} {us_per_frame / num_mics:>7.1f} {closest:>7.1f}% {snr:>7.1f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure microphone selection and delay-and-sum on a simulated multi-mic room.")
+    parser.add_argument("wav", nargs="+", help="Clean speech recordings (any sample rate, resampled to 16 kHz)")
+    parser.add_argument("--mics", type=int, nargs="+", default=[1, 2, 4, 8], help="Microphone counts to try")
+    parser.add_argument("--noise-db", type=float, default=-20.0, help="Noise level of every microphone relative to the speech")
+    main(parser.parse_args())
@@ -0,0 +1,185 @@
+import argparse
+import asyncio
+import json
+import time
+
+import numpy as np
+
+from ..client import LucyWebSocketClient
+from ..sound import SoundManager, SpeechSound, NullSink, decode_speech_audio
+from ..speech import VoiceAssistant
+from ..speech.audio_source import WavFileSource
+from ..speech.detect_speech_provider.wake_word import DetectWakeWordProvider
+from .stub_server import StubLucyServer
+
+def find_voiced_segments(audio, sample_rate, frame_ms=20, threshold_db=-40, min_gap_ms=150):
+    frame_size = int(sample_rate * frame_ms / 1000)
+    num_frames = len(audio) // frame_size
+    frames = audio[:num_frames * frame_size].astype(np.float32).reshape(num_frames, frame_size) / 32768
+    rms_db = 20 * np.log10(np.sqrt((frames ** 2).mean(axis=1)) + 1e-9)
+    voiced = np.flatnonzero(rms_db > threshold_db)
+    if len(voiced) == 0:
+        return []
+
+    # split wherever the gap between voiced frames is long enough to be a pause
+    max_gap = max(1, int(min_gap_ms / frame_ms))
+    breaks = np.flatnonzero(np.diff(voiced) > max_gap)
+    starts = np.concatenate(([voiced[0]], voiced[breaks + 1]))
+    ends = np.concatenate((voiced[breaks], [voiced[-1]])) + 1
+    return [(int(s) * frame_size, int(e) * frame_size) for s, e in zip(starts, ends)]
+
+class FirstSampleSink(NullSink):
+    def __init__(self, marks):
+        super().__init__(realtime=True)
+        self.marks = marks
+
+    def write(self, chunk):
+        if "first_output_sample" not in self.marks and np.any(chunk):
+            self.marks["first_output_sample"] = time.monotonic()
+        super().write(chunk)
+
+async def run_once(args):
+    stub = StubLucyServer(tts_seconds=args.tts_seconds)
+    await stub.start()
+
+    marks = {}
+    connected = asyncio.Event()
+    done = asyncio.Event()
+    speech_sound = SpeechSound(sample_rate=24000)
+
+    async def on_reconnect():
+        connected.set()
+
+    async def on_disconnect():
+        pass
+
+    async def on_message(message):
+        if message["type"] == "audio":
+            marks.setdefault("first_tts_byte", time.monotonic())
+            speech_sound.add_audio_data(decode_speech_audio(message["data"]))
+        elif message["type"] == "end":
+            speech_sound.end_stream()
+            done.set()
+
+    websocket_client = LucyWebSocketClient(stub.ws_url, on_reconnect=on_reconnect, on_disconnect=on_disconnect, on_message=on_message)
+    await websocket_client.connect()
+    await connected.wait()
+
+    async def on_wake_word(wake_word=None):
+        marks.setdefault("wake_callback", time.monotonic())
+        await websocket_client.send_wake_word_trigger(wake_word)
+
+    async def on_end_speaking(transcription):
+        marks.setdefault("end_callback", time.monotonic())
+        if transcription is not None:
+            await websocket_client.send_request(transcription)
+
+    source = WavFileSource(args.wav, speed=args.speed)
+    detect_speech_provider = DetectWakeWordProvider(wake_word_detection_callback=on_wake_word, preroll_ms=args.preroll_ms)
+    va = VoiceAssistant(detect_speech_provider,
+                        end_speaking_callback=on_end_speaking,
+                        audio_source=source,
+                        http_url=stub.http_url,
+                        speculative_transcription=not args.no_speculative,
+                        speculative_pause_ms=args.speculative_pause_ms)
+
+    sound_manager = SoundManager(sink=FirstSampleSink(marks))
+    sound_manager.add_sound(speech_sound)
+
+    wall_start = time.monotonic()
+    cpu_start = time.process_time()
+
+    await va.run()
+    try:
+        await asyncio.wait_for(done.wait(), timeout=args.timeout)
+    except asyncio.TimeoutError:
+        print(f"[BENCH] No response within {args.timeout} seconds")
+
+    deadline = time.monotonic() + 1
+    while "first_output_sample" not in marks and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+
+    cpu_percent = 100 * (time.process_time() - cpu_start) / (time.monotonic() - wall_start)
+
+    va.stop()
+    sound_manager.stop()
+    await websocket_client.close()
+    await stub.close()
+
+    sample_rate = source.sample_rate
+    segments = find_voiced_segments(source.audio_data, sample_rate)
+    wake_end = int(args.wake_end * sample_rate) if args.wake_end is not None else (segments[0][1] if segments else 0)
+    speech_end = int(args.speech_end * sample_rate) if args.speech_end is not None else (segments[-1][1] if segments else 0)
+
+    # the transcription that became the request is the last one sent before it
+    request_time = stub.first_event("request")
+    transcribe_times = [t for name, t, _ in stub.events if name == "transcribe" and (request_time is None or t <= request_time)]
+    committed_transcribe = transcribe_times[-1] if transcribe_times else None
+    committed_samples = [data["samples"] for name, t, data in stub.events if name == "transcribe" and t == committed_transcribe]
+
+    # the query is everything voiced after the wake word segment
+    query_start = int(args.query_start * sample_rate) if args.query_start is not None else (segments[1][0] if len(segments) > 1 else wake_end)
+    query_samples = max(speech_end - query_start, 0)
+
+    def delta_ms(end, start):
+        if end is None or start is None:
+            return None
+        return (end - start) * 1000
+
+    return {
+        "wake_to_callback_ms": delta_ms(marks.get("wake_callback"), source.time_at(wake_end)),
+        "end_of_speech_to_request_ms": delta_ms(stub.first_event("request"), source.time_at(speech_end)),
+        "end_of_speech_to_transcribe_ms": delta_ms(committed_transcribe, source.time_at(speech_end)),
+        "first_tts_byte_to_first_output_ms": delta_ms(marks.get("first_output_sample"), marks.get("first_tts_byte")),
+        "captured_audio_ms": 1000 * committed_samples[0] / sample_rate if committed_samples else None,
+        "query_audio_ms": 1000 * query_samples / sample_rate,
+        "transcribe_requests": sum(1 for event in stub.events if event[0] == "transcribe"),
+        "cpu_percent": cpu_percent,
+    }
+
+def summarize(results):
+    summary = {}
+    for key in results[0]:
+        values = [r[key] for r in results if r[key] is not None]
+        if not values:
+            summary[key] = None
+            continue
+        summary[key] = {
+            "median": float(np.median(values)),
+            "max": float(np.max(values)),
+            "runs": len(values),
+        }
+    return summary
+
+async def main(args):
+    results = []
+    for i in range(args.runs):
+        result = await run_once(args)
+        print(f"[BENCH] Run {i + 1}/{args.runs}: {result}")
+        results.append(result)
+
+    summary = summarize(results)
+    if args.json:
+        print(json.dumps(summary, indent=4))
+    else:
+        for key, value in summary.items():
+            if value is None:
+                print(f"{key:>36}: n/a")
+            else:
+                print(f"{key:>36}: median {value['median']:8.1f}  max {value['max']:8.1f}  ({value['runs']} runs)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a recorded utterance through the voice pipeline against a local stub server.")
+    parser.add_argument("wav", help="Recording of the wake word followed by a query")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay speed, 1.0 is real time and 0 is as fast as possible")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--wake-end", type=float, default=None, help="Seconds into the file where the wake word ends (default: end of the first voiced segment)")
+    parser.add_argument("--speech-end", type=float, default=None, help="Seconds into the file where the query ends (default: end of the last voiced segment)")
+    parser.add_argument("--query-start", type=float, default=None, help="Seconds into the file where the query starts (default: start of the second voiced segment)")
+    parser.add_argument("--preroll-ms", type=int, default=300, help="Audio kept from before the VAD triggers, 0 disables it")
+    parser.add_argument("--tts-seconds", type=float, default=1.0, help="Length of the stub server's spoken answer")
+    parser.add_argument("--no-speculative", action="store_true", help="Only transcribe once the user has finished speaking")
+    parser.add_argument("--speculative-pause-ms", type=float, default=250, help="Gap in speech that starts a speculative transcription")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--json", action="store_true", help="Print the summary as JSON")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,137 @@
+import asyncio
+import base64
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import websockets
+
+class StubLucyServer:
+    """
+    Minimal local stand-in for LucyServer. Serves /v1/meewhee/transcribe over
+    HTTP and /v1/ws/meewhee over a websocket, answering every request with a
+    short streamed TTS tone. Every interesting event is recorded in `events`
+    with a time.monotonic() timestamp.
+    """
+    def __init__(self, host="127.0.0.1", transcription="what time is it", classification="query",
+                 tts_seconds=1.0, tts_packet_ms=100, tts_first_delay=0.2, tts_jitter_ms=0):
+        self.host = host
+        self.transcription = transcription
+        self.classification = classification
+
+        self.tts_seconds = tts_seconds
+        self.tts_packet_ms = tts_packet_ms
+        self.tts_first_delay = tts_first_delay
+        self.tts_jitter_ms = tts_jitter_ms
+
+        self.events = []
+        self.ws_server = None
+        self.http_server = None
+
+    def record(self, name, **data):
+        self.events.append((name, time.monotonic(), data))
+
+    def first_event(self, name):
+        for event_name, event_time, _ in self.events:
+            if event_name == name:
+                return event_time
+        return None
+
+    @property
+    def http_url(self):
+        return f"http://{self.host}:{self.http_port}"
+
+    @property
+    def ws_url(self):
+        return f"ws://{self.host}:{self.ws_port}"
+
+    async def start(self):
+        self.ws_server = await websockets.serve(self._websocket_handler, self.host, 0)
+        self.ws_port = self.ws_server.sockets[0].getsockname()[1]
+
+        self.http_server = ThreadingHTTPServer((self.host, 0), self._make_http_handler())
+        self.http_port = self.http_server.server_address[1]
+        threading.Thread(target=self.http_server.serve_forever, daemon=True).start()
+
+    async def close(self):
+        if self.http_server:
+            self.http_server.shutdown()
+        if self.ws_server:
+            self.ws_server.close()
+            await self.ws_server.wait_closed()
+
+    def _make_http_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length)
+                if self.path != "/v1/meewhee/transcribe":
+                    self.send_error(404)
+                    return
+                server.record("transcribe", samples=len(body) // 2)
+                payload = json.dumps({
+                    "transcription": server.transcription,
+                    "classification": server.classification,
+                }).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    async def _websocket_handler(self, websocket, path=None):
+        try:
+            async for message in websocket:
+                data = json.loads(message)
+                self.record(data["type"], data=data)
+                if data["type"] == "auth":
+                    await websocket.send(json.dumps({"type": "auth", "status": "ok"}))
+                elif data["type"] == "request":
+                    asyncio.create_task(self._respond(websocket, data.get("trace_id")))
+        except websockets.ConnectionClosed:
+            pass
+
+    async def _respond(self, websocket, trace_id=None):
+        async def send(data):
+            # echoed like the server does, so clients can tell answers apart
+            if trace_id is not None:
+                data["trace_id"] = trace_id
+            await websocket.send(json.dumps(data))
+
+        await asyncio.sleep(self.tts_first_delay)
+        await send({"type": "assistant", "message": "It is noon."})
+        await send({"type": "speech_start"})
+
+        sample_rate = 24000
+        packet_samples = int(sample_rate * self.tts_packet_ms / 1000)
+        total_samples = int(sample_rate * self.tts_seconds)
+        t = np.arange(total_samples) / sample_rate
+        tone = (0.3 * np.sin(2 * np.pi * 220 * t)).astype(np.float32)
+
+        start_time = time.monotonic()
+        for i, start in enumerate(range(0, total_samples, packet_samples)):
+            due = start_time + i * self.tts_packet_ms / 1000
+            if self.tts_jitter_ms:
+                due += random.uniform(0, self.tts_jitter_ms) / 1000
+            await asyncio.sleep(max(0, due - time.monotonic()))
+
+            packet = tone[start:start + packet_samples]
+            if i == 0:
+                self.record("first_audio")
+            await send({
+                "type": "audio",
+                "data": base64.b64encode(packet.tobytes()).decode("utf-8"),
+            })
+
+        await send({"type": "end"})
+        self.record("end")
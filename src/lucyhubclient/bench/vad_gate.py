@@ -0,0 +1,56 @@
+import argparse
+import time
+
+import numpy as np
+
+from ..speech.audio_source import WavFileSource
+from ..speech.detect_speech_provider.vad import DetectSpeechSileroVADProvider, VAD_CHUNKS
+
+def run(audio, vad_gate):
+    before = dict(VAD_CHUNKS.values)
+    provider = DetectSpeechSileroVADProvider(vad_gate=vad_gate)
+
+    frame_probabilities = []
+    cpu_start = time.process_time()
+    for start in range(0, len(audio) - 1535, 1536):
+        provider.feed_audio(audio[start:start + 1536].tobytes())
+        frame_probabilities.append(provider.speaking_history[-1])
+    cpu = time.process_time() - cpu_start
+
+    counts = {dict(key)["result"]: value - before.get(key, 0) for key, value in VAD_CHUNKS.values.items()}
+    return np.array(frame_probabilities), cpu, counts, len(provider.get_audio())
+
+def main(args):
+    audio = np.concatenate([WavFileSource(path, speed=0).audio_data for path in args.wav])
+    seconds = len(audio) / 16000
+
+    reference, reference_cpu, _, reference_captured = run(audio, None)
+    reference_speech = reference >= 0.5
+    print(f"[BENCH] {seconds:.1f} s of audio, {reference_speech.mean() * 100:.1f}% speech frames")
+    print(f"{'open dB':>8} {'CPU s':>7} {'x faster':>9} {'skipped':>8} {'agree':>7} {'missed':>7} {'captured':>9}")
+    print(f"{'off':>8} {reference_cpu:>7.3f} {1.0:>9.2f} {0:>7.1f}% {100:>6.1f}% {0:>7} {100:>8.1f}%")
+
+    for open_db in args.open_db:
+        vad_gate = {
+            "enabled": True,
+            "open_db": open_db,
+            "close_db": open_db / 2,
+            "hangover_ms": args.hangover_ms,
+            "min_level_db": args.min_level_db,
+        }
+        probabilities, cpu, counts, captured = run(audio, vad_gate)
+        speech = probabilities >= 0.5
+        total_chunks = sum(counts.get(k, 0) for k in ("inferred", "skipped"))
+        print(f"{open_db:>8.1f} {cpu:>7.3f} {reference_cpu / cpu:>9.2f} "
+              f"{100 * counts.get('skipped', 0) / max(total_chunks, 1):>7.1f}% "
+              f"{100 * np.mean(speech == reference_speech):>6.1f}% "
+              f"{int(np.sum(reference_speech & ~speech)):>7} "
+              f"{100 * captured / max(reference_captured, 1):>8.1f}%")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare Silero VAD with and without the energy pre-gate on recorded fixtures.")
+    parser.add_argument("wav", nargs="+", help="Recordings to replay (any sample rate, resampled to 16 kHz)")
+    parser.add_argument("--open-db", type=float, nargs="+", default=[3, 6, 9, 12], help="Gate opening thresholds above the noise floor to try")
+    parser.add_argument("--hangover-ms", type=int, default=300)
+    parser.add_argument("--min-level-db", type=float, default=-60.0)
+    main(parser.parse_args())
@@ -0,0 +1,42 @@
+import argparse
+import time
+
+import numpy as np
+
+from ..speech.audio_source import WavFileSource
+
+PRETRAINED_MODELS = ["alexa", "hey_jarvis", "hey_mycroft", "hey_rhasspy", "timer", "weather"]
+
+def time_predictions(models, audio, window_samples):
+    import openwakeword
+    from openwakeword.model import Model
+
+    openwakeword.utils.download_models()
+    model = Model(wakeword_models=models, inference_framework="onnx")
+
+    # same call pattern as DetectWakeWordProvider: the latest 0.4 s every step
+    times = []
+    for end in range(window_samples, len(audio), 1280):
+        start_time = time.perf_counter()
+        model.predict(audio[end - window_samples:end])
+        times.append(time.perf_counter() - start_time)
+    return np.array(times[5:])  # the first calls allocate
+
+def main(args):
+    if args.wav:
+        audio = np.concatenate([WavFileSource(path, speed=0).audio_data for path in args.wav])
+    else:
+        audio = (np.random.default_rng(0).normal(0, 1000, 16000 * 20)).astype(np.int16)
+
+    print(f"{'models':>7} {'mean ms':>8} {'p95 ms':>7} {'vs one':>7}")
+    baseline = None
+    for count in args.models:
+        times = time_predictions(PRETRAINED_MODELS[:count], audio, int(16000 * 0.4)) * 1000
+        baseline = baseline or times.mean()
+        print(f"{count:>7} {times.mean():>8.2f} {np.percentile(times, 95):>7.2f} {times.mean() / baseline:>6.2f}x")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time openWakeWord inference against the number of loaded wake word models.")
+    parser.add_argument("wav", nargs="*", help="Recordings to run the models on (default: 20 s of noise)")
+    parser.add_argument("--models", type=int, nargs="+", default=list(range(1, len(PRETRAINED_MODELS) + 1)), help="Model counts to try")
+    main(parser.parse_args())
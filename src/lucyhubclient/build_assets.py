@@ -0,0 +1,99 @@
+"""
+Minifies and precompresses the web UI templates into templates/dist, with
+content-hashed names and a manifest.json that web.TemplateCache serves from.
+
+    python -m lucyhubclient.build_assets
+
+Without a dist directory the same build runs in memory at startup.
+"""
+import gzip
+import hashlib
+import json
+import re
+from pathlib import Path
+
+TEMPLATES_DIR = Path(__file__).parent / "templates"
+DIST_DIR = TEMPLATES_DIR / "dist"
+
+SOURCES = ["index.html", "background.html", "config.html", "traces.html"]
+# served at fixed URLs, everything else gets the content hash in its name
+ENTRY_PAGES = ["index.html", "config.html", "traces.html"]
+
+def minify_html(text):
+    # Conservative on purpose: the pages carry inline JS and GLSL, so only
+    # comments and indentation go and every newline that matters stays.
+    text = re.sub(r"<!--.*?-->", "", text, flags=re.S)
+    lines = (line.strip() for line in text.splitlines())
+    return "\n".join(line for line in lines if line and not line.startswith("//"))
+
+def _compress(body):
+    encoded = {"identity": body, "gzip": gzip.compress(body, compresslevel=9, mtime=0)}
+    try:
+        import brotli
+        encoded["br"] = brotli.compress(body, quality=11)
+    except ImportError:
+        pass
+    return encoded
+
+def _digest(body):
+    return hashlib.sha256(body).hexdigest()[:12]
+
+def build(read_source):
+    """
+    read_source(name) returns a template's text. Returns
+    {name: {"path", "etag", "immutable", "encoded": {encoding: bytes}}}.
+    """
+    texts = {name: minify_html(read_source(name)) for name in SOURCES}
+
+    paths = {}
+    for name in SOURCES:
+        if name not in ENTRY_PAGES:
+            stem, suffix = name.rsplit(".", 1)
+            paths[name] = f"{stem}.{_digest(texts[name].encode())}.{suffix}"
+
+    assets = {}
+    for name in SOURCES:
+        text = texts[name]
+        for other, path in paths.items():
+            text = text.replace(f'"{other}"', f'"{path}"')
+        body = text.encode()
+        assets[name] = {
+            "path": paths.get(name, name),
+            "etag": f'"{_digest(body)}"',
+            "immutable": name not in ENTRY_PAGES,
+            "encoded": _compress(body),
+        }
+    return assets
+
+def write_dist(assets, dist_dir=DIST_DIR):
+    dist_dir.mkdir(parents=True, exist_ok=True)
+    for old_file in dist_dir.iterdir():
+        old_file.unlink()
+
+    manifest = {}
+    for name, asset in assets.items():
+        suffixes = {"identity": "", "gzip": ".gz", "br": ".br"}
+        for encoding, body in asset["encoded"].items():
+            (dist_dir / (asset["path"] + suffixes[encoding])).write_bytes(body)
+        manifest[name] = {
+            "path": asset["path"],
+            "etag": asset["etag"],
+            "immutable": asset["immutable"],
+            "encodings": list(asset["encoded"]),
+        }
+    (dist_dir / "manifest.json").write_text(json.dumps(manifest, indent=4))
+    return manifest
+
+def main():
+    source_size = sum((TEMPLATES_DIR / name).stat().st_size for name in SOURCES)
+    assets = build(lambda name: (TEMPLATES_DIR / name).read_text())
+    write_dist(assets)
+
+    print(f"{'asset':>32} {'bytes':>7} {'gzip':>7} {'br':>7}")
+    for name, asset in assets.items():
+        sizes = {encoding: len(body) for encoding, body in asset["encoded"].items()}
+        print(f"{asset['path']:>32} {sizes['identity']:>7} {sizes['gzip']:>7} {sizes.get('br', '-'):>7}")
+    print(f"[ASSETS] {source_size} source bytes, wrote {DIST_DIR}")
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,146 @@
 import websockets
+import collections
 import json
 import asyncio
+import time
+
+from . import metrics
+
+WEBSOCKET_MESSAGES = metrics.counter("lucy_websocket_messages_total", "Websocket messages exchanged with the server")
+WEBSOCKET_RTT_SECONDS = metrics.histogram("lucy_websocket_rtt_seconds", "Websocket ping/pong round trip time")
+SEND_QUEUE_DEPTH = metrics.gauge("lucy_websocket_send_queue_depth", "Messages waiting to be sent, by priority")
+SEND_QUEUE_DROPPED = metrics.counter("lucy_websocket_send_queue_dropped_total", "Outbound messages dropped, by priority and reason")
+SEND_QUEUE_SECONDS = metrics.histogram("lucy_websocket_send_queue_seconds", "Time from queueing a message to sending it, by priority")
+
+# lower goes first
+PRIORITIES = ("control", "tool")
+POLICIES = ("block", "drop_oldest", "drop_newest")
+
+class SendQueue:
+    """
+    Outbound messages, one FIFO per priority, each holding at most
+    max_messages. What happens to a message for a full priority is up to
+    its policy: "block" waits up to block_timeout for room and then drops
+    it, "drop_oldest" drops the oldest queued one instead, "drop_newest"
+    drops it right away. Messages that waited longer than their priority's
+    max_age_seconds are dropped instead of sent, so replaying a backlog
+    after a reconnect doesn't deliver stale triggers.
+    """
+    def __init__(self, max_messages=256, block_timeout=1.0, policies=None, max_age_seconds=None):
+        self.max_messages = max_messages
+        self.block_timeout = block_timeout
+        policies, max_age_seconds = dict(policies or {}), dict(max_age_seconds or {})
+        # config files written by older versions still list a "bulk" priority
+        for priority in set(policies) | set(max_age_seconds):
+            if priority not in PRIORITIES:
+                print(f"[WebSocket] Ignoring send queue settings for unknown priority '{priority}'")
+                policies.pop(priority, None)
+                max_age_seconds.pop(priority, None)
+        self.policies = {"control": "block", "tool": "drop_oldest", **policies}
+        self.max_age = {"control": 15, "tool": 60, **max_age_seconds}
+        for priority, policy in self.policies.items():
+            if policy not in POLICIES:
+                raise ValueError(f"Invalid send queue policy {priority}: {policy}")
+
+        self.queues = {priority: collections.deque() for priority in PRIORITIES}
+        self.not_empty = asyncio.Event()
+        self.space = asyncio.Event()
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def _drop(self, priority, reason):
+        SEND_QUEUE_DROPPED.inc(priority=priority, reason=reason)
+
+    def _update_depth(self, priority):
+        SEND_QUEUE_DEPTH.set(len(self.queues[priority]), priority=priority)
+
+    async def put(self, priority, data):
+        """Returns whether the message was queued."""
+        queue = self.queues[priority]
+        policy = self.policies[priority]
+        if len(queue) >= self.max_messages:
+            if policy == "drop_newest":
+                self._drop(priority, "full")
+                return False
+            if policy == "drop_oldest":
+                queue.popleft()
+                self._drop(priority, "full")
+            else:
+                deadline = time.monotonic() + self.block_timeout
+                while len(queue) >= self.max_messages:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._drop(priority, "timeout")
+                        return False
+                    self.space.clear()
+                    try:
+                        await asyncio.wait_for(self.space.wait(), remaining)
+                    except asyncio.TimeoutError:
+                        pass
+
+        queue.append((priority, time.monotonic(), data))
+        self._update_depth(priority)
+        self.not_empty.set()
+        return True
+
+    def pop(self):
+        """The next message to send as (priority, queued_time, data), or None."""
+        now = time.monotonic()
+        for priority, queue in self.queues.items():
+            while queue:
+                item = queue.popleft()
+                self._update_depth(priority)
+                self.space.set()
+                if now - item[1] > self.max_age[priority]:
+                    self._drop(priority, "expired")
+                    continue
+                return item
+        self.not_empty.clear()
+        return None
+
+    def push_front(self, item):
+        # a message whose send failed goes out first after the reconnect
+        self.queues[item[0]].appendleft(item)
+        self._update_depth(item[0])
+        self.not_empty.set()
 
 class LucyWebSocketClient:
-    def __init__(self, url, on_reconnect, on_disconnect, on_message):
+    """
+    Keeps a connection to the server open, reconnecting as needed. Every
+    outbound message goes through one SendQueue and one writer task, so
+    sends never race each other, control messages overtake tool ones, and
+    whatever is queued while disconnected goes out in order once the
+    connection is back.
+    """
+    def __init__(self, url, on_reconnect, on_disconnect, on_message, ping_interval=10, send_queue=None):
         self.url = url
+        self.ping_interval = ping_interval
         self.close_websocket = False
         self.is_closed = False
 
+        self.websocket = None
+        # send_queue is the "send_queue" config section, see SendQueue
+        self.send_queue = SendQueue(**(send_queue or {}))
+        self.connected = asyncio.Event()
+        self.writer_task = None
+
         self.on_reconnect = on_reconnect
         self.on_disconnect = on_disconnect
         self.on_message = on_message
 
     async def connect(self):
         asyncio.create_task(self._internal_loop())
+        self.writer_task = asyncio.create_task(self._write_loop())
 
     async def _internal_loop(self):
         is_first_disconnect = True
         self.close_websocket = False
 
-        self.websocket = None
-
         url = f'{self.url}/v1/ws/meewhee'
 
         async for websocket in websockets.connect(url):
+            rtt_task = None
             try:
                 if self.close_websocket:
                     break
@@ -32,6 +149,9 @@ class LucyWebSocketClient:
                 await websocket.recv()
 
                 self.websocket = websocket
+                # the backlog goes out before anything on_reconnect sends
+                self.connected.set()
+                rtt_task = asyncio.create_task(self._measure_rtt(websocket))
 
                 await self.on_reconnect()
 
@@ -39,6 +159,7 @@ class LucyWebSocketClient:
                     try:
                         message = await asyncio.wait_for(websocket.recv(), timeout=0.1)
                         message = json.loads(message)
+                        WEBSOCKET_MESSAGES.inc(direction="received", type=message.get("type"))
                         await self.on_message(message)
                     except asyncio.TimeoutError:
                         if self.close_websocket:
@@ -46,36 +167,93 @@ class LucyWebSocketClient:
             except Exception as e:
                 print(f"[WebSocket] Connection error: {e}")
                 self.websocket = None
+                self.connected.clear()
                 if is_first_disconnect:
                     await self.on_disconnect()
                     is_first_disconnect = False
                 if self.close_websocket:
                     print("[WebSocket] Closing connection as requested.")
                     break
+            finally:
+                if rtt_task:
+                    rtt_task.cancel()
 
+        self.websocket = None
+        self.connected.clear()
         self.is_closed = True
 
+    async def _measure_rtt(self, websocket):
+        try:
+            while True:
+                await asyncio.sleep(self.ping_interval)
+                start_time = time.perf_counter()
+                pong_waiter = await websocket.ping()
+                await pong_waiter
+                WEBSOCKET_RTT_SECONDS.observe(time.perf_counter() - start_time)
+        except websockets.ConnectionClosed:
+            pass
+
+    async def _write_loop(self):
+        while True:
+            await self.connected.wait()
+            await self.send_queue.not_empty.wait()
+            websocket = self.websocket
+            if websocket is None:
+                continue
+
+            # Everything queued goes out in this pass, back to back. The
+            # server reads one JSON message per frame, so frames aren't merged.
+            while (item := self.send_queue.pop()) is not None:
+                priority, queued_time, data = item
+                try:
+                    payload = json.dumps(data)
+                except (TypeError, ValueError) as e:
+                    print(f"[WebSocket] Dropping a message that isn't JSON: {e}")
+                    self.send_queue._drop(priority, "invalid")
+                    continue
+                try:
+                    await websocket.send(payload)
+                except Exception as e:
+                    # not known to have arrived, so it is sent again
+                    print(f"[WebSocket] Send failed, keeping the message for the next connection: {e}")
+                    self.send_queue.push_front(item)
+                    if self.websocket is websocket:
+                        self.connected.clear()
+                    break
+                WEBSOCKET_MESSAGES.inc(direction="sent", type=data["type"])
+                SEND_QUEUE_SECONDS.observe(time.monotonic() - queued_time, priority=priority)
+
+    async def send(self, data, priority="tool"):
+        """
+        Queues a message for the server, waiting only as the priority's
+        policy says. Returns whether it was queued.
+        """
+        return await self.send_queue.put(priority, data)
+
     async def close(self):
         self.close_websocket = True
         while not self.is_closed:
             await asyncio.sleep(0.1)
+        if self.writer_task is not None:
+            self.writer_task.cancel()
 
-    async def send_request(self, request):
-        if self.websocket is None:
-            return
+    async def send_request(self, request, trace_id=None):
         data = {
             "type": "request",
             "message": request
         }
-        await self.websocket.send(json.dumps(data))
+        if trace_id is not None:
+            data["trace_id"] = trace_id
+        return await self.send(data, priority="control")
 
-    async def send_wake_word_trigger(self):
-        if self.websocket is None:
-            return
+    async def send_wake_word_trigger(self, wake_word=None, trace_id=None):
         data = {
-            "type": "wake_word_detected"
+            "type": "wake_word_detected",
+            "wake_word": wake_word
         }
-        await self.websocket.send(json.dumps(data))
+        if trace_id is not None:
+            data["trace_id"] = trace_id
+        return await self.send(data, priority="control")
 
     async def send_tool_message(self, tool_name, data):
         data = {
@@ -83,4 +261,4 @@ class LucyWebSocketClient:
             "tool": tool_name,
             "data": data
         }
-        await self.websocket.send(json.dumps(data))
\ No newline at end of file
+        return await self.send(data, priority="tool")
\ No newline at end of file
@@ -1,4 +1,8 @@
+import asyncio
+import atexit
 import os
+import threading
+from types import MappingProxyType
 import yaml
 from pathlib import Path
 
@@ -8,47 +12,200 @@ DEFAULT_CONFIG_SCHEMA = {
     "quiet_mode": False,
     "type_mode": False,
     "microphones": [],
+    "microphone_mode": "select",
     "webview_type": "chrome",
+    "echo_cancellation": True,
+    "mixer_process": False,
+    # client tool modules to load, by entry point name
+    "tools": ["spotify", "clock"],
+    "speculative_transcription": True,
+    # gap in speech that starts a speculative transcription
+    "speculative_pause_ms": 250,
+    "wake_words": [
+        {"model": "alexa", "threshold": 0.2, "window": 5},
+    ],
+    "vad_preroll_ms": 300,
+    # traces.jsonl is rotated to traces.jsonl.1 past this size
+    "trace_file_max_mb": 5,
+    "send_queue": {
+        "max_messages": 256,
+        "block_timeout": 1.0,
+        # "block", "drop_oldest" or "drop_newest" when a priority is full
+        "policies": {"control": "block", "tool": "drop_oldest"},
+        # queued messages older than this are dropped, not sent late
+        "max_age_seconds": {"control": 15, "tool": 60},
+    },
+    "vad_gate": {
+        "enabled": True,
+        "open_db": 6.0,
+        "close_db": 3.0,
+        "hangover_ms": 300,
+        "min_level_db": -60.0,
+        "warmup_chunks": 2,
+    },
 }
 CONFIG_DIR = Path(os.path.expanduser("~/lucyclient"))
 CONFIG_FILE = CONFIG_DIR / "config.yaml"
+METRICS_FILE = CONFIG_DIR / "metrics.json"
+TRACES_FILE = CONFIG_DIR / "traces.jsonl"
+
+# seconds to wait for more changes before writing the file
+WRITE_DELAY = 0.5
 
+# _APP_CONFIG is an immutable snapshot that is replaced, never modified, so
+# readers never need the lock. Writers hold it while building the next one.
 _APP_CONFIG = None
+_CONFIG_LOCK = threading.RLock()
+_SUBSCRIBERS = []
+_WRITE_TIMER = None
+_FILE_MTIME = None
 
-def save_empty_config():
+def _freeze(value):
+    if isinstance(value, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+def _thaw(value):
+    if isinstance(value, MappingProxyType):
+        return {k: _thaw(v) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return [_thaw(v) for v in value]
+    return value
+
+def _write_file(config):
+    global _FILE_MTIME
     CONFIG_DIR.mkdir(parents=True, exist_ok=True)
-    with open(CONFIG_FILE, 'w') as f:
-        yaml.dump(DEFAULT_CONFIG_SCHEMA, f, indent=4, sort_keys=False)
+    tmp_file = CONFIG_FILE.with_suffix(".yaml.tmp")
+    with open(tmp_file, 'w') as f:
+        yaml.dump(_thaw(config), f, indent=4, sort_keys=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, CONFIG_FILE)
+    # don't hot reload our own write
+    _FILE_MTIME = CONFIG_FILE.stat().st_mtime_ns
 
-def load_config():
-    global _APP_CONFIG
+def save_empty_config():
+    _write_file(DEFAULT_CONFIG_SCHEMA)
+
+def _merge_defaults(defaults, config):
+    # sections are merged key by key, so a file that sets only part of one
+    # keeps the defaults for the rest
+    merged = dict(defaults)
+    for key, value in config.items():
+        if isinstance(value, dict) and isinstance(defaults.get(key), dict):
+            value = _merge_defaults(defaults[key], value)
+        merged[key] = value
+    return merged
+
+def _read_file():
+    global _FILE_MTIME
 
     if not CONFIG_FILE.exists():
         save_empty_config() 
 
     try:
+        _FILE_MTIME = CONFIG_FILE.stat().st_mtime_ns
         with open(CONFIG_FILE, 'r') as f:
             config = yaml.safe_load(f)
         if config is None:
             save_empty_config()
             config = DEFAULT_CONFIG_SCHEMA.copy() 
 
-        _APP_CONFIG = config
-        return _APP_CONFIG
+        # config files written by older versions lack newer keys
+        return _merge_defaults(DEFAULT_CONFIG_SCHEMA, config)
     except yaml.YAMLError as e:
         raise ValueError(f"Error parsing YAML configuration file '{CONFIG_FILE}': {e}")
     except Exception as e:
         raise RuntimeError(f"An unexpected error occurred while loading config: {e}")
 
-def get_config():
+def _replace_config(config):
     global _APP_CONFIG
-    if _APP_CONFIG is None:
-        _APP_CONFIG = load_config()
+    with _CONFIG_LOCK:
+        old_config = _APP_CONFIG or {}
+        _APP_CONFIG = _freeze(config)
+        return [key for key in _APP_CONFIG if old_config.get(key) != _APP_CONFIG[key]]
+
+def _notify(changed):
+    # called without the lock held, subscribers always get the latest value
+    for key, callback in list(_SUBSCRIBERS):
+        if key in changed:
+            try:
+                callback(_APP_CONFIG[key])
+            except Exception as e:
+                print(f"[CONFIG] Subscriber for '{key}' failed: {e}")
+
+def load_config():
+    changed = _replace_config(_read_file())
+    _notify(changed)
     return _APP_CONFIG
 
+def get_config():
+    """Returns a read-only snapshot, use update_config() to change it."""
+    config = _APP_CONFIG
+    if config is None:
+        config = load_config()
+    return config
+
+def update_config(**changes):
+    with _CONFIG_LOCK:
+        config = _thaw(get_config())
+        config.update(changes)
+        changed = _replace_config(config)
+        _schedule_write()
+    _notify(changed)
+
+def subscribe(key, callback):
+    """
+    Calls callback(value) whenever `key` changes, from whichever thread made
+    the change. It must be quick, e.g. storing the value on an object.
+    """
+    _SUBSCRIBERS.append((key, callback))
+
+def _schedule_write():
+    global _WRITE_TIMER
+    with _CONFIG_LOCK:
+        if _WRITE_TIMER is not None:
+            _WRITE_TIMER.cancel()
+        _WRITE_TIMER = threading.Timer(WRITE_DELAY, write_config)
+        _WRITE_TIMER.daemon = True
+        _WRITE_TIMER.start()
+
 def write_config():
-    with open(CONFIG_FILE, 'w') as f:
-        yaml.dump(_APP_CONFIG, f, indent=4, sort_keys=False)
+    global _WRITE_TIMER
+    with _CONFIG_LOCK:
+        if _WRITE_TIMER is not None:
+            _WRITE_TIMER.cancel()
+            _WRITE_TIMER = None
+        _write_file(get_config())
+
+def flush_config():
+    """Writes a pending change right away, call before exiting."""
+    if _WRITE_TIMER is not None:
+        write_config()
+
+atexit.register(flush_config)
+
+async def watch_config_file(interval=2.0):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            mtime = CONFIG_FILE.stat().st_mtime_ns
+        except OSError:
+            continue
+        if mtime == _FILE_MTIME:
+            continue
+
+        try:
+            config = await asyncio.to_thread(_read_file)
+        except (ValueError, RuntimeError) as e:
+            print(f"[CONFIG] Ignoring edited config file: {e}")
+            continue
+        changed = _replace_config(config)
+        if changed:
+            print(f"[CONFIG] Reloaded {CONFIG_FILE}, changed: {', '.join(changed)}")
+            _notify(changed)
 
 def get_http_url():
     config = get_config()
@@ -66,65 +223,140 @@ def get_ws_url():
 
 
 
-from flask import Flask, request, jsonify
-import threading
-from importlib import resources
+import json
+import math
+from aiohttp import web
+from .metrics import REGISTRY
+from .profiler import PROFILER
+from .tracing import TRACER
+from .web import TEMPLATES, start_site
 
-app = Flask(__name__)
+routes = web.RouteTableDef()
 
-import logging
+@routes.get('/')
+async def index(request):
+    return TEMPLATES.response(request, 'config.html')
+    
+@routes.get('/get_config')
+async def get_config_route(request):
+    return web.json_response(_thaw(get_config()))
 
-# Disable Flask's default logger
-log = logging.getLogger('werkzeug')
-log.setLevel(logging.ERROR)
+def _bad_request(message):
+    return web.json_response({"status": "error", "message": message}, status=400)
 
-# Disable all other Flask logging if needed
-flask_log = logging.getLogger('flask.app')
-flask_log.setLevel(logging.CRITICAL)
+@routes.post('/set_server_address')
+async def set_server_address(request):
+    try:
+        data = await request.json()
+        server_address, is_secure = data['server_address'], data['is_secure']
+    except (json.JSONDecodeError, KeyError, TypeError):
+        return _bad_request("Expected a JSON object with server_address and is_secure")
+    if not isinstance(server_address, str) or not isinstance(is_secure, bool):
+        return _bad_request("server_address must be a string and is_secure a boolean")
+    update_config(url=server_address, is_secure=is_secure)
+    return web.json_response({"status": "success"})
 
-@app.route('/')
-def index():
-    file = resources.files('lucyhubclient.templates') / 'config.html'
-    with open(file, 'r') as f:
-        return f.read()
-    
-@app.route('/get_config')
-def get_config_route():
-    return jsonify(get_config())
-
-@app.route('/set_server_address', methods=['POST'])
-def set_server_address():
-    data = request.json
-    _APP_CONFIG['url'] = data['server_address']
-    _APP_CONFIG['is_secure'] = data['is_secure']
-    write_config()
-    return jsonify({"status": "success"})
-
-@app.route('/set_primary_mic', methods=['POST'])
-def set_primary_mic():
-    data = request.json
-    _APP_CONFIG['microphones'] = [ data['primary_mic'] ]
-    write_config()
-    return jsonify({"status": "success"})
-
-@app.route('/set_typing_mode', methods=['POST'])
-def set_typing_mode():
-    data = request.json
-    _APP_CONFIG['type_mode'] = data['type_mode']
-    write_config()
-    return jsonify({"status": "success"})
-
-@app.route('/set_quiet_mode', methods=['POST'])
-def set_quiet_mode():
-    data = request.json
-    _APP_CONFIG['quiet_mode'] = data['quiet_mode']
-    write_config()
-    return jsonify({"status": "success"})
-
-def run_flask_app():
-    app.run(host='0.0.0.0', port=4812)
-
-def start_flask_server():
-    flask_thread = threading.Thread(target=run_flask_app)
-    flask_thread.daemon = True
-    flask_thread.start()
\ No newline at end of file
+@routes.post('/set_microphones')
+async def set_microphones(request):
+    try:
+        data = await request.json()
+        microphones = data['microphones']
+        microphone_mode = data.get('microphone_mode', get_config()['microphone_mode'])
+    except (json.JSONDecodeError, KeyError, TypeError, AttributeError):
+        return _bad_request("Expected a JSON object with microphones")
+    if not isinstance(microphones, list) or not all(isinstance(mic, str) for mic in microphones):
+        return _bad_request("microphones must be a list of strings")
+    if microphone_mode not in ("select", "beamform"):
+        return _bad_request("microphone_mode must be select or beamform")
+    update_config(microphones=[mic.strip() for mic in microphones if mic.strip()],
+                  microphone_mode=microphone_mode)
+    return web.json_response({"status": "success"})
+
+@routes.post('/set_typing_mode')
+async def set_typing_mode(request):
+    try:
+        data = await request.json()
+        type_mode = data['type_mode']
+    except (json.JSONDecodeError, KeyError, TypeError):
+        return _bad_request("Expected a JSON object with type_mode")
+    if not isinstance(type_mode, bool):
+        return _bad_request("type_mode must be a boolean")
+    update_config(type_mode=type_mode)
+    return web.json_response({"status": "success"})
+
+@routes.post('/set_quiet_mode')
+async def set_quiet_mode(request):
+    try:
+        data = await request.json()
+        quiet_mode = data['quiet_mode']
+    except (json.JSONDecodeError, KeyError, TypeError):
+        return _bad_request("Expected a JSON object with quiet_mode")
+    if not isinstance(quiet_mode, bool):
+        return _bad_request("quiet_mode must be a boolean")
+    update_config(quiet_mode=quiet_mode)
+    return web.json_response({"status": "success"})
+
+@routes.get('/metrics')
+async def metrics_route(request):
+    return web.Response(text=REGISTRY.to_prometheus(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+@routes.get('/metrics.json')
+async def metrics_json_route(request):
+    return web.json_response(REGISTRY.to_dict())
+
+@routes.get('/traces')
+async def traces_page(request):
+    return TEMPLATES.response(request, 'traces.html')
+
+@routes.get('/traces.json')
+async def traces_json_route(request):
+    try:
+        limit = int(request.query.get('limit', 50))
+    except ValueError:
+        return web.json_response({"status": "error", "message": "limit must be an integer"}, status=400)
+    if limit < 0:
+        return web.json_response({"status": "error", "message": "limit must not be negative"}, status=400)
+    # no more than the tracer keeps anyway
+    limit = min(limit, TRACER.recent.maxlen)
+    return web.json_response(TRACER.to_dict(limit=limit))
+
+@routes.post('/profiler/start')
+async def profiler_start(request):
+    try:
+        data = await request.json()
+    except json.JSONDecodeError:
+        data = {}
+    data = data or {}
+    if not isinstance(data, dict):
+        return web.json_response({"status": "error", "message": "Expected a JSON object"}, status=400)
+    try:
+        # below 1 ms the sampler spins and starves the mixer of the GIL
+        interval = max(float(data.get('interval_ms', 5)), 1.0) / 1000
+        max_duration = float(data.get('max_seconds', 300))
+    except (TypeError, ValueError):
+        return web.json_response({"status": "error", "message": "interval_ms and max_seconds must be numbers"}, status=400)
+    if not (math.isfinite(interval) and math.isfinite(max_duration) and max_duration > 0):
+        return web.json_response({"status": "error", "message": "interval_ms and max_seconds must be finite and max_seconds positive"}, status=400)
+    if not PROFILER.start(interval=interval, max_duration=max_duration):
+        return web.json_response({"status": "error", "message": "Profiler is already running"}, status=409)
+    return web.json_response({"status": "success"})
+
+@routes.post('/profiler/stop')
+async def profiler_stop(request):
+    # joins the sampling thread, keep that off the event loop
+    collapsed = await asyncio.to_thread(PROFILER.stop)
+    return web.Response(text=collapsed, content_type='text/plain', headers={
+        "Content-Disposition": "attachment; filename=lucyhub.collapsed"
+    })
+
+@routes.get('/profiler/status')
+async def profiler_status(request):
+    return web.json_response(PROFILER.status())
+
+def create_config_app():
+    app = web.Application()
+    app.add_routes(routes)
+    return app
+
+async def start_config_server():
+    return await start_site(create_config_app(), '0.0.0.0', 4812)
@@ -0,0 +1,151 @@
+import asyncio
+import bisect
+import json
+import os
+import time
+
+# Metric updates are plain dict/list writes with no locking so they are cheap
+# enough for the mixer thread. Every metric is only ever updated from one
+# thread, so the worst a concurrent scrape can see is a half-updated sample.
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+class Metric:
+    TYPE = None
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+
+    def prometheus_lines(self):
+        raise NotImplementedError("Subclasses should implement this method")
+
+    def to_dict(self):
+        return {_format_labels(key) or "value": value for key, value in list(self.values.items())}
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def prometheus_lines(self):
+        for key, value in list(self.values.items()):
+            yield f"{self.name}{_format_labels(key)} {value}"
+
+class Gauge(Metric):
+    TYPE = "gauge"
+
+    def set(self, value, **labels):
+        self.values[_label_key(labels)] = value
+
+    def prometheus_lines(self):
+        for key, value in list(self.values.items()):
+            yield f"{self.name}{_format_labels(key)} {value}"
+
+class Histogram(Metric):
+    TYPE = "histogram"
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        state = self.values.get(key)
+        if state is None:
+            # per-bucket counts (plus +Inf), sum, count
+            state = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            self.values[key] = state
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def prometheus_lines(self):
+        for key, (counts, total, count) in list(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket{_format_labels(key, [('le', bound)])} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(key)} {total}"
+            yield f"{self.name}_count{_format_labels(key)} {count}"
+
+    def to_dict(self):
+        result = {}
+        for key, (counts, total, count) in list(self.values.items()):
+            result[_format_labels(key) or "value"] = {
+                "count": count,
+                "sum": total,
+                "mean": total / count if count else 0,
+                "buckets": dict(zip([str(b) for b in self.buckets + ("+Inf",)], counts)),
+            }
+        return result
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+
+    def _register(self, metric):
+        if metric.name in self.metrics:
+            return self.metrics[metric.name]
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help):
+        return self._register(Counter(name, help))
+
+    def gauge(self, name, help):
+        return self._register(Gauge(name, help))
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help, buckets))
+
+    def to_prometheus(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.TYPE}")
+            lines.extend(metric.prometheus_lines())
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self):
+        return {name: metric.to_dict() for name, metric in list(self.metrics.items())}
+
+    def dump_json(self, path):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({"time": time.time(), "metrics": self.to_dict()}, f, indent=4)
+        os.replace(tmp_path, path)
+
+REGISTRY = MetricsRegistry()
+
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+EVENT_LOOP_LAG = histogram("lucy_event_loop_lag_seconds", "How late the asyncio loop woke up from a sleep")
+
+async def monitor_event_loop_lag(interval=0.25):
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(0.0, time.perf_counter() - start - interval))
+
+async def dump_json_periodically(path, interval=30):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await asyncio.to_thread(REGISTRY.dump_json, path)
+        except OSError as e:
+            print(f"[METRICS] Could not write {path}: {e}")
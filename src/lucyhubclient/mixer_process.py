@@ -0,0 +1,415 @@
+import copy
+import multiprocessing
+import pickle
+import signal
+import struct
+import threading
+import time
+import uuid
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from . import metrics
+from .config import subscribe
+from .sound import SoundManager, ContinuousSound, SpeechSound, PyAudioSink
+
+MIXER_RING_FULL = metrics.counter("lucy_mixer_ring_full_total", "Messages dropped because a mixer process ring was full")
+
+# main process -> mixer
+CALL, AUDIO, STOP = 1, 2, 3
+# mixer -> main process
+CLOCK, OUTPUT, EVENT = 11, 12, 13
+
+class SharedRing:
+    """
+    Single producer, single consumer message ring in shared memory. A
+    message is an 8 byte (kind, length) header and its payload padded to 8
+    bytes, and never wraps around the end, so the reader gets every payload
+    as one aligned numpy view into the ring. The producer only moves the
+    write counter and the consumer only the read counter.
+    """
+    HEADER_BYTES = 32  # write counter, read counter, capacity
+    WRAP = 0
+
+    def __init__(self, name=None, capacity=1 << 23):
+        self.owner = name is None
+        if self.owner:
+            capacity = (capacity + 7) & ~7
+            self.shm = shared_memory.SharedMemory(create=True, size=self.HEADER_BYTES + capacity)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+
+        self.counters = np.ndarray((3,), dtype=np.uint64, buffer=self.shm.buf)
+        if self.owner:
+            self.counters[:] = (0, 0, capacity)
+        self.capacity = int(self.counters[2])
+        self.data = np.ndarray((self.capacity,), dtype=np.uint8, buffer=self.shm.buf, offset=self.HEADER_BYTES)
+
+    def write(self, kind, *parts):
+        """Returns False, having written nothing, if there isn't room."""
+        parts = [np.ascontiguousarray(part).reshape(-1).view(np.uint8) if isinstance(part, np.ndarray)
+                 else np.frombuffer(part, dtype=np.uint8) for part in parts]
+        length = sum(len(part) for part in parts)
+        size = 8 + ((length + 7) & ~7)
+        if size > self.capacity:
+            raise ValueError(f"A {length} byte message doesn't fit in the ring")
+
+        write_pos = int(self.counters[0])
+        free = self.capacity - (write_pos - int(self.counters[1]))
+        offset = write_pos % self.capacity
+        skip = self.capacity - offset if offset + size > self.capacity else 0
+        if skip + size > free:
+            return False
+
+        if skip:
+            struct.pack_into("<II", self.data, offset, self.WRAP, 0)
+            offset = 0
+        struct.pack_into("<II", self.data, offset, kind, length)
+        position = offset + 8
+        for part in parts:
+            self.data[position:position + len(part)] = part
+            position += len(part)
+        # publish only once the payload is in place
+        self.counters[0] = write_pos + skip + size
+        return True
+
+    def messages(self):
+        """
+        Yields (kind, payload) until the ring is empty. The payload is a view
+        into the ring, only valid until the next message is requested.
+        """
+        while True:
+            read_pos = int(self.counters[1])
+            if read_pos == int(self.counters[0]):
+                return
+            offset = read_pos % self.capacity
+            kind, length = struct.unpack_from("<II", self.data, offset)
+            if kind == self.WRAP:
+                self.counters[1] = read_pos + self.capacity - offset
+                continue
+            yield kind, self.data[offset + 8:offset + 8 + length]
+            self.counters[1] = read_pos + 8 + ((length + 7) & ~7)
+
+    def close(self):
+        # the views have to go before the mapping can
+        del self.counters, self.data
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+class RemoteSound:
+    """
+    Stands in for a ContinuousSound, e.g. the SpeechSound, playing in the
+    mixer process. Audio goes over the ring as raw PCM, the stream controls
+    are forwarded and is_speaking is mirrored back.
+    """
+    def __init__(self, manager, sound):
+        self.manager = manager
+        self.uuid = sound.get_id()
+        self.sample_rate = sound.sample_rate
+        self.is_speaking = getattr(sound, "is_speaking", False)
+
+    def get_id(self):
+        return self.uuid
+
+    def add_audio_data(self, audio_data):
+        self.manager._send_audio(self.uuid, audio_data)
+
+    def add_effect(self, effect):
+        self.manager._call(self.uuid, "add_effect", effect)
+
+    def start_stream(self):
+        self.manager._call(self.uuid, "start_stream")
+
+    def interrupt(self):
+        self.manager._call(self.uuid, "interrupt")
+
+    def end_stream(self):
+        self.manager._call(self.uuid, "end_stream")
+
+class RemoteSoundManager:
+    """
+    SoundManager whose mixing and audio output run in a separate process,
+    so nothing in this one can hold the GIL while a block is due. It takes
+    the same calls. Commands and TTS audio go to the mixer over one
+    SharedRing; clock updates, output blocks, sound callbacks and the
+    mixer's metrics come back over another and are handled on the
+    MixerEvents thread here.
+
+    add_sound returns a RemoteSound for continuous sounds, which is what
+    must be fed and controlled from then on. Callbacks of a sound
+    (attributes ending in _callback) run here, not in the mixer.
+    """
+    CHUNK_SIZE = 1024
+    SAMPLE_RATE = 48000
+    BUS_PRIORITIES = SoundManager.BUS_PRIORITIES
+    frame_at = SoundManager.frame_at
+
+    def __init__(self, sink_factory=PyAudioSink, sink_kwargs=None, ring_bytes=1 << 23, **manager_kwargs):
+        self.to_mixer = SharedRing(capacity=ring_bytes)
+        self.from_mixer = SharedRing(capacity=ring_bytes)
+        self.send_lock = threading.Lock()
+
+        self.callbacks = {}
+        self.remote_sounds = {}
+        self.output_listeners = []
+        self.clock_reference = (0, time.monotonic())
+        self.should_stop = False
+
+        # spawn, not fork: the mixer gets its own PortAudio and no copies of
+        # this process's threads
+        context = multiprocessing.get_context("spawn")
+        self.process = context.Process(target=_run_mixer, name="LucyMixer", daemon=True,
+                                       args=(self.to_mixer.name, self.from_mixer.name, sink_factory, sink_kwargs or {}, manager_kwargs))
+        self.process.start()
+
+        subscribe("quiet_mode", self._set_quiet_mode)
+
+        self.thread = threading.Thread(target=self._event_thread, name="MixerEvents", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.should_stop = True
+        self._send(STOP)
+        self.process.join(timeout=2)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.thread.join()
+        self.to_mixer.close()
+        self.from_mixer.close()
+
+    def close(self):
+        self.stop()
+
+    def _send(self, kind, *parts, timeout=0.1):
+        # only blocks when the mixer has stopped reading
+        deadline = time.monotonic() + timeout
+        with self.send_lock:
+            while not self.to_mixer.write(kind, *parts):
+                if time.monotonic() > deadline or not self.process.is_alive():
+                    MIXER_RING_FULL.inc(direction="to_mixer")
+                    print("[SOUND] Mixer process isn't reading, dropped a message")
+                    return False
+                time.sleep(0.001)
+        return True
+
+    def _call(self, target, name, *args):
+        # target is "manager", "server" or a sound id
+        self._send(CALL, pickle.dumps((target, name, args), protocol=5))
+
+    def _send_audio(self, sound_id, audio_data):
+        audio_data = np.asarray(audio_data, dtype=np.int32)
+        channels = 1 if audio_data.ndim == 1 else audio_data.shape[1]
+        header = uuid.UUID(sound_id).bytes + struct.pack("<dii", time.monotonic(), channels, 0)
+        self._send(AUDIO, header, audio_data)
+
+    def add_sound(self, sound, start_frame=None, bus="effect"):
+        if bus not in self.BUS_PRIORITIES:
+            raise ValueError(f"Unknown bus '{bus}'")
+
+        callbacks = {name: value for name, value in vars(sound).items() if name.endswith("_callback") and value is not None}
+        if callbacks:
+            self.callbacks[sound.get_id()] = callbacks
+            sound = copy.copy(sound)
+            for name in callbacks:
+                setattr(sound, name, None)
+        self._call("server", "add_sound", sound, start_frame, bus, list(callbacks))
+
+        if isinstance(sound, ContinuousSound):
+            remote_sound = RemoteSound(self, sound)
+            self.remote_sounds[sound.get_id()] = remote_sound
+            return remote_sound
+        return sound
+
+    def remove_sound(self, sound_id):
+        self._call("manager", "remove_sound", sound_id)
+
+    def stop_sound(self, sound_id, stop_frame=None):
+        self._call("manager", "stop_sound", sound_id, stop_frame)
+
+    def add_output_listener(self, listener):
+        # listener(chunk, play_time) is called on the MixerEvents thread
+        self.output_listeners.append(listener)
+        self._call("server", "send_output")
+
+    def add_effect_to_sound(self, sound_id, effect):
+        self._call("manager", "add_effect_to_sound", sound_id, effect)
+
+    def set_volume(self, volume, ramp_seconds=0.05):
+        if not (0 <= volume <= 1):
+            raise ValueError("Volume must be between 0 and 1")
+        self._call("manager", "set_volume", volume, ramp_seconds)
+
+    def set_sound_gain(self, sound_id, gain, ramp_seconds=0.05):
+        self._call("manager", "set_sound_gain", sound_id, gain, ramp_seconds)
+
+    def set_bus_gain(self, bus, gain, ramp_seconds=0.05):
+        self._call("manager", "set_bus_gain", bus, gain, ramp_seconds)
+
+    def hold_duck(self, bus, held=True):
+        self._call("manager", "hold_duck", bus, held)
+
+    def _set_quiet_mode(self, quiet_mode):
+        self._call("manager", "_set_quiet_mode", quiet_mode)
+
+    def _event_thread(self):
+        idle_sleep = self.CHUNK_SIZE / self.SAMPLE_RATE / 4
+        while not self.should_stop:
+            handled = False
+            for kind, payload in self.from_mixer.messages():
+                handled = True
+                if kind == CLOCK:
+                    self.clock_reference = struct.unpack_from("<qd", payload)
+                elif kind == OUTPUT:
+                    _, play_time = struct.unpack_from("<qd", payload)
+                    # listeners may keep the block, the ring slot won't last
+                    chunk = payload[16:].view(np.int32).reshape(-1, 2).copy()
+                    for listener in self.output_listeners:
+                        listener(chunk, play_time)
+                elif kind == EVENT:
+                    self._handle_event(*pickle.loads(payload))
+
+            if not handled:
+                if not self.process.is_alive():
+                    if not self.should_stop:
+                        print(f"[SOUND] Mixer process exited with code {self.process.exitcode}")
+                    return
+                time.sleep(idle_sleep)
+
+    def _handle_event(self, event, *args):
+        if event == "callback":
+            sound_id, name, callback_args = args
+            callback = self.callbacks.get(sound_id, {}).get(name)
+            if callback is not None:
+                callback(*callback_args)
+        elif event == "state":
+            sound_id, is_speaking = args
+            if sound_id in self.remote_sounds:
+                self.remote_sounds[sound_id].is_speaking = is_speaking
+        elif event == "removed":
+            self.callbacks.pop(args[0], None)
+            self.remote_sounds.pop(args[0], None)
+        elif event == "metrics":
+            for name, values in args[0].items():
+                metric = metrics.REGISTRY.metrics.get(name)
+                if metric is not None:
+                    # merged, this process counts some labels itself
+                    metric.values.update(values)
+
+class _MixerServer:
+    """The mixer process's side: applies what arrives, then plays a block."""
+    METRICS_INTERVAL = 1.0
+
+    def __init__(self, manager, inbox, outbox):
+        self.manager = manager
+        self.inbox = inbox
+        self.outbox = outbox
+        # sounds added with callbacks or fed with audio, by id
+        self.sounds = {}
+        self.is_speaking = {}
+        self.sending_output = False
+        self.next_metrics_time = 0
+
+    def run(self):
+        while not self.manager.should_stop:
+            self._drain()
+            if self.manager.should_stop:
+                break
+            self.manager.play_block()
+            self._after_block()
+
+    def _post(self, kind, *parts):
+        # never wait here, the next block is due
+        if not self.outbox.write(kind, *parts):
+            MIXER_RING_FULL.inc(direction="from_mixer")
+
+    def _post_event(self, *event):
+        self._post(EVENT, pickle.dumps(event, protocol=5))
+
+    def _drain(self):
+        for kind, payload in self.inbox.messages():
+            if kind == STOP:
+                self.manager.should_stop = True
+                return
+            try:
+                if kind == AUDIO:
+                    self._receive_audio(payload)
+                elif kind == CALL:
+                    target, name, args = pickle.loads(payload)
+                    if target == "server":
+                        obj = self
+                    elif target == "manager":
+                        obj = self.manager
+                    else:
+                        obj = self.sounds[target]
+                    getattr(obj, name)(*args)
+            except Exception as e:
+                print(f"[SOUND] Mixer process failed to apply a message: {e!r}")
+
+    def _receive_audio(self, payload):
+        sound = self.sounds.get(str(uuid.UUID(bytes=bytes(payload[:16]))))
+        if sound is None:
+            return
+        arrival_time, channels, _ = struct.unpack_from("<dii", payload, 16)
+        audio_data = payload[32:].view(np.int32)
+        if channels > 1:
+            audio_data = audio_data.reshape(-1, channels)
+        # the sound keeps it, the ring slot won't last
+        audio_data = audio_data.copy()
+        if isinstance(sound, SpeechSound):
+            sound.add_audio_data(audio_data, arrival_time)
+        else:
+            sound.add_audio_data(audio_data)
+
+    def add_sound(self, sound, start_frame, bus, callbacks):
+        sound_id = sound.get_id()
+        for name in callbacks:
+            setattr(sound, name, lambda *args, name=name: self._post_event("callback", sound_id, name, args))
+        if callbacks or isinstance(sound, ContinuousSound):
+            self.sounds[sound_id] = sound
+        self.manager.add_sound(sound, start_frame, bus)
+
+    def send_output(self):
+        if not self.sending_output:
+            self.sending_output = True
+            self.manager.add_output_listener(self._post_output)
+
+    def _post_output(self, chunk, play_time):
+        self._post(OUTPUT, struct.pack("<qd", self.manager.frame, play_time), chunk)
+
+    def _after_block(self):
+        self._post(CLOCK, struct.pack("<qd", *self.manager.clock_reference))
+
+        # commands are applied at the start of a block, so anything not in
+        # manager.sounds by now has finished, was removed or never fit
+        for sound_id in [sound_id for sound_id in self.sounds if sound_id not in self.manager.sounds]:
+            del self.sounds[sound_id]
+            self.is_speaking.pop(sound_id, None)
+            self._post_event("removed", sound_id)
+
+        for sound_id, sound in self.sounds.items():
+            is_speaking = getattr(sound, "is_speaking", None)
+            if is_speaking is not None and is_speaking != self.is_speaking.get(sound_id):
+                self.is_speaking[sound_id] = is_speaking
+                self._post_event("state", sound_id, is_speaking)
+
+        now = time.monotonic()
+        if now >= self.next_metrics_time:
+            self.next_metrics_time = now + self.METRICS_INTERVAL
+            self._post_event("metrics", {name: metric.values for name, metric in metrics.REGISTRY.metrics.items() if metric.values})
+
+def _run_mixer(inbox_name, outbox_name, sink_factory, sink_kwargs, manager_kwargs):
+    # Ctrl+C is for the main process, which stops us in its own time
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    inbox = SharedRing(inbox_name)
+    outbox = SharedRing(outbox_name)
+    manager = SoundManager(sink=sink_factory(**sink_kwargs), start_thread=False, **manager_kwargs)
+    try:
+        _MixerServer(manager, inbox, outbox).run()
+    finally:
+        manager.sink.close()
+        inbox.close()
+        outbox.close()
@@ -0,0 +1,82 @@
+import collections
+import os
+import sys
+import threading
+import time
+
+class SamplingProfiler:
+    """
+    Periodically samples the stack of every Python thread and aggregates them
+    as collapsed stacks ("thread;outer;...;inner count"), the input format of
+    flamegraph.pl and speedscope. Nothing runs while the profiler is stopped.
+    """
+    def __init__(self):
+        self.thread = None
+        self.stop_event = threading.Event()
+
+        self.samples = collections.Counter()
+        self.sample_count = 0
+        self.interval = 0.005
+        self.started_at = None
+        self.stopped_at = None
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, interval=0.005, max_duration=300):
+        if self.is_running():
+            return False
+
+        self.samples = collections.Counter()
+        self.sample_count = 0
+        self.interval = interval
+        self.max_duration = max_duration
+        self.started_at = time.monotonic()
+        self.stopped_at = None
+
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._sampling_thread, name="SamplingProfiler", daemon=True)
+        self.thread.start()
+        return True
+
+    def stop(self):
+        if self.is_running():
+            self.stop_event.set()
+            self.thread.join()
+        return self.collapsed()
+
+    def status(self):
+        end = self.stopped_at if self.stopped_at is not None else time.monotonic()
+        return {
+            "running": self.is_running(),
+            "interval": self.interval,
+            "samples": self.sample_count,
+            "duration": end - self.started_at if self.started_at is not None else 0,
+        }
+
+    def collapsed(self):
+        return "\n".join(f"{stack} {count}" for stack, count in self.samples.most_common()) + "\n"
+
+    def _sampling_thread(self):
+        own_id = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            thread_names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(thread_names.get(thread_id, str(thread_id)))
+                self.samples[";".join(reversed(stack))] += 1
+            self.sample_count += 1
+
+            if time.monotonic() - self.started_at > self.max_duration:
+                print(f"[PROFILER] Stopping after {self.max_duration} seconds")
+                break
+
+        self.stopped_at = time.monotonic()
+
+PROFILER = SamplingProfiler()
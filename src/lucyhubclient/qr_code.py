@@ -0,0 +1,75 @@
+import asyncio
+import hashlib
+import os
+import socket
+
+from .config import CONFIG_DIR
+
+QR_CACHE_DIR = CONFIG_DIR / "qr"
+
+def get_local_ip():
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        # Doesn't need to be reachable, just forces routing table use
+        s.connect(("8.8.8.8", 80))
+        return s.getsockname()[0]
+    finally:
+        s.close()
+
+class ConfigQRCode:
+    """
+    PNG of a QR code pointing at the config UI. It is only re-rendered when
+    the hub's address changes, and renders are cached on disk by ip:port so
+    moving back to a known network doesn't render again either.
+    """
+    def __init__(self, port=4812, cache_dir=QR_CACHE_DIR):
+        self.port = port
+        self.cache_dir = cache_dir
+        self.ip_port = None
+        self.png = None
+        self.version = None
+
+    def _render(self, url):
+        import qrcode
+        from io import BytesIO
+
+        buffer = BytesIO()
+        qrcode.make(url).save(buffer, format="PNG")
+        return buffer.getvalue()
+
+    def _refresh(self):
+        try:
+            ip_port = f"{get_local_ip()}:{self.port}"
+        except OSError:
+            # no route, e.g. while the network is down
+            return False
+        if ip_port == self.ip_port:
+            return False
+
+        cache_file = self.cache_dir / f"{ip_port.replace(':', '_')}.png"
+        if cache_file.exists():
+            png = cache_file.read_bytes()
+        else:
+            png = self._render(f"http://{ip_port}")
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            tmp_file = cache_file.with_suffix(".png.tmp")
+            tmp_file.write_bytes(png)
+            os.replace(tmp_file, cache_file)
+
+        self.png = png
+        self.version = hashlib.sha1(png).hexdigest()[:12]
+        self.ip_port = ip_port
+        return True
+
+    async def refresh(self):
+        """Returns True if the address changed."""
+        return await asyncio.to_thread(self._refresh)
+
+    async def watch(self, on_change, interval=10):
+        # looking up the route sends no packets, polling it is cheap and
+        # catches DHCP renewals, Wi-Fi roaming and cable changes alike
+        while True:
+            await asyncio.sleep(interval)
+            if await self.refresh():
+                print(f"[NETWORK] Address changed to {self.ip_port}")
+                await on_change(self)
@@ -1,16 +1,32 @@
 import os
-import websockets
 import uuid
 import asyncio
 import json
 import time
 
+from aiohttp import web, WSMsgType
+
+from .web import TEMPLATES, start_site
+from . import metrics
+
+KIOSK_FIRST_PAINT_SECONDS = metrics.histogram("lucy_kiosk_first_paint_seconds", "First contentful paint of the kiosk UI, by navigation type")
+
 IS_MACOS = (os.uname().sysname == 'Darwin')
 
 class SocketWebView:
+    """
+    Serves the kiosk UI and the websocket it connects back on (/ws) from one
+    server on localhost:4814, running on the main event loop.
+    """
     def __init__(self):
         self.client = None
         self.responses = {}
+        self.runner = None
+        self.qr_code = None
+
+        # mirrored from LucyHub's flags, flag_event is replaced on every change
+        self.flags = {}
+        self.flag_event = asyncio.Event()
 
     def open(self, chrome_path, dev=False):
         if not IS_MACOS:
@@ -26,26 +42,70 @@ class SocketWebView:
         while self.client is None:
             await asyncio.sleep(0.1)
 
-    async def _websocket_handler(self, websocket, path):
+    async def _websocket_handler(self, request):
+        websocket = web.WebSocketResponse()
+        await websocket.prepare(request)
+
         self.client = websocket
+        # a new page, with an empty iframe
+        self._reset_flags()
+        if self.qr_code is not None:
+            # a reloaded page starts out without it
+            asyncio.create_task(self.update_ip_qr(self.qr_code))
         try:
             async for message in websocket:
-                import json
-                data = json.loads(message)
+                if message.type != WSMsgType.TEXT:
+                    continue
+                data = json.loads(message.data)
                 if 'uuid' in data:
                     self.responses[data['uuid']] = data["result"]
-        except:
-            self.client = None
+                elif data.get('type') == 'flag':
+                    self.flags[data['flag']] = data['value']
+                    self._flags_changed()
+                elif data.get('type') == 'flags_reset':
+                    self._reset_flags()
+                elif data.get('type') == 'paint':
+                    KIOSK_FIRST_PAINT_SECONDS.observe(data['first_contentful_paint'], navigation=data['navigation'])
+                    print(f"[WebView] First paint after {data['navigation']} in {data['first_contentful_paint'] * 1000:.0f} ms ({data['transfer_size']} bytes)")
+        finally:
+            if self.client is websocket:
+                self.client = None
+        return websocket
+
+    async def _index(self, request):
+        return TEMPLATES.response(request, 'index.html')
+
+    async def _qr_png(self, request):
+        if self.qr_code is None or self.qr_code.png is None:
+            raise web.HTTPNotFound()
+        # the URL carries the version, so a new address means a new URL
+        return web.Response(body=self.qr_code.png, content_type='image/png', headers={
+            "Cache-Control": "public, max-age=31536000, immutable"
+        })
+
+    async def _asset(self, request):
+        return TEMPLATES.response(request, request.match_info['path'])
+
+    def create_app(self):
+        app = web.Application()
+        app.router.add_get('/', self._index)
+        app.router.add_get('/ws', self._websocket_handler)
+        app.router.add_get('/qr.png', self._qr_png)
+        app.router.add_get('/{path}', self._asset)
+        return app
 
     async def start(self):
-        self.server = await websockets.serve(self._websocket_handler, "localhost", 4813)
+        self.runner = await start_site(self.create_app(), "127.0.0.1", 4814)
 
     async def set_state(self, state):
         js = f"LucyHub.setState('{state}');"
         await self.run_javascript(js, forget=True)
 
-    async def update_ip_qr(self, ip_port, qr):
-        await self.run_javascript(f"LucyHub.updateIPAndQR('{ip_port}', '{qr}');", forget=True)
+    async def update_ip_qr(self, qr_code):
+        self.qr_code = qr_code
+        if qr_code.png is None:
+            return
+        await self.run_javascript(f"LucyHub.updateIPAndQR('{qr_code.ip_port}', '/qr.png?v={qr_code.version}');", forget=True)
 
     async def set_connected(self, connected: bool):
         js = f"LucyHub.setConnected({str(connected).lower()});"
@@ -60,6 +120,34 @@ class SocketWebView:
         js = f"LucyHub.setVolume({volume});"
         await self.run_javascript(js, forget=True)
 
+    def _flags_changed(self):
+        self.flag_event.set()
+        self.flag_event = asyncio.Event()
+
+    def _reset_flags(self):
+        self.flags = {}
+        self._flags_changed()
+
+    def forget_flag(self, flag):
+        self.flags.pop(flag, None)
+        self._flags_changed()
+
+    def get_flag(self, flag):
+        return self.flags.get(flag, False)
+
+    async def wait_for_flag(self, flag, expected_value=True, timeout=5):
+        """Waits for the UI to report a flag, returns whether it did in time."""
+        deadline = time.monotonic() + timeout
+        while self.get_flag(flag) != expected_value:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self.client is None:
+                return False
+            try:
+                await asyncio.wait_for(self.flag_event.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
     async def wait_for_var(self, var_name, expected_value, timeout=5):
         start_time = time.time()
         while True:
@@ -78,7 +166,7 @@ class SocketWebView:
         if self.client is None:
             return
         this_uuid = str(uuid.uuid4())
-        await self.client.send(json.dumps({
+        await self.client.send_str(json.dumps({
             "type": "run_javascript",
             "script": script,
             "forget": forget,
@@ -94,42 +182,6 @@ class SocketWebView:
         return response
 
     async def close(self):
-        self.server.close()
-        await self.server.wait_closed()
-
-    def start_frontend_server(self):
-        from flask import Flask
-        import threading
-        from importlib import resources
-
-        app = Flask(__name__)
-
-        import logging
-
-        # Disable Flask's default logger
-        log = logging.getLogger('werkzeug')
-        log.setLevel(logging.ERROR)
-
-        # Disable all other Flask logging if needed
-        flask_log = logging.getLogger('flask.app')
-        flask_log.setLevel(logging.CRITICAL)
-
-        @app.route('/')
-        def internal_ui():
-            file = resources.files('lucyhubclient.templates') / 'index.html'
-            with open(file, 'r') as f:
-                return f.read()
-            
-        @app.route('/background.html')
-        def background_html():
-            file = resources.files('lucyhubclient.templates') / 'background.html'
-            with open(file, 'r') as f:
-                return f.read()
-            
-        def run_flask_app():
-            app.run(host='127.0.0.1', port=4814)
-            
-        flask_thread = threading.Thread(target=run_flask_app)
-        flask_thread.daemon = True
-        flask_thread.start()
-        
\ No newline at end of file
+        if self.client is not None:
+            await self.client.close()
+        await self.runner.cleanup()
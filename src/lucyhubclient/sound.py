@@ -1,11 +1,25 @@
-import pyaudio
+import collections
+import mmap
+import struct
 import threading
 import uuid
+import base64
 import numpy as np
 import time
-from .config import get_config
+from .config import get_config, subscribe
+from . import metrics
 from importlib import resources
 
+MIXER_BLOCK_SECONDS = metrics.histogram("lucy_mixer_block_seconds", "Time spent mixing one output block")
+MIXER_UNDERRUNS = metrics.counter("lucy_mixer_underruns_total", "Output blocks that took longer to mix than to play")
+TTS_BUFFER_SECONDS = metrics.gauge("lucy_tts_buffer_seconds", "Streamed TTS audio queued for playback")
+TTS_TARGET_SECONDS = metrics.gauge("lucy_tts_target_preroll_seconds", "Pre-roll the TTS jitter buffer is aiming for")
+TTS_GAPS = metrics.counter("lucy_tts_gaps_total", "Times streamed TTS ran dry before the server ended the stream")
+BARGE_IN_SECONDS = metrics.histogram("lucy_barge_in_seconds", "Time from an interrupt request until TTS was cut")
+MIXER_VOICES = metrics.gauge("lucy_mixer_voices", "Sounds mixed in the last block")
+MIXER_VOICES_STOLEN = metrics.counter("lucy_mixer_voices_stolen_total", "Sounds stopped to make way for a new one at the voice limit, by the stopped sound's bus")
+MIXER_VOICES_DROPPED = metrics.counter("lucy_mixer_voices_dropped_total", "New sounds not played because every voice held a more important one, by bus")
+
 # ----------
 
 class SoundEffect:
@@ -21,12 +35,9 @@ class FadeInEffect(SoundEffect):
         if self.progress >= self.duration:
             return audio_chunk
 
-        for i in range(len(audio_chunk)):
-            factor = self.progress / self.duration
-            audio_chunk[i] = audio_chunk[i] * factor
-            self.progress += 1
-
-        return audio_chunk
+        factor = np.minimum((self.progress + np.arange(len(audio_chunk))) / self.duration, 1)
+        self.progress += len(audio_chunk)
+        return (audio_chunk * factor[:, np.newaxis]).astype(audio_chunk.dtype)
     
     def is_done_playing(self):
         return False
@@ -40,14 +51,9 @@ class FadeOutEffect(SoundEffect):
         if self.progress >= self.duration:
             return np.zeros_like(audio_chunk)
 
-        for i in range(len(audio_chunk)):
-            factor = (self.duration - self.progress) / self.duration
-            if factor < 0:
-                factor = 0
-            audio_chunk[i] = audio_chunk[i] * factor
-            self.progress += 1
-
-        return audio_chunk
+        factor = np.maximum((self.duration - self.progress - np.arange(len(audio_chunk))) / self.duration, 0)
+        self.progress += len(audio_chunk)
+        return (audio_chunk * factor[:, np.newaxis]).astype(audio_chunk.dtype)
     
     def is_done_playing(self):
         return self.progress >= self.duration
@@ -59,17 +65,154 @@ class SoundPlaybackModifier:
         raise NotImplementedError("Subclasses should implement this method")
     
 class LoopPlaybackModifier(SoundPlaybackModifier):
-    def __init__(self, loop_start_frame, loop_end_frame):
+    """
+    Loops between two frames of a sound. Sound.get_next wraps at exactly
+    loop_end_frame, and the last crossfade_frames before it are blended
+    into the audio leading up to loop_start_frame so the jump is seamless.
+    """
+    def __init__(self, loop_start_frame, loop_end_frame, crossfade_frames=480):
         self.loop_start_frame = loop_start_frame
         self.loop_end_frame = loop_end_frame
+        self.crossfade_frames = crossfade_frames
+        self.crossfaded_tail = None
+
+    def prepare(self, audio_data):
+        self.loop_end_frame = min(self.loop_end_frame, len(audio_data))
+        crossfade_frames = min(self.crossfade_frames, self.loop_start_frame, self.loop_end_frame - self.loop_start_frame)
+        self.crossfade_frames = crossfade_frames
+
+        fade_out = np.linspace(1, 0, crossfade_frames)[:, np.newaxis]
+        tail = audio_data[self.loop_end_frame - crossfade_frames:self.loop_end_frame] * fade_out
+        lead_in = audio_data[self.loop_start_frame - crossfade_frames:self.loop_start_frame] * (1 - fade_out)
+        self.crossfaded_tail = (tail + lead_in).astype(audio_data.dtype)
 
     def apply(self, sound):
-        if sound.current_position >= self.loop_end_frame:
-            sound.current_position = self.loop_start_frame
+        # Sound._read_looped wraps inside the chunk, nothing left to do here
+        pass
+
+class GainRamp:
+    """
+    A gain that moves linearly to its target over a number of frames.
+    block() returns the per-frame gains for the next block as a column, or
+    a plain float while the gain is steady.
+    """
+    def __init__(self, gain=1.0):
+        self.gain = gain
+        self.target = gain
+        self.step = 0.0
+
+    def set(self, target, frames):
+        self.target = target
+        self.step = (target - self.gain) / max(frames, 1)
+
+    def block(self, num_frames):
+        if self.gain == self.target:
+            return self.gain
+        values = self.gain + self.step * np.arange(1, num_frames + 1)
+        values = np.minimum(values, self.target) if self.step > 0 else np.maximum(values, self.target)
+        self.gain = float(values[-1])
+        return values[:, np.newaxis]
 
 import soundfile as sf
+
+def _wav_data_offset(file_path):
+    # byte offset of the samples in a RIFF/WAVE file, None if it isn't one
+    with open(file_path, "rb") as f:
+        riff, _, wave = struct.unpack("<4sI4s", f.read(12))
+        if riff != b"RIFF" or wave != b"WAVE":
+            return None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return None
+            chunk_id, size = struct.unpack("<4sI", header)
+            if chunk_id == b"data":
+                return f.tell()
+            f.seek(size + (size & 1), 1)
+
+class WavStream:
+    """
+    Stands in for a Sound's audio_data array but only converts the frames
+    it is sliced for, so memory use doesn't grow with the length of the
+    file. 16 and 32 bit PCM WAVs are memory-mapped and pages already read are
+    released as playback moves on; anything else soundfile can open
+    is decoded with a seek per read. Slices are int32 stereo at the same
+    scale Sound.from_wav uses.
+    """
+    dtype = np.dtype(np.int32)
+    RELEASE_BYTES = 1 << 20
+
+    def __init__(self, file_path):
+        info = sf.info(str(file_path))
+        self.file_path = str(file_path)
+        self.sample_rate = info.samplerate
+        self.channels = info.channels
+        self.shape = (info.frames, 2)
+
+        self.samples = None
+        self.sound_file = None
+        offset = _wav_data_offset(file_path) if info.format == "WAV" and info.subtype in ("PCM_16", "PCM_32") else None
+        if offset is not None:
+            self.shift = 15 if info.subtype == "PCM_16" else -1
+            with open(file_path, "rb") as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            sample_dtype = np.dtype("<i2" if info.subtype == "PCM_16" else "<i4")
+            self.samples = np.frombuffer(self.map, dtype=sample_dtype, count=info.frames * info.channels, offset=offset)
+            self.samples = self.samples.reshape(info.frames, info.channels)
+            self.offset = offset
+            self.frame_bytes = sample_dtype.itemsize * info.channels
+            self.window = 0
+        else:
+            self.shift = -1
+            self.sound_file = sf.SoundFile(str(file_path))
+
+    def __getstate__(self):
+        # reopened wherever it is unpickled, e.g. in the mixer process
+        return self.file_path
+
+    def __setstate__(self, file_path):
+        self.__init__(file_path)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice) or key.step not in (None, 1):
+            raise TypeError("WavStream only supports contiguous slices")
+        start, stop, _ = key.indices(len(self))
+        stop = max(stop, start)
+
+        if self.samples is not None:
+            block = self.samples[start:stop, :2].astype(np.int32)
+            self._release(start, stop)
+        else:
+            self.sound_file.seek(start)
+            block = self.sound_file.read(stop - start, dtype='int32', always_2d=True)[:, :2]
+        block = block << self.shift if self.shift > 0 else block >> -self.shift
+
+        if self.channels == 1:
+            block = np.repeat(block, 2, axis=1)
+        return block
+
+    def _release(self, start, stop):
+        # Each time reading moves on to another RELEASE_BYTES of the file,
+        # drop every page mapped so far. The mapping is read only, so this
+        # costs nothing and the page cache serves pages a loop comes back to.
+        window = (self.offset + stop * self.frame_bytes) // self.RELEASE_BYTES
+        if window == self.window or not hasattr(self.map, "madvise"):
+            return
+        self.window = window
+        self.map.madvise(mmap.MADV_DONTNEED)
+
 class Sound:
-    def from_wav(file_path):
+    def from_wav(file_path, stream=False):
+        # stream=True reads the file as it plays, for long sounds
+        if stream:
+            audio_data = WavStream(file_path)
+            if audio_data.sample_rate != 48000:
+                raise ValueError("Audio sample rate must be 48000 Hz")
+            return Sound(audio_data)
+
         audio_data, audio_sr = sf.read(file_path, dtype='int16')
         if audio_data.dtype == 'int16':
             audio_data = audio_data.astype(np.int32)
@@ -92,33 +235,77 @@ class Sound:
         self.current_position = 0
         self.effects = []
         self.playback_modifiers = []
+        self.loop = None
+
+        # set by SoundManager, see SoundManager.add_sound
+        self.start_frame = None
+        self.stop_frame = None
+        self.bus = None
+        self.gain = GainRamp()
+        # called on the mixer thread once the SoundManager lets go of the
+        # sound: finished, removed, stopped, stolen or dropped at the limit
+        self.removed_callback = None
 
     def get_next(self, chunk_size):
-        audio_chunk = self.audio_data[self.current_position:self.current_position + chunk_size]
-        if len(audio_chunk) < chunk_size:
-            pad_amount = chunk_size - len(audio_chunk)
-            audio_chunk = np.pad(audio_chunk, ((0, pad_amount), (0, 0)), 'constant')
+        if self.loop is not None:
+            audio_chunk = self._read_looped(chunk_size)
+        else:
+            audio_chunk = self.audio_data[self.current_position:self.current_position + chunk_size]
+            if len(audio_chunk) < chunk_size:
+                pad_amount = chunk_size - len(audio_chunk)
+                audio_chunk = np.pad(audio_chunk, ((0, pad_amount), (0, 0)), 'constant')
+            self.current_position += chunk_size
 
         for effect in self.effects:
             audio_chunk = effect.apply(audio_chunk)
 
-        self.current_position += chunk_size
-
         for modifier in self.playback_modifiers:
             if isinstance(modifier, SoundPlaybackModifier):
                 modifier.apply(self)
 
         return audio_chunk
+
+    def _read_looped(self, chunk_size):
+        loop = self.loop
+        crossfade_start = loop.loop_end_frame - loop.crossfade_frames
+        audio_chunk = np.empty((chunk_size, self.audio_data.shape[1]), dtype=self.audio_data.dtype)
+
+        filled = 0
+        while filled < chunk_size:
+            position = self.current_position
+            take = min(chunk_size - filled, loop.loop_end_frame - position)
+            audio_chunk[filled:filled + take] = self.audio_data[position:position + take]
+
+            # the part inside the crossfade comes from the blended copy
+            overlap_start = max(position, crossfade_start)
+            if overlap_start < position + take:
+                audio_chunk[filled + overlap_start - position:filled + take] = \
+                    loop.crossfaded_tail[overlap_start - crossfade_start:position + take - crossfade_start]
+
+            filled += take
+            self.current_position += take
+            if self.current_position >= loop.loop_end_frame:
+                self.current_position = loop.loop_start_frame
+
+        return audio_chunk
     
     def add_effect(self, effect):
         self.effects.append(effect)
 
     def add_playback_modifier(self, modifier: SoundPlaybackModifier):
+        if isinstance(modifier, LoopPlaybackModifier):
+            modifier.prepare(self.audio_data)
+            self.loop = modifier
+            return
         self.playback_modifiers.append(modifier)    
 
     def get_id(self):
         return self.uuid
 
+    def is_audible(self):
+        # whether it should duck lower priority buses right now
+        return True
+
     def is_done_playing(self):
         for effect in self.effects:
             if effect.is_done_playing():
@@ -130,9 +317,15 @@ class ContinuousSound(Sound):
         super().__init__(np.zeros((0, 2), dtype=np.int32))
         self.sample_rate = sample_rate
 
-        self.lock = threading.Lock()
+        # filled by the producer, emptied by the mixer; deque appends and
+        # pops are atomic so neither side takes a lock
+        self.pending_audio = collections.deque()
 
     def add_audio_data(self, audio_data):
+        self.pending_audio.append(self._to_output_format(audio_data))
+
+    def _to_output_format(self, audio_data):
+        # stereo at 48 kHz, done by the producer to keep it off the mixer
         if audio_data.ndim == 1:
             audio_data = np.stack((audio_data, audio_data), axis=-1)
 
@@ -140,117 +333,574 @@ class ContinuousSound(Sound):
             audio_data = np.repeat(audio_data, 2, axis=0)
         elif self.sample_rate == 16000:
             audio_data = np.repeat(audio_data, 3, axis=0)
+        return audio_data
 
-        with self.lock:
-            self.audio_data = np.concatenate((self.audio_data, audio_data), axis=0)
+    def _take_pending_audio(self):
+        if not self.pending_audio:
+            return
+        blocks = [self.audio_data]
+        while self.pending_audio:
+            blocks.append(self.pending_audio.popleft())
+        self.audio_data = np.concatenate(blocks, axis=0)
 
     def get_next(self, chunk_size):
-        with self.lock:
-            next_chunk = super().get_next(chunk_size)
-            self.audio_data = self.audio_data[chunk_size:]
-            self.current_position = 0
-            return next_chunk
+        self._take_pending_audio()
+        next_chunk = super().get_next(chunk_size)
+        self.audio_data = self.audio_data[chunk_size:]
+        self.current_position = 0
+        return next_chunk
     
+    def is_audible(self):
+        return len(self.audio_data) > 0 or len(self.pending_audio) > 0
+
     def is_done_playing(self):
         return False
     
+class AdaptiveJitterBuffer:
+    """
+    Estimates network jitter from packet inter-arrival times (the RFC 3550
+    running average of |arrival spacing - packet duration|) and turns it into
+    the amount of audio to hold back before playback starts or resumes.
+    """
+    def __init__(self, min_delay=0.06, max_delay=0.5, jitter_multiplier=4):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.jitter_multiplier = jitter_multiplier
+
+        self.jitter = 0.0
+        self.last_arrival_time = None
+        self.last_duration = None
+
+    def reset(self):
+        # keep the jitter estimate, the network doesn't change between answers
+        self.last_arrival_time = None
+        self.last_duration = None
+
+    def on_packet(self, duration, arrival_time):
+        if self.last_arrival_time is not None:
+            deviation = (arrival_time - self.last_arrival_time) - self.last_duration
+            self.jitter += (abs(deviation) - self.jitter) / 16
+        self.last_arrival_time = arrival_time
+        self.last_duration = duration
+
+    def target_delay(self):
+        return min(max(self.jitter * self.jitter_multiplier, self.min_delay), self.max_delay)
+
 class SpeechSound(ContinuousSound):
-    def __init__(self, sample_rate=48000, volume_callback=None, done_speaking_callback=None):
+    """
+    A streamed answer. add_audio_data, start_stream, interrupt and
+    end_stream may be called from any thread: they only queue an event,
+    and the mixer applies the events in order at the start of get_next.
+    Every other field belongs to the mixer thread.
+    """
+    CONCEAL_FRAMES = 240  # 5 ms fade at the edges of a gap
+
+    def __init__(self, sample_rate=48000, volume_callback=None, done_speaking_callback=None, jitter_buffer=None, stream_timeout=3.0, clock=time.monotonic, start_speaking_callback=None):
         super().__init__(sample_rate)
         self.volume_callback = volume_callback
         self.done_speaking_callback = done_speaking_callback
+        # called once per answer, when its first audio leaves the pre-roll
+        self.start_speaking_callback = start_speaking_callback
 
-        self.is_speaking = False
+        self.jitter_buffer = jitter_buffer or AdaptiveJitterBuffer()
+        self.stream_timeout = stream_timeout
+        self.clock = clock
 
-    def add_audio_data(self, audio_data):
+        self.is_speaking = False
+        self.stream_ended = False
+        self.is_buffering = True
+        self.needs_fade_in = False
+        self.last_packet_time = 0
+        self.buffering_since = None
+        self.has_started_playing = False
+
+        self.interrupt_requested_at = None
+        self.discard_until_next_stream = False
+
+        # (kind, args) from the producer, like SoundManager.commands
+        self.events = collections.deque()
+
+    def add_audio_data(self, audio_data, arrival_time=None):
+        # stamped now, the jitter estimate needs the arrival time
+        now = self.clock() if arrival_time is None else arrival_time
+        self.events.append((self._on_audio, (self._to_output_format(audio_data), now)))
+
+    def start_stream(self):
+        self.events.append((self._on_start_stream, ()))
+
+    def interrupt(self):
+        # Barge-in: cut the current answer at the next block and ignore the
+        # rest of its audio until the server starts a new one.
+        self.events.append((self._on_interrupt, (self.clock(),)))
+
+    def end_stream(self):
+        # The server is done sending audio for this answer. Only now may an
+        # empty buffer be treated as the end of speech.
+        self.events.append((self._on_end_stream, ()))
+
+    def is_audible(self):
+        return self.is_speaking
+
+    # ---------- applied on the mixer thread
+
+    def _apply_events(self):
+        while self.events:
+            handler, args = self.events.popleft()
+            handler(*args)
+
+    def _on_audio(self, audio_data, now):
+        if self.discard_until_next_stream:
+            return
+
+        if not self.is_speaking:
+            self.stream_ended = False
+            self.is_buffering = True
+            self.needs_fade_in = False
+            self.buffering_since = None
+            self.has_started_playing = False
+            self.jitter_buffer.reset()
+
+        # already at 48 kHz
+        self.jitter_buffer.on_packet(len(audio_data) / 48000, now)
+        self.last_packet_time = now
+        if self.buffering_since is None:
+            self.buffering_since = now
+
+        self.pending_audio.append(audio_data)
         self.is_speaking = True
-        super().add_audio_data(audio_data)
+
+    def _on_start_stream(self):
+        self.discard_until_next_stream = False
+
+    def _on_interrupt(self, requested_at):
+        if self.is_speaking:
+            self.discard_until_next_stream = True
+            self.interrupt_requested_at = requested_at
+
+    def _on_end_stream(self):
+        if self.is_speaking:
+            self.stream_ended = True
 
     def get_next(self, chunk_size):
-        next_chunk = super().get_next(chunk_size)
+        self._apply_events()
+        if not self.is_speaking:
+            return super().get_next(chunk_size)
+
+        if self.interrupt_requested_at is not None:
+            return self._cut(chunk_size)
+
+        self._take_pending_audio()
+
+        now = self.clock()
+        buffered = self.audio_data.shape[0]
+        stream_ended = self.stream_ended or (now - self.last_packet_time > self.stream_timeout)
+
+        if self.is_buffering:
+            # Hold playback back by the target delay, measured from the first
+            # packet, so later packets can arrive that much late without a gap.
+            target_delay = self.jitter_buffer.target_delay()
+            TTS_TARGET_SECONDS.set(target_delay)
+            waited = now - self.buffering_since if self.buffering_since is not None else 0
+            if (waited >= target_delay and buffered >= chunk_size) or stream_ended:
+                self.is_buffering = False
+                if not self.has_started_playing:
+                    self.has_started_playing = True
+                    if self.start_speaking_callback:
+                        self.start_speaking_callback()
+
+        if self.is_buffering:
+            next_chunk = np.zeros((chunk_size, 2), dtype=np.int32)
+        else:
+            next_chunk = super().get_next(chunk_size)
+
+            if self.needs_fade_in:
+                fade_frames = min(self.CONCEAL_FRAMES, chunk_size)
+                ramp = np.linspace(0, 1, fade_frames, dtype=np.float32)[:, np.newaxis]
+                next_chunk[:fade_frames] = (next_chunk[:fade_frames] * ramp).astype(np.int32)
+                self.needs_fade_in = False
+
+            if buffered < chunk_size and not stream_ended:
+                # Ran dry mid-answer: fade out what is left instead of
+                # clicking, then build the pre-roll back up before resuming.
+                fade_frames = min(self.CONCEAL_FRAMES, buffered)
+                ramp = np.linspace(1, 0, fade_frames, dtype=np.float32)[:, np.newaxis]
+                next_chunk[buffered - fade_frames:buffered] = (next_chunk[buffered - fade_frames:buffered] * ramp).astype(np.int32)
+                self.is_buffering = True
+                self.needs_fade_in = True
+                self.buffering_since = None
+                TTS_GAPS.inc()
+
+        TTS_BUFFER_SECONDS.set(self.audio_data.shape[0] / 48000)
 
         if self.volume_callback and self.is_speaking:
             mono_next_chunk = next_chunk.mean(axis=1).astype(np.float32)
             mono_next_chunk = mono_next_chunk / 32768 / 32768
-            window = np.hanning(1024)
+            window = np.hanning(len(mono_next_chunk))
             audio_windowed = mono_next_chunk * window
             fft_result = np.fft.rfft(audio_windowed)
             magnitude = np.abs(fft_result)
             magnitude_db = 20 * np.log10(magnitude + 1e-8)
             self.volume_callback(magnitude_db)
 
-        if self.audio_data.shape[0] == 0 and self.done_speaking_callback and self.is_speaking:
+        if stream_ended and self.audio_data.shape[0] == 0:
             self.is_speaking = False
-            self.done_speaking_callback()
+            if self.done_speaking_callback:
+                self.done_speaking_callback()
 
         return next_chunk
 
-class SoundManager:
-    def __init__(self):
+    def _cut(self, chunk_size):
+        self._take_pending_audio()
+        next_chunk = self.audio_data[:chunk_size].copy()
+        self.audio_data = np.zeros((0, 2), dtype=np.int32)
+        self.current_position = 0
+
+        if len(next_chunk) < chunk_size:
+            next_chunk = np.pad(next_chunk, ((0, chunk_size - len(next_chunk)), (0, 0)), 'constant')
+        if not self.is_buffering:
+            ramp = np.linspace(1, 0, self.CONCEAL_FRAMES, dtype=np.float32)[:, np.newaxis]
+            next_chunk[:self.CONCEAL_FRAMES] = (next_chunk[:self.CONCEAL_FRAMES] * ramp).astype(np.int32)
+        next_chunk[self.CONCEAL_FRAMES:] = 0
+
+        BARGE_IN_SECONDS.observe(self.clock() - self.interrupt_requested_at)
+        self.interrupt_requested_at = None
+        self.is_speaking = False
+        self.is_buffering = True
+        self.buffering_since = None
+        return next_chunk
+
+def decode_speech_audio(base64_data):
+    audio_data = base64.b64decode(base64_data)
+    audio_array = np.frombuffer(audio_data, dtype=np.float32)
+    return (audio_array * 32767 * 32767).astype(np.int32)
+
+# ----------
+
+class OutputSink:
+    """
+    Destination for the mixed 48 kHz stereo int32 blocks. Sinks that don't
+    block on a device can be paced to real time with realtime=True, otherwise
+    they accept blocks as fast as the mixer can produce them.
+    """
+    def __init__(self, sample_rate=48000, realtime=False):
+        self.sample_rate = sample_rate
+        self.realtime = realtime
+        self.next_block_time = None
+        # seconds between write() returning and the block being heard
+        self.latency = 0.0
+
+    def write(self, chunk):
+        raise NotImplementedError("Subclasses should implement this method")
+
+    def close(self):
+        pass
+
+    def _wait_for_block(self, num_frames):
+        if not self.realtime:
+            return
+        now = time.monotonic()
+        if self.next_block_time is None or self.next_block_time < now:
+            self.next_block_time = now
+        self.next_block_time += num_frames / self.sample_rate
+        delay = self.next_block_time - now
+        if delay > 0:
+            time.sleep(delay)
+
+class PyAudioSink(OutputSink):
+    def __init__(self, sample_rate=48000, channels=2):
+        super().__init__(sample_rate)
+        import pyaudio
+
         self.p = pyaudio.PyAudio()
-        self.stream = self.p.open(format=pyaudio.paInt32, channels=2, rate=48000, output=True)
+        self.stream = self.p.open(format=pyaudio.paInt32, channels=channels, rate=sample_rate, output=True)
+        self.latency = self.stream.get_output_latency()
+
+    def write(self, chunk):
+        self.stream.write(chunk.tobytes())
+
+    def close(self):
+        self.stream.stop_stream()
+        self.stream.close()
+        self.p.terminate()
+
+class WavFileSink(OutputSink):
+    def __init__(self, file_path, sample_rate=48000, channels=2, realtime=False):
+        super().__init__(sample_rate, realtime)
+        self.file = sf.SoundFile(file_path, mode='w', samplerate=sample_rate, channels=channels, subtype='PCM_32')
+
+    def write(self, chunk):
+        self.file.write(chunk)
+        self._wait_for_block(len(chunk))
+
+    def close(self):
+        self.file.close()
+
+class NullSink(OutputSink):
+    def write(self, chunk):
+        self._wait_for_block(len(chunk))
+
+class SoundManager:
+    """
+    Mixes the active sounds on its own thread. Control methods (add_sound,
+    remove_sound, stop_sound, add_effect_to_sound, set_volume, set_*_gain,
+    hold_duck) may be called from any thread: they only queue a command, and
+    the mixer applies the queue at the start of the next block.
+    self.sounds belongs to the mixer thread.
+
+    Sounds can be started and stopped at an exact output frame, frame 0
+    being the first frame ever mixed. frame_at() converts a time.monotonic()
+    time at which something should be heard into a frame.
+
+    Every sound plays on a bus. While a bus has an audible sound, every bus
+    of lower priority is ducked. At most max_voices sounds play at once;
+    beyond that the oldest sound of the lowest STEAL_PRIORITIES makes way.
+    """
+    STOP_FADE_FRAMES = 240
+    BUS_PRIORITIES = {"speech": 3, "alert": 2, "effect": 1, "alarm": 0}
+    # a ringing alarm is ducked under everything but never cut for a new
+    # sound, nothing would start it again
+    STEAL_PRIORITIES = {"alarm": 4, "speech": 3, "alert": 2, "effect": 1}
+
+    def __init__(self, sink=None, start_thread=True, max_voices=8, duck_gain=0.15, duck_attack=0.05, duck_release=0.4):
+        self.CHUNK_SIZE = 1024
+        self.SAMPLE_RATE = 48000
+
+        if sink is None:
+            sink = PyAudioSink(sample_rate=self.SAMPLE_RATE)
+        self.sink = sink
 
         self.sounds = {}
-        self.volume = 1.0
+        self.volume = GainRamp()
+        self.output_listeners = []
+        self.commands = collections.deque()
+
+        self.max_voices = max_voices
+        self.duck_gain = duck_gain
+        self.duck_attack_frames = int(duck_attack * self.SAMPLE_RATE)
+        self.duck_release_frames = int(duck_release * self.SAMPLE_RATE)
+        # user set gain and automatic ducking, per bus
+        self.bus_gains = {bus: GainRamp() for bus in self.BUS_PRIORITIES}
+        self.bus_ducks = {bus: GainRamp() for bus in self.BUS_PRIORITIES}
+        self.held_ducks = set()
+
+        # first frame of the next block, and (frame, monotonic time it is
+        # heard) as of the last block written
+        self.frame = 0
+        self.clock_reference = (0, time.monotonic())
+
+        # read on every block, so keep a copy that the config pushes to us
+        self.quiet_mode = get_config()["quiet_mode"]
+        subscribe("quiet_mode", self._set_quiet_mode)
 
         self.should_stop = False
 
-        self.thread = threading.Thread(target=self._playing_thread)
-        self.thread.start()
-
+        self.thread = None
+        if start_thread:
+            self.thread = threading.Thread(target=self._playing_thread, name="SoundManager")
+            self.thread.start()
 
     def stop(self):
         self.should_stop = True
-        self.thread.join()
-        self.stream.stop_stream()
-        self.stream.close()
-        self.p.terminate()
+        if self.thread is not None:
+            self.thread.join()
+        self.sink.close()
+
+    def _set_quiet_mode(self, quiet_mode):
+        self.quiet_mode = quiet_mode
+
+    def add_sound(self, sound: Sound, start_frame=None, bus="effect"):
+        # start_frame=None starts at the next block, a frame that has
+        # already been mixed starts right away
+        # returns the sound to control it by, see RemoteSoundManager
+        if bus not in self.BUS_PRIORITIES:
+            raise ValueError(f"Unknown bus '{bus}'")
+        self.commands.append((self._add_sound, (sound, start_frame, bus)))
+        return sound
+
+    def remove_sound(self, sound_id):
+        self.commands.append((self._remove_sound, (sound_id,)))
+
+    def stop_sound(self, sound_id, stop_frame=None):
+        # ends with a short fade that finishes exactly at stop_frame
+        self.commands.append((self._stop_sound, (sound_id, stop_frame)))
+
+    def frame_at(self, play_time):
+        frame, frame_time = self.clock_reference
+        return frame + int(round((play_time - frame_time) * self.SAMPLE_RATE))
+
+    def add_output_listener(self, listener):
+        # listener(chunk, play_time) is called on the mixer thread after every
+        # block, e.g. EchoCanceller.push_reference. It must not block.
+        self.output_listeners.append(listener)
+
+    def add_effect_to_sound(self, sound_id, effect: SoundEffect):
+        self.commands.append((self._add_effect_to_sound, (sound_id, effect)))
+
+    def set_volume(self, volume, ramp_seconds=0.05):
+        if not (0 <= volume <= 1):
+            raise ValueError("Volume must be between 0 and 1")
+        self.commands.append((self.volume.set, (volume, int(ramp_seconds * self.SAMPLE_RATE))))
 
-    def add_sound(self, sound: Sound):
+    def set_sound_gain(self, sound_id, gain, ramp_seconds=0.05):
+        self.commands.append((self._set_sound_gain, (sound_id, gain, int(ramp_seconds * self.SAMPLE_RATE))))
+
+    def set_bus_gain(self, bus, gain, ramp_seconds=0.05):
+        self.commands.append((self.bus_gains[bus].set, (gain, int(ramp_seconds * self.SAMPLE_RATE))))
+
+    def hold_duck(self, bus, held=True):
+        # duck everything below `bus` as if it were playing, e.g. while the
+        # user is talking to the assistant
+        self.commands.append((self._hold_duck, (bus, held)))
+
+    # ---------- applied on the mixer thread
+
+    def _add_sound(self, sound, start_frame, bus):
         if sound.get_id() in self.sounds:
             raise ValueError("Sound with this ID already exists")
+        sound.start_frame = max(start_frame if start_frame is not None else self.frame, self.frame)
+        sound.bus = bus
+
+        voices = [v for v in self.sounds.values() if v.stop_frame is None]
+        if len(voices) >= self.max_voices:
+            priority = self.STEAL_PRIORITIES[bus]
+            # oldest first, dicts keep insertion order
+            victim = min(voices, key=lambda v: self.STEAL_PRIORITIES[v.bus])
+            if self.STEAL_PRIORITIES[victim.bus] > priority:
+                print(f"[SOUND] Voice limit reached, dropping new {bus} sound")
+                MIXER_VOICES_DROPPED.inc(bus=bus)
+                self._notify_removed(sound)
+                return
+            MIXER_VOICES_STOLEN.inc(bus=victim.bus)
+            victim.stop_frame = self.frame + self.STOP_FADE_FRAMES
+
         self.sounds[sound.get_id()] = sound
 
-    def add_effect_to_sound(self, sound_id, effect: SoundEffect):
+    def _remove_sound(self, sound_id):
+        sound = self.sounds.pop(sound_id, None)
+        if sound is not None:
+            self._notify_removed(sound)
+
+    def _notify_removed(self, sound):
+        if sound.removed_callback is not None:
+            try:
+                sound.removed_callback()
+            except Exception as e:
+                print(f"[SOUND] removed_callback failed: {e}")
+
+    def _stop_sound(self, sound_id, stop_frame):
         if sound_id not in self.sounds:
-            raise ValueError("Sound with this ID does not exist")
-        self.sounds[sound_id].add_effect(effect)
+            return
+        self.sounds[sound_id].stop_frame = max(stop_frame if stop_frame is not None else self.frame + self.STOP_FADE_FRAMES, self.frame)
 
-    def set_volume(self, volume):
-        if not (0 <= volume <= 1):
-            raise ValueError("Volume must be between 0 and 1")
-        self.volume = volume
+    def _add_effect_to_sound(self, sound_id, effect):
+        if sound_id not in self.sounds:
+            # finished or removed before the command got here
+            return
+        self.sounds[sound_id].add_effect(effect)
 
-    def _playing_thread(self):
-        CHUNK_SIZE = 1024
-        
-        while True:
-            if self.should_stop:
-                break
-
-            chunk = np.zeros((CHUNK_SIZE, 2), dtype=np.int32)
-            done_sounds = []
-            for sound in self.sounds:
-                sound = self.sounds[sound]
-                if sound.is_done_playing():
+    def _set_sound_gain(self, sound_id, gain, frames):
+        if sound_id in self.sounds:
+            self.sounds[sound_id].gain.set(gain, frames)
+
+    def _hold_duck(self, bus, held):
+        if held:
+            self.held_ducks.add(bus)
+        else:
+            self.held_ducks.discard(bus)
+
+    def _apply_commands(self):
+        while self.commands:
+            command, args = self.commands.popleft()
+            try:
+                command(*args)
+            except Exception as e:
+                print(f"[SOUND] {command.__name__} failed: {e}")
+
+    def _update_ducking(self):
+        audible = {sound.bus for sound in self.sounds.values() if sound.is_audible()} | self.held_ducks
+        top_priority = max((self.BUS_PRIORITIES[bus] for bus in audible), default=-1)
+        for bus, duck in self.bus_ducks.items():
+            target = self.duck_gain if self.BUS_PRIORITIES[bus] < top_priority else 1.0
+            if target != duck.target:
+                duck.set(target, self.duck_attack_frames if target < duck.gain else self.duck_release_frames)
+
+    def render_block(self):
+        self._apply_commands()
+        self._update_ducking()
+
+        block_start = self.frame
+        self.frame += self.CHUNK_SIZE
+
+        bus_gains = {bus: self.bus_gains[bus].block(self.CHUNK_SIZE) * self.bus_ducks[bus].block(self.CHUNK_SIZE)
+                     for bus in self.BUS_PRIORITIES}
+
+        # summed in float so several loud sounds clip instead of wrapping
+        mix = np.zeros((self.CHUNK_SIZE, 2), dtype=np.float64)
+        done_sounds = []
+        for sound in self.sounds:
+            sound = self.sounds[sound]
+            if sound.is_done_playing():
+                done_sounds.append(sound.get_id())
+                continue
+
+            # the part of this block the sound covers
+            start = max(sound.start_frame - block_start, 0) if sound.start_frame is not None else 0
+            end = self.CHUNK_SIZE
+            if sound.stop_frame is not None:
+                end = min(end, sound.stop_frame - block_start)
+                if sound.stop_frame <= self.frame:
                     done_sounds.append(sound.get_id())
-                    continue
-                next_chunk = sound.get_next(CHUNK_SIZE)
-                if next_chunk is not None:
-                    chunk += next_chunk
+            if start >= end:
+                continue
+
+            next_chunk = sound.get_next(end - start)
+            if next_chunk is None:
+                continue
+
+            gain = sound.gain.block(end - start)
+            bus_gain = bus_gains[sound.bus]
+            gain = gain * (bus_gain[start:end] if isinstance(bus_gain, np.ndarray) else bus_gain)
+            if sound.stop_frame is not None:
+                frames_left = sound.stop_frame - (block_start + start + np.arange(end - start))
+                gain = gain * np.minimum(frames_left / self.STOP_FADE_FRAMES, 1)[:, np.newaxis]
+            mix[start:end] += next_chunk * gain if isinstance(gain, np.ndarray) or gain != 1.0 else next_chunk
+
+        for sound_id in done_sounds:
+            self._notify_removed(self.sounds.pop(sound_id))
+        MIXER_VOICES.set(len(self.sounds))
+
+        mix *= self.volume.block(self.CHUNK_SIZE)
+        chunk = np.clip(mix, -2147483648, 2147483647).astype(np.int32)
+
+        if self.quiet_mode:
+            chunk = np.zeros_like(chunk)
 
-            for sound_id in done_sounds:
-                del self.sounds[sound_id]
+        return chunk
 
-            if get_config()["quiet_mode"]:
-                chunk = np.zeros_like(chunk)
+    def play_block(self):
+        start_time = time.perf_counter()
+        chunk = self.render_block()
+        elapsed = time.perf_counter() - start_time
 
-            self.stream.write(chunk.tobytes())
-                
+        MIXER_BLOCK_SECONDS.observe(elapsed)
+        if elapsed > self.CHUNK_SIZE / self.SAMPLE_RATE:
+            MIXER_UNDERRUNS.inc()
+
+        self.sink.write(chunk)
+        # the end of the block just written is heard after the latency
+        self.clock_reference = (self.frame, time.monotonic() + self.sink.latency)
+
+        if self.output_listeners:
+            play_time = self.clock_reference[1]
+            for listener in self.output_listeners:
+                listener(chunk, play_time)
+
+    def _playing_thread(self):
+        while not self.should_stop:
+            self.play_block()
 
     def close(self):
-        self.stream.close()
-        self.p.terminate()
+        self.sink.close()
 
 if __name__ == "__main__":
     # Example usage
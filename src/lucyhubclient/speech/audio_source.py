@@ -0,0 +1,287 @@
+import bisect
+import re
+import time
+import numpy as np
+
+from .. import metrics
+
+MIC_SELECTED_CHANNEL = metrics.gauge("lucy_mic_selected_channel", "Index of the microphone currently feeding the voice assistant")
+MIC_SNR_DB = metrics.gauge("lucy_mic_snr_db", "Smoothed signal to noise ratio of each microphone")
+MIC_COMBINE_SECONDS = metrics.histogram("lucy_mic_combine_seconds", "Time spent combining the microphones per frame")
+
+class AudioSource:
+    """
+    Blocking source of 16-bit mono PCM frames for the VoiceAssistant.
+    read() returns raw int16 bytes, exactly like a PyAudio input stream.
+    """
+    # seconds between a frame being captured and read() returning it
+    latency = 0.0
+
+    def read(self, num_frames):
+        raise NotImplementedError("Subclasses should implement this method")
+
+    def lock_selection(self, locked):
+        # called when an utterance starts and ends, see MultiMicSource
+        pass
+
+    def close(self):
+        pass
+
+class PyAudioMicSource(AudioSource):
+    def __init__(self, mic_list=[], sample_rate=16000, chunk_size=1536, device_index=None, pyaudio_instance=None):
+        import pyaudio
+
+        self.p = pyaudio_instance or pyaudio.PyAudio()
+
+        if device_index is None:
+            for mic_name in mic_list:
+                device_index = self.find_device_by_name(mic_name)
+                if device_index is not None:
+                    print(f"[AUDIO] Using microphone: {mic_name} (index {device_index})")
+                    break
+
+        if device_index is None:
+            print("[AUDIO] No microphone found, using default device")
+            device_index = self.p.get_default_input_device_info()['index']
+
+        self.stream = self.p.open(format=pyaudio.paInt16, channels=1, rate=sample_rate, input=True, frames_per_buffer=chunk_size, input_device_index=device_index)
+        self.latency = self.stream.get_input_latency()
+
+    def find_device_by_name(self, name):
+        for i in range(self.p.get_device_count()):
+            info = self.p.get_device_info_by_index(i)
+            if name.lower() in info['name'].lower():
+                return i
+        return None
+
+    def read(self, num_frames):
+        return self.stream.read(num_frames, exception_on_overflow=False)
+
+    def close(self):
+        self.stream.stop_stream()
+        self.stream.close()
+
+class WavFileSource(AudioSource):
+    """
+    Replays a WAV file as if it were a microphone. speed=1.0 paces reads at
+    real time, higher values replay faster and speed=0 returns immediately.
+    Once the file runs out the source keeps returning silence.
+    """
+    def __init__(self, file_path, sample_rate=16000, speed=1.0):
+        import soundfile as sf
+
+        audio_data, audio_sr = sf.read(file_path, dtype='float32', always_2d=True)
+        audio_data = audio_data.mean(axis=1)
+        if audio_sr != sample_rate:
+            duration = len(audio_data) / audio_sr
+            target_times = np.arange(int(duration * sample_rate)) / sample_rate
+            audio_data = np.interp(target_times, np.arange(len(audio_data)) / audio_sr, audio_data)
+
+        self.audio_data = np.clip(audio_data * 32768, -32768, 32767).astype(np.int16)
+        self.sample_rate = sample_rate
+        self.speed = speed
+
+        self.position = 0
+        self.start_time = None
+
+        # (end sample position, monotonic time) for every read, used to map
+        # positions in the file to the wall-clock time they were delivered
+        self.delivered_positions = []
+        self.delivered_times = []
+
+    def read(self, num_frames):
+        if self.start_time is None:
+            self.start_time = time.monotonic()
+
+        end = self.position + num_frames
+        if self.speed:
+            delay = self.start_time + end / self.sample_rate / self.speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+        chunk = self.audio_data[self.position:end]
+        if len(chunk) < num_frames:
+            chunk = np.pad(chunk, (0, num_frames - len(chunk)), 'constant')
+        self.position = end
+
+        self.delivered_positions.append(end)
+        self.delivered_times.append(time.monotonic())
+        return chunk.tobytes()
+
+    def is_finished(self):
+        return self.position >= len(self.audio_data)
+
+    def time_at(self, sample_position):
+        i = bisect.bisect_left(self.delivered_positions, sample_position)
+        if i >= len(self.delivered_times):
+            return None
+        return self.delivered_times[i]
+
+class MultiMicSource(AudioSource):
+    """
+    Captures from several microphones at once and hands the VoiceAssistant a
+    single channel. mode="select" passes through the microphone with the best
+    SNR, mode="beamform" aligns every microphone to that one and averages
+    them (delay-and-sum). While lock_selection(True) is in effect the choice
+    is frozen, so an utterance never switches microphone halfway through.
+    """
+    def __init__(self, sources, mode="select", sample_rate=16000, switch_db=3.0, smoothing=0.7, max_delay_ms=10.0, floor_rise_db_per_s=3.0):
+        if mode not in ("select", "beamform"):
+            raise ValueError(f"Unknown microphone mode '{mode}'")
+
+        self.sources = sources
+        self.mode = mode
+        self.sample_rate = sample_rate
+        self.latency = max(source.latency for source in sources)
+
+        self.switch_db = switch_db
+        self.smoothing = smoothing
+        self.max_delay = int(sample_rate * max_delay_ms / 1000)
+        self.floor_rise_db_per_s = floor_rise_db_per_s
+
+        num_channels = len(sources)
+        self.noise_floor = None
+        self.frame_snr = np.zeros(num_channels)
+        self.snr = np.zeros(num_channels)
+        self.selected = 0
+        self.locked = False
+
+        # delay of each microphone behind the selected one, in samples
+        self.delays = np.zeros(num_channels, dtype=np.int64)
+        self.history = None
+
+    def read(self, num_frames):
+        # each stream buffers on its own, so reading them one after another
+        # only blocks on the first
+        frames = np.stack([np.frombuffer(source.read(num_frames), dtype=np.int16) for source in self.sources])
+
+        start_time = time.perf_counter()
+        frames = frames.astype(np.float32)
+        self._update_snr(frames)
+        if not self.locked:
+            self._select()
+
+        if self.mode == "beamform":
+            output = self._delay_and_sum(frames)
+        else:
+            output = frames[self.selected]
+        MIC_COMBINE_SECONDS.observe(time.perf_counter() - start_time)
+
+        return np.clip(output, -32768, 32767).astype(np.int16).tobytes()
+
+    def _update_snr(self, frames):
+        level = 10 * np.log10(np.mean(frames * frames, axis=1) + 1.0)
+        if self.noise_floor is None:
+            self.noise_floor = level.copy()
+        else:
+            # follow quieter frames immediately, louder ones only slowly
+            rise = self.floor_rise_db_per_s * frames.shape[1] / self.sample_rate
+            self.noise_floor = np.minimum(level, self.noise_floor + rise)
+        self.frame_snr = level - self.noise_floor
+        self.snr = self.smoothing * self.snr + (1 - self.smoothing) * self.frame_snr
+
+    def _select(self):
+        best = int(np.argmax(self.snr))
+        if best != self.selected and self.snr[best] - self.snr[self.selected] > self.switch_db:
+            print(f"[AUDIO] Switching to microphone {best} (SNR {self.snr[best]:.1f} dB)")
+            self.selected = best
+            self.delays[:] = 0
+
+        MIC_SELECTED_CHANNEL.set(self.selected)
+        for channel, snr in enumerate(self.snr):
+            MIC_SNR_DB.set(float(snr), channel=str(channel))
+
+    def _delay_and_sum(self, frames):
+        num_channels, num_frames = frames.shape
+        if self.history is None or self.history.shape[1] != 2 * num_frames:
+            self.history = np.zeros((num_channels, 2 * num_frames), dtype=np.float32)
+        # the previous frame stays around so channels can be shifted both ways
+        self.history[:, :num_frames] = self.history[:, num_frames:]
+        self.history[:, num_frames:] = frames
+
+        max_delay = min(self.max_delay, num_frames // 2)
+        if not self.locked and self.frame_snr[self.selected] > 2 * self.switch_db:
+            self._estimate_delays(max_delay)
+
+        # output lags the input by max_delay so late channels can be aligned
+        start = num_frames - max_delay + self.delays[:, None] + np.arange(num_frames)
+        aligned = np.take_along_axis(self.history, start, axis=1)
+        # weight by SNR so distant microphones add less noise than signal
+        weights = 10 ** (np.maximum(self.snr, 0) / 20)
+        return weights @ aligned / weights.sum()
+
+    def _estimate_delays(self, max_delay):
+        # GCC-PHAT of every channel against the selected one
+        spectra = np.fft.rfft(self.history, n=2 * self.history.shape[1], axis=1)
+        cross = spectra * np.conj(spectra[self.selected])
+        correlation = np.fft.irfft(cross / (np.abs(cross) + 1e-9), axis=1)
+        candidates = np.concatenate((correlation[:, -max_delay:], correlation[:, :max_delay + 1]), axis=1) if max_delay else correlation[:, :1]
+        peaks = np.argmax(candidates, axis=1)
+
+        # only trust a clear peak, noise and tones give a flat correlation
+        peak_values = candidates[np.arange(len(peaks)), peaks]
+        confident = peak_values > 5 * np.std(correlation, axis=1)
+        self.delays = np.where(confident, peaks - max_delay, self.delays)
+
+    def lock_selection(self, locked):
+        self.locked = locked
+
+    def close(self):
+        for source in self.sources:
+            source.close()
+
+def _hardware_key(info):
+    # ALSA lists one card under several names, e.g. "Yeti: USB Audio (hw:1,0)"
+    match = re.search(r"\(hw:(\d+),(\d+)\)", info['name'])
+    return match.groups() if match else info['name']
+
+def open_microphones(mic_list=[], sample_rate=16000, chunk_size=1536, mode="select"):
+    """
+    Opens every plugged in microphone that matches a name in mic_list, not
+    just the first, and combines them with MultiMicSource. Devices that
+    fail to open are skipped. With a single one this is the same as
+    PyAudioMicSource.
+    """
+    import pyaudio
+
+    p = pyaudio.PyAudio()
+    matches = []
+    for i in range(p.get_device_count()):
+        info = p.get_device_info_by_index(i)
+        if info['maxInputChannels'] > 0 and any(name.lower() in info['name'].lower() for name in mic_list):
+            matches.append(info)
+
+    # the same microphone also shows up under every host API, keep the
+    # default one's entries when it has any
+    default_host_api = p.get_default_host_api_info()['index']
+    if any(info['hostApi'] == default_host_api for info in matches):
+        matches = [info for info in matches if info['hostApi'] == default_host_api]
+    device_indices = []
+    seen = set()
+    for info in matches:
+        key = (info['hostApi'], _hardware_key(info))
+        if key not in seen:
+            seen.add(key)
+            device_indices.append(info['index'])
+
+    if len(device_indices) <= 1:
+        device_index = device_indices[0] if device_indices else None
+        return PyAudioMicSource(mic_list, sample_rate=sample_rate, chunk_size=chunk_size, device_index=device_index, pyaudio_instance=p)
+
+    sources = []
+    for i in device_indices:
+        name = p.get_device_info_by_index(i)['name']
+        try:
+            sources.append(PyAudioMicSource(sample_rate=sample_rate, chunk_size=chunk_size, device_index=i, pyaudio_instance=p))
+        except Exception as e:
+            # busy, or no 16 kHz capture, the others still work
+            print(f"[AUDIO] Could not open microphone {name} (index {i}): {e}")
+            continue
+        print(f"[AUDIO] Using microphone: {name} (index {i})")
+
+    if not sources:
+        print("[AUDIO] None of the matching microphones opened")
+        return PyAudioMicSource(sample_rate=sample_rate, chunk_size=chunk_size, pyaudio_instance=p)
+    if len(sources) == 1:
+        return sources[0]
+    return MultiMicSource(sources, mode=mode, sample_rate=sample_rate)
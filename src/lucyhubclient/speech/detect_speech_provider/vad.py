@@ -1,46 +1,160 @@
+import collections
+import time
 import numpy as np
 
+from ... import metrics
+
+VAD_INFERENCE_SECONDS = metrics.histogram("lucy_vad_inference_seconds", "Silero VAD inference time per 512-sample window")
+VAD_CHUNKS = metrics.counter("lucy_vad_chunks_total", "512-sample windows seen by the VAD, by whether the model ran")
+
+class EnergyGate:
+    """
+    Cheap pre-gate for the VAD. Tracks the noise floor in dB (falls quickly,
+    rises slowly) and opens when a window is open_db above it, closing again
+    only after the level has stayed below close_db for hangover_ms.
+    Windows quieter than min_level_db never open the gate.
+    """
+    def __init__(self, open_db=9.0, close_db=5.0, hangover_ms=300, min_level_db=-60.0, floor_rise_db_per_s=1.5, chunk_ms=32):
+        self.open_db = open_db
+        self.close_db = close_db
+        self.hangover_chunks = int(hangover_ms / chunk_ms)
+        self.min_level_db = min_level_db
+        self.floor_rise_db = floor_rise_db_per_s * chunk_ms / 1000
+
+        self.floor_db = min_level_db
+        self.is_open = False
+        self.hangover = 0
+
+    def update(self, chunks):
+        # chunks: (num_chunks, samples) int16
+        power = np.mean(np.square(chunks, dtype=np.float32), axis=1) / (32768.0 ** 2)
+        levels_db = 10 * np.log10(power + 1e-12)
+
+        gate_open = np.zeros(len(levels_db), dtype=bool)
+        for i, level_db in enumerate(levels_db):
+            if level_db < self.floor_db:
+                self.floor_db += 0.5 * (level_db - self.floor_db)
+            else:
+                self.floor_db += self.floor_rise_db
+            self.floor_db = max(self.floor_db, self.min_level_db - 20)
+
+            above_floor = level_db - self.floor_db
+            if level_db >= self.min_level_db and (above_floor >= self.open_db or (self.is_open and above_floor >= self.close_db)):
+                self.is_open = True
+                self.hangover = self.hangover_chunks
+            elif self.hangover > 0:
+                self.hangover -= 1
+            else:
+                self.is_open = False
+            gate_open[i] = self.is_open
+        return gate_open
+
 
 class DetectSpeechSileroVADProvider:
-    def __init__(self):
+    def __init__(self, vad_gate=None, preroll_ms=300):
         # torch.set_num_threads(1)
         # self.vad_model, _ = torch.hub.load(
         #     'snakers4/silero-vad', 'silero_vad', verbose=False
         # )
         self.vad_model = SileroVAD()
 
-        self.audio_history = np.array([], dtype=np.int16) 
+        # The utterance is kept as a list of frames and only joined when it is
+        # read, so splicing in the pre-roll just appends references.
+        self.audio_segments = []
+        self.audio_length = 0
+        self.joined_audio = None
         self.speaking_history = []
 
         self.CHUNKSIZE = 1536
         self.SAMPLERATE = 16000
 
+        # frames that weren't speech, spliced in front of the next speech so
+        # the VAD's reaction time doesn't clip the first syllable
+        self.preroll = collections.deque(maxlen=int(np.ceil(preroll_ms / 1000 * self.SAMPLERATE / self.CHUNKSIZE)))
+
+        # vad_gate is the "vad_gate" config section, see EnergyGate
+        vad_gate = dict(vad_gate or {})
+        self.energy_gate = EnergyGate(**{k: v for k, v in vad_gate.items() if k not in ("enabled", "warmup_chunks", "reset_after_s")}) if vad_gate.get("enabled") else None
+        # the last few windows skipped by the gate, replayed through the model
+        # when it reopens so the recurrent state matches the audio again
+        warmup_chunks = vad_gate.get("warmup_chunks", 2)
+        self.skipped_chunks = collections.deque(maxlen=warmup_chunks + 1)
+        self.skipped_count = 0
+        self.reset_after_chunks = int(vad_gate.get("reset_after_s", 5) * self.SAMPLERATE / _CHUNK_SAMPLES)
+
+    def _infer_chunks(self, chunks):
+        if self.energy_gate is None:
+            VAD_CHUNKS.inc(len(chunks), result="inferred")
+            return [self.vad_model.process_array(chunk) for chunk in chunks]
+
+        probabilities = []
+        for chunk, is_open in zip(chunks, self.energy_gate.update(chunks)):
+            if not is_open:
+                self.skipped_chunks.append(chunk)
+                self.skipped_count += 1
+                probabilities.append(0.0)
+                VAD_CHUNKS.inc(result="skipped")
+                continue
+
+            if self.skipped_chunks:
+                if self.skipped_count > self.reset_after_chunks:
+                    self.vad_model.reset_state()
+                warmup = list(self.skipped_chunks)
+                if len(warmup) == self.skipped_chunks.maxlen:
+                    # the oldest kept window only provides the model context
+                    self.vad_model.set_context(warmup.pop(0))
+                for warmup_chunk in warmup:
+                    self.vad_model.process_array(warmup_chunk)
+                VAD_CHUNKS.inc(len(warmup), result="warmup")
+                self.skipped_chunks.clear()
+                self.skipped_count = 0
+
+            probabilities.append(self.vad_model.process_array(chunk))
+            VAD_CHUNKS.inc(result="inferred")
+        return probabilities
+
     def feed_audio(self, buffer):
         audio = np.frombuffer(buffer, dtype=np.int16)
-        chunks = np.split(audio, 3)  # 1536 / 3 = 512 samples per chunk
-        is_speaking_arr = []
-        for chunk in chunks:
-            # print(f"[VAD] Feeding audio of shape: {chunk.shape}")
-            # is_speaking_arr.append(self.vad_model(chunk, 16000).item())
-            is_speaking_arr.append(self.vad_model.process_array(chunk))
+        chunks = audio.reshape(3, -1)  # 1536 / 3 = 512 samples per chunk
+        is_speaking_arr = self._infer_chunks(chunks)
         is_speaking = np.mean(is_speaking_arr)
 
         # is_speaking = self.vad_model(tensor, 16000).item()
         if is_speaking >= 0.2:
-            self.audio_history = np.concatenate((self.audio_history, audio))
+            while self.preroll:
+                self._append_audio(self.preroll.popleft())
+            self._append_audio(audio)
+        elif self.preroll.maxlen:
+            self.preroll.append(audio)
 
         self.speaking_history.append(is_speaking)
 
-        if len(self.audio_history) < self.SAMPLERATE * 0.25:
-            pass
-
         self.speaking_history = self.speaking_history[-int((self.SAMPLERATE / self.CHUNKSIZE) * 0.5):]
 
+    def _append_audio(self, audio):
+        self.audio_segments.append(audio)
+        self.audio_length += len(audio)
+        self.joined_audio = None
+
+    def seed_preroll(self, audio):
+        # audio that came just before this provider started listening
+        self.preroll.clear()
+        if self.preroll.maxlen and len(audio):
+            self.preroll.append(audio)
+
     def get_audio(self):
-        return self.audio_history
+        if self.joined_audio is None:
+            self.joined_audio = np.concatenate(self.audio_segments) if self.audio_segments else np.array([], dtype=np.int16)
+        return self.joined_audio
+
+    def get_audio_length(self):
+        return self.audio_length
     
     def clear_audio(self):
-        self.audio_history = np.array([], dtype=np.int16)
+        self.audio_segments = []
+        self.audio_length = 0
+        self.joined_audio = None
+        self.preroll.clear()
 
     def is_speaking(self):
         avg_speaking = np.mean(self.speaking_history)
@@ -50,6 +164,11 @@ class DetectSpeechSileroVADProvider:
     def is_done_speaking(self):
         avg_speaking = np.mean(self.speaking_history)
         return avg_speaking < 0.7
+
+    def is_pausing(self, pause_frames=1, pause_threshold=0.3):
+        # a short gap (pause_frames 96 ms frames) that may or may not be the end of the query
+        recent = self.speaking_history[-pause_frames:]
+        return len(recent) == pause_frames and max(recent) < pause_threshold
     
     def stop(self):
         pass
@@ -78,6 +197,12 @@ class SileroVAD:
         self._state = np.zeros((2, 1, 128), dtype=np.float32)
         self._sr = np.array(_RATE, dtype=np.int64)
 
+    def reset_state(self):
+        self._state = np.zeros((2, 1, 128), dtype=np.float32)
+
+    def set_context(self, audio_array):
+        self._context = (audio_array[-_CONTEXT_SIZE:].astype(np.float32) / 32768.0)[np.newaxis, :]
+
     def process_array(self, audio_array: np.ndarray) -> float:
         audio_array = audio_array.astype(np.float32) / 32768.0
 
@@ -97,7 +222,9 @@ class SileroVAD:
             "state": self._state,
             "sr": self._sr,
         }
+        start_time = time.perf_counter()
         ort_outs = self.session.run(None, ort_inputs)
+        VAD_INFERENCE_SECONDS.observe(time.perf_counter() - start_time)
         out, self._state = ort_outs
 
         return out.squeeze()
\ No newline at end of file
@@ -7,16 +7,37 @@ import asyncio
 import numpy as np
 
 from ...speech.detect_speech_provider.vad import DetectSpeechSileroVADProvider
+from ... import metrics
+
+WAKE_WORD_INFERENCE_SECONDS = metrics.histogram("lucy_wake_word_inference_seconds", "openWakeWord inference time per prediction")
 
 class DetectWakeWordProvider(DetectSpeechSileroVADProvider):
-    def __init__(self, wake_word="alexa", wake_word_detection_callback=None):
-        super().__init__()
+    """
+    wake_words is a list of openWakeWord model names or paths, or of dicts
+    with "model" and optionally "name", "threshold" (mean score needed over
+    the window) and "window" (number of predictions). All models share one
+    melspectrogram and embedding pass, so each extra one only adds its small
+    classifier head.
+    """
+    def __init__(self, wake_words=["alexa"], wake_word_detection_callback=None, vad_gate=None, preroll_ms=300):
+        super().__init__(vad_gate=vad_gate, preroll_ms=preroll_ms)
+        self.preroll_samples = int(self.SAMPLERATE * preroll_ms / 1000)
         self.wake_word_audio_buffer = np.array([], dtype=np.int16)
 
+        wake_words = [{"model": w} if isinstance(w, str) else w for w in wake_words]
+
         openwakeword.utils.download_models()
-        self.wake_word_model = Model(wakeword_models=[wake_word], inference_framework="onnx")
-        self.wake_word_likelyhood_history = []
-        self.wake_word = wake_word
+        self.wake_word_model = Model(wakeword_models=[w["model"] for w in wake_words], inference_framework="onnx")
+        # prediction keys come back in the order the models were given
+        self.model_keys = list(self.wake_word_model.models.keys())
+        self.wake_words = [w.get("name", key) for w, key in zip(wake_words, self.model_keys)]
+        self.thresholds = np.array([w.get("threshold", 0.2) for w in wake_words])
+        self.windows = np.array([w.get("window", 5) for w in wake_words])
+
+        # newest prediction last, one row per wake word
+        self.wake_word_likelyhood_history = np.zeros((len(wake_words), self.windows.max()))
+        self.prediction_count = 0
+        self.detected_wake_word = None
 
         self.last_triggered_time = 0
 
@@ -43,22 +64,35 @@ class DetectWakeWordProvider(DetectSpeechSileroVADProvider):
             
             wake_word_detection_audio = self.wake_word_audio_buffer[-int(self.SAMPLERATE * 0.4):]
 
-            prediction = self.wake_word_model.predict(wake_word_detection_audio)[self.wake_word]
-            self.wake_word_likelyhood_history.append(prediction)
+            start_time = time.perf_counter()
+            prediction = self.wake_word_model.predict(wake_word_detection_audio)
+            WAKE_WORD_INFERENCE_SECONDS.observe(time.perf_counter() - start_time, models=str(len(self.model_keys)))
 
-            if len(self.wake_word_likelyhood_history) < 5:
+            history = np.roll(self.wake_word_likelyhood_history, -1, axis=1)
+            history[:, -1] = [prediction[key] for key in self.model_keys]
+            self.wake_word_likelyhood_history = history
+            self.prediction_count += 1
+
+            if self.prediction_count < self.windows.min():
                 await asyncio.sleep(0.1)
                 continue
-            if len(self.wake_word_likelyhood_history) > 5:
-                self.wake_word_likelyhood_history = self.wake_word_likelyhood_history[-5:]
-            total = sum(self.wake_word_likelyhood_history)
-            self.wake_word_detected = total >= 1
 
-            if self.wake_word_detected:
-                print(f"[WAKE WORD DETECTED] {self.wake_word_detected}, {len(self.wake_word_audio_buffer)} samples, {total} likelyhood")
+            # mean of each wake word's last `window` predictions
+            totals = np.cumsum(history[:, ::-1], axis=1)[np.arange(len(self.windows)), self.windows - 1]
+            scores = np.where(self.prediction_count >= self.windows, totals / self.windows, 0)
+            triggered = scores >= self.thresholds
+
+            if triggered.any():
+                best = int(np.argmax(np.where(triggered, scores / self.thresholds, 0)))
+                self.detected_wake_word = self.wake_words[best]
+                self.wake_word_detected = True
+                print(f"[WAKE WORD DETECTED] {self.detected_wake_word}, {len(self.wake_word_audio_buffer)} samples, {scores[best]:.2f} likelyhood")
+                # whatever was said while the detector made up its mind, a view
+                # into the buffer which is replaced rather than modified later
+                self.seed_preroll(self.wake_word_audio_buffer[-self.preroll_samples:] if self.preroll_samples else self.wake_word_audio_buffer[:0])
                 self.last_triggered_time = time.time()
                 if self.wake_word_detection_callback:
-                    await self.wake_word_detection_callback()
+                    await self.wake_word_detection_callback(self.detected_wake_word)
 
             await asyncio.sleep(0.01)
 
@@ -84,12 +118,13 @@ class DetectWakeWordProvider(DetectSpeechSileroVADProvider):
         super().clear_audio()
 
         self.wake_word_audio_buffer = np.array([], dtype=np.int16)
-        self.wake_word_likelyhood_history = []
+        self.wake_word_likelyhood_history[:] = 0
+        self.prediction_count = 0
 
         self.wake_word_detected = False
+        self.detected_wake_word = None
         self.wake_word_model.reset()
             
     def stop(self):
         self.is_closing = True
-        self.wake_word_check_thread.join()
         super().stop()
\ No newline at end of file
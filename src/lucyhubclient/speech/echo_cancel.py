@@ -0,0 +1,138 @@
+import collections
+import time
+
+import numpy as np
+
+from .. import metrics
+
+AEC_PROCESS_SECONDS = metrics.histogram("lucy_aec_process_seconds", "Echo cancellation time per microphone frame")
+AEC_ERLE_DB = metrics.gauge("lucy_aec_erle_db", "Echo return loss enhancement over the last frame")
+
+class EchoCanceller:
+    """
+    Removes the hub's own playback from the microphone signal with a
+    partitioned-block frequency-domain NLMS filter (overlap-save).
+
+    The mixer thread hands every output block to push_reference() together
+    with the time it will be heard. That is only a deque append; resampling
+    to 16 kHz and alignment happen in process() on the microphone side.
+    """
+    def __init__(self, sample_rate=16000, block_size=256, num_partitions=8, step_size=0.5, bulk_delay=0.0, double_talk_threshold=1.0, history_seconds=2.0):
+        self.sample_rate = sample_rate
+        self.block_size = block_size
+        self.num_partitions = num_partitions
+        self.step_size = step_size
+        self.bulk_delay = bulk_delay
+        self.double_talk_threshold = double_talk_threshold
+        self.history_size = int(sample_rate * history_seconds)
+
+        self.pending_reference = collections.deque()
+        self.decimation_remainder = np.zeros(0, dtype=np.float32)
+
+        # far-end history at 16 kHz and the time its last sample is heard
+        self.reference_history = np.zeros(self.history_size, dtype=np.float32)
+        self.reference_end_time = None
+
+        num_bins = block_size + 1
+        self.weights = np.zeros((num_partitions, num_bins), dtype=np.complex64)
+        self.reference_spectra = np.zeros((num_partitions, num_bins), dtype=np.complex64)
+        self.reference_power = None
+        self.previous_reference_block = np.zeros(block_size, dtype=np.float32)
+
+    def push_reference(self, chunk, play_time):
+        # called from the mixer thread, keep it to a single append
+        self.pending_reference.append((chunk, play_time))
+
+    def _drain_reference(self):
+        blocks = []
+        while self.pending_reference:
+            chunk, play_time = self.pending_reference.popleft()
+            blocks.append(chunk)
+            self.reference_end_time = play_time
+        if not blocks:
+            return
+
+        # 48 kHz stereo int32 -> 16 kHz mono float, averaging each group of
+        # three samples doubles as a cheap anti-aliasing filter
+        mono = np.concatenate(blocks).mean(axis=1, dtype=np.float32) / 2147483648.0
+        mono = np.concatenate((self.decimation_remainder, mono))
+        usable = len(mono) - len(mono) % 3
+        self.decimation_remainder = mono[usable:]
+        decimated = mono[:usable].reshape(-1, 3).mean(axis=1)
+        # the leftover samples haven't made it into the history yet
+        self.reference_end_time -= len(self.decimation_remainder) / (3 * self.sample_rate)
+
+        if len(decimated) >= self.history_size:
+            self.reference_history = decimated[-self.history_size:].copy()
+        else:
+            self.reference_history = np.roll(self.reference_history, -len(decimated))
+            self.reference_history[-len(decimated):] = decimated
+
+    def _aligned_reference(self, num_samples, capture_time):
+        if self.reference_end_time is None:
+            return None
+        # the last mic sample was captured at capture_time; find the far-end
+        # sample that was playing at that moment
+        lag = int(round((self.reference_end_time - capture_time + self.bulk_delay) * self.sample_rate))
+        end = self.history_size - lag
+        start = end - num_samples
+        if start < 0 or end > self.history_size:
+            return None
+        return self.reference_history[start:end]
+
+    def process(self, buffer, capture_time=None):
+        start_time = time.perf_counter()
+        if capture_time is None:
+            capture_time = time.monotonic()
+
+        self._drain_reference()
+
+        mic = np.frombuffer(buffer, dtype=np.int16).astype(np.float32) / 32768.0
+        reference = self._aligned_reference(len(mic), capture_time)
+        if reference is None or len(mic) % self.block_size != 0:
+            return buffer
+
+        output = np.empty_like(mic)
+        for start in range(0, len(mic), self.block_size):
+            end = start + self.block_size
+            output[start:end] = self._process_block(mic[start:end], reference[start:end])
+
+        mic_energy = float(np.dot(mic, mic))
+        out_energy = float(np.dot(output, output))
+        if mic_energy > 1e-6:
+            AEC_ERLE_DB.set(10 * np.log10(mic_energy / (out_energy + 1e-12)))
+        AEC_PROCESS_SECONDS.observe(time.perf_counter() - start_time)
+
+        return (np.clip(output, -1, 1) * 32767).astype(np.int16).tobytes()
+
+    def _process_block(self, mic_block, reference_block):
+        N = self.block_size
+
+        reference_spectrum = np.fft.rfft(np.concatenate((self.previous_reference_block, reference_block)))
+        self.previous_reference_block = reference_block
+        self.reference_spectra = np.roll(self.reference_spectra, 1, axis=0)
+        self.reference_spectra[0] = reference_spectrum
+
+        echo_estimate = np.fft.irfft((self.reference_spectra * self.weights).sum(axis=0), n=2 * N)[N:]
+        error = mic_block - echo_estimate
+
+        # Only adapt while the far end is active and the near end is quiet
+        # (Geigel double-talk detector), otherwise the filter learns the user.
+        # The threshold depends on the speaker to mic gain of the hardware.
+        reference_peak = np.max(np.abs(self.reference_history[-N * self.num_partitions:]))
+        near_end_talking = np.max(np.abs(mic_block)) > self.double_talk_threshold * reference_peak
+        if reference_peak > 1e-4 and not near_end_talking:
+            block_power = np.abs(reference_spectrum) ** 2
+            if self.reference_power is None:
+                self.reference_power = block_power
+            else:
+                self.reference_power = 0.9 * self.reference_power + 0.1 * block_power
+            error_spectrum = np.fft.rfft(np.concatenate((np.zeros(N, dtype=np.float32), error)))
+            gradient = np.conj(self.reference_spectra) * error_spectrum / (self.num_partitions * self.reference_power + 1e-6)
+
+            # gradient constraint: keep each partition a causal N-tap filter
+            gradient_time = np.fft.irfft(gradient, n=2 * N, axis=1)
+            gradient_time[:, N:] = 0
+            self.weights += self.step_size * np.fft.rfft(gradient_time, axis=1).astype(np.complex64)
+
+        return error
@@ -1,10 +1,13 @@
-import pyaudio
+import math
 import threading
 import time
 import requests
 import asyncio
 
 from ..config import get_http_url
+from .audio_source import open_microphones
+from .. import metrics
+from ..tracing import TRACER
 from enum import Enum
 
 class RequestType(str):
@@ -12,37 +15,38 @@ class RequestType(str):
     NOT_QUERY = "not_query"
     INCOMPLETE_QUERY = "incomplete_query"
 
+TRANSCRIBE_SECONDS = metrics.histogram("lucy_transcribe_seconds", "Round trip time of /v1/meewhee/transcribe requests")
+SPECULATIVE_TRANSCRIPTIONS = metrics.counter("lucy_speculative_transcriptions_total", "Transcriptions started at a pause, by whether the final result reused them")
+
+def _consume_exception(task):
+    if not task.cancelled():
+        task.exception()
+
 class VoiceAssistant:
-    def __init__(self, detect_speech_provider, mic_list=[], start_speaking_callback=None, end_speaking_callback=None):
+    def __init__(self, detect_speech_provider, mic_list=[], start_speaking_callback=None, end_speaking_callback=None, audio_source=None, http_url=None, echo_canceller=None, speculative_transcription=True, microphone_mode="select", speculative_pause_ms=250):
         self.CHUNKSIZE = 1536
         self.SAMPLERATE = 16000
 
         self.attempts = 0
 
-        p = pyaudio.PyAudio()
-
-        def find_device_by_name(name):
-            for i in range(p.get_device_count()):
-                info = p.get_device_info_by_index(i)
-                if name.lower() in info['name'].lower():
-                    return i
-            return None
-
-        device_index = None
-        for mic_name in mic_list:
-            device_index = find_device_by_name(mic_name)
-            if device_index is not None:
-                print(f"[AUDIO] Using microphone: {mic_name} (index {device_index})")
-                break
-        
-        if device_index is None:
-            print("[AUDIO] No microphone found, using default device")
-            device_index = p.get_default_input_device_info()['index']
-
-        self.stream = p.open(format=pyaudio.paInt16, channels=1, rate=self.SAMPLERATE,input=True, frames_per_buffer=self.CHUNKSIZE, input_device_index=device_index)
+        if audio_source is None:
+            audio_source = open_microphones(mic_list, sample_rate=self.SAMPLERATE, chunk_size=self.CHUNKSIZE, mode=microphone_mode)
+        self.audio_source = audio_source
+        self.http_url = http_url
+        self.echo_canceller = echo_canceller
 
         self.current_conversation_response_nonce = 0
 
+        # Transcription started at a short pause, as (nonce, samples, task).
+        # If the user stops for good without saying anything more it becomes
+        # the final transcription and its latency hides in the silence.
+        self.speculative_transcription = speculative_transcription
+        # how long a gap has to last to start one, in whole VAD frames
+        self.speculative_pause_frames = max(1, math.ceil(speculative_pause_ms / 1000 * self.SAMPLERATE / self.CHUNKSIZE))
+        self.pending_transcription = None
+        self.awake = False
+        self.try_transcribe = False
+
         self.start_speaking_callback = start_speaking_callback
         self.end_speaking_callback = end_speaking_callback
 
@@ -56,35 +60,79 @@ class VoiceAssistant:
         asyncio.create_task(self._transcribe_loop())
 
     async def _loop(self):
-        self.awake = False
-        self.can_try_transcribe = False
 
         while True:
             if self.is_closing:
-                self.stream.stop_stream()
-                self.stream.close()
+                self.audio_source.close()
                 return
             
             await asyncio.sleep(0.01)
             
-            data = self.stream.read(self.CHUNKSIZE, exception_on_overflow=False)
+            data = self.audio_source.read(self.CHUNKSIZE)
+            if self.echo_canceller is not None:
+                data = self.echo_canceller.process(data, time.monotonic() - self.audio_source.latency)
             self.detect_speech_provider.feed_audio(data)
 
             if self.detect_speech_provider.is_speaking() and not self.awake:
                 print("[AUDIO] User started speaking")
+                TRACER.mark("user_speaking", once=True)
                 if self.start_speaking_callback != None:
                     asyncio.create_task(self.start_speaking_callback())
                 self.awake = True
+                self.audio_source.lock_selection(True)
                 self.last_transcription_submitted_time = float('inf')
             elif self.detect_speech_provider.is_done_speaking() and self.awake:
                 print("[AUDIO] User finished speaking")
+                TRACER.mark("user_done")
                 self.awake = False
+                self.audio_source.lock_selection(False)
                 self.try_transcribe = True
-
+            elif self.awake and self.speculative_transcription and self.detect_speech_provider.is_pausing(pause_frames=self.speculative_pause_frames):
+                audio_length = self.detect_speech_provider.get_audio_length()
+                already_sent = self.pending_transcription is not None and self.pending_transcription[1] == audio_length
+                if not already_sent and audio_length >= self.SAMPLERATE * 0.25:
+                    if self.pending_transcription is not None:
+                        # the user went on talking, this one won't be used
+                        SPECULATIVE_TRANSCRIPTIONS.inc(result="discarded")
+                    self.pending_transcription = self._start_transcription(self.detect_speech_provider.get_audio())
+
+
+    def _start_transcription(self, audio):
+        # Bumping the nonce supersedes every earlier transcription, their
+        # results are dropped when they arrive.
+        self.current_conversation_response_nonce += 1
+        task = asyncio.create_task(asyncio.to_thread(self._transcribe, audio, TRACER.current_id()))
+        # superseded speculations are never awaited, don't let their
+        # failures end up as "Task exception was never retrieved"
+        task.add_done_callback(_consume_exception)
+        return (self.current_conversation_response_nonce, len(audio), task)
+
+    def _transcribe(self, audio, trace_id=None):
+        # transcription = self.transcription_provider.transcribe(audio)
+        # request_type = self.request_classifier.classify(transcription) if transcription else RequestType.NOT_QUERY
+        url = f'{self.http_url or get_http_url()}/v1/meewhee/transcribe'
+        start_time = time.perf_counter()
+        headers = {"Content-Type": "application/octet-stream"}
+        if trace_id is not None:
+            headers["X-Lucy-Trace-Id"] = trace_id
+        response = requests.post(url, data=audio.tobytes(), headers=headers)
+        response = response.json()
+        TRANSCRIBE_SECONDS.observe(time.perf_counter() - start_time)
+
+        transcription = response["transcription"]
+        request_type = response["classification"]
+
+        if request_type == "query":
+            request_type = RequestType.QUERY
+        elif request_type == "not_query":
+            request_type = RequestType.NOT_QUERY
+        elif request_type == "incomplete_query":
+            request_type = RequestType.INCOMPLETE_QUERY
+
+        return transcription, request_type
 
     async def _transcribe_loop(self):
         self.last_transcription = ""
-        self.try_transcribe = False
 
         while True:
             if self.is_closing:
@@ -94,35 +142,39 @@ class VoiceAssistant:
                 continue
             self.try_transcribe = False
 
-            self.current_conversation_response_nonce += 1
-
             audio = self.detect_speech_provider.get_audio()
-            if len(audio) < self.SAMPLERATE * 0.25:
+            pending = self.pending_transcription
+            self.pending_transcription = None
+
+            if pending is not None and pending[1] == len(audio) and pending[0] == self.current_conversation_response_nonce:
+                SPECULATIVE_TRANSCRIPTIONS.inc(result="reused")
+                nonce, _, task = pending
+            else:
+                if pending is not None:
+                    SPECULATIVE_TRANSCRIPTIONS.inc(result="discarded")
+                if len(audio) < self.SAMPLERATE * 0.25:
+                    self.current_conversation_response_nonce += 1
+                    continue
+                nonce, _, task = self._start_transcription(audio)
+
+            try:
+                transcription, request_type = await task
+            except Exception as e:
+                print(f"[TRANSCRIPTION] Request failed: {e}")
                 continue
 
-            # transcription = self.transcription_provider.transcribe(audio)
-            # request_type = self.request_classifier.classify(transcription) if transcription else RequestType.NOT_QUERY
-            url = f'{get_http_url()}/v1/meewhee/transcribe'
-            response = requests.post(url, data=audio.tobytes(), headers={"Content-Type": "application/octet-stream"})
-            response = response.json()
-
-            transcription = response["transcription"]
-            request_type = response["classification"]
-
-            if request_type == "query":
-                request_type = RequestType.QUERY
-            elif request_type == "not_query":
-                request_type = RequestType.NOT_QUERY
-            elif request_type == "incomplete_query":
-                request_type = RequestType.INCOMPLETE_QUERY
+            if nonce != self.current_conversation_response_nonce:
+                print("[INTERRUPTED] Transcription superseded, skipping")
+                continue
 
             print(f"[TRANSCRIPTION] {transcription} (request_type={request_type})")
+            TRACER.mark("transcribed")
             if request_type == RequestType.QUERY:        
                 # self._generate_response(transcription, self.current_conversation_response_nonce, time.time())
-                asyncio.create_task(self._generate_response(transcription, self.current_conversation_response_nonce, time.time()))
+                asyncio.create_task(self._generate_response(transcription, nonce, time.time()))
             elif request_type == RequestType.INCOMPLETE_QUERY:
                 extra_time = 0
-                asyncio.create_task(self._generate_response(transcription, self.current_conversation_response_nonce, time.time() + extra_time))
+                asyncio.create_task(self._generate_response(transcription, nonce, time.time() + extra_time))
             elif request_type == RequestType.NOT_QUERY:
                 # self._generate_response(None, self.current_conversation_response_nonce, time.time())
                 pass
@@ -142,13 +194,8 @@ class VoiceAssistant:
     def stop(self):
         print("[AUDIO] Stopping...")
         self.is_closing = True
-        print("[AUDIO] Waiting for VAD thread to join...")
-        self.vad_loop_thread.join()
-        print("[AUDIO] Waiting for transcription thread to join...")
-        self.transcribe_loop_thread.join()
 
         print("[AUDIO] Closing VAD provider")
         self.detect_speech_provider.stop()
 
         print("[AUDIO] Stopped")
-    
\ No newline at end of file
@@ -8,20 +8,20 @@ import soundfile as sf
 from ..sound import Sound, LoopPlaybackModifier, FadeOutEffect, FadeInEffect
 
 class LClockClient(LucyClientModule):
-    def __init__(self):
-        super().__init__("clock")
+    def __init__(self, context):
+        super().__init__("clock", context)
 
         timer_audio_path = resources.files("lucyhubclient.tools.clock_util").joinpath("alarm.wav")
         if not os.path.exists(timer_audio_path):
             raise FileNotFoundError(f"Timer audio file not found at {timer_audio_path}")
         
-        audio_data, audio_sr = sf.read(timer_audio_path, dtype='int16')
+        audio_frames = sf.info(str(timer_audio_path)).frames
 
         self.timer_sound_id = None
         
         self.timer_audio_path = timer_audio_path
-        self.loop_start_pos = int(len(audio_data) / 3)
-        self.loop_end_pos = int(len(audio_data) * 2 / 3)
+        self.loop_start_pos = int(audio_frames / 3)
+        self.loop_end_pos = int(audio_frames * 2 / 3)
         # loop between 1/3 and 2/3 of the audio data
 
 
@@ -29,11 +29,15 @@ class LClockClient(LucyClientModule):
         if message["message"] == "START_TIMER_SOUND":
             if self.timer_sound_id is not None:
                 return
-            sound = Sound.from_wav(self.timer_audio_path)
+            sound = Sound.from_wav(self.timer_audio_path, stream=True)
             sound.add_effect(FadeInEffect(48000))
             sound.add_playback_modifier(LoopPlaybackModifier(loop_start_frame=self.loop_start_pos, loop_end_frame=self.loop_end_pos))
+            # if the mixer lets go of it for any reason, the next
+            # START_TIMER_SOUND has to be able to start a new one
+            loop = asyncio.get_running_loop()
+            sound.removed_callback = lambda sound_id=sound.get_id(): loop.call_soon_threadsafe(self._on_timer_sound_removed, sound_id)
             self.timer_sound_id = sound.get_id()
-            self.sound_manager.add_sound(sound)
+            self.sound_manager.add_sound(sound, bus="alarm")
 
         elif message["message"] == "STOP_TIMER_SOUND":
             if self.timer_sound_id is None:
@@ -41,9 +45,15 @@ class LClockClient(LucyClientModule):
             sound = self.sound_manager.add_effect_to_sound(self.timer_sound_id, FadeOutEffect(48000))
             self.timer_sound_id = None
 
+    def _on_timer_sound_removed(self, sound_id):
+        if self.timer_sound_id == sound_id:
+            self.timer_sound_id = None
+
 
 if __name__ == "__main__":
-    client = LClockClient()
+    from ..sound import SoundManager
+    from .registry import ToolContext
+    client = LClockClient(ToolContext(sound_manager=SoundManager()))
     asyncio.run(client.handle_message({
         "message": "START_TIMER_SOUND"
     }))
@@ -2,13 +2,26 @@ import json
 from ..sound import SoundManager
 
 class LucyClientModule:
+    """
+    Base of the client side of a server tool. Modules are registered under
+    the "lucyhubclient.tools" entry point group and built by the
+    ToolRegistry with a ToolContext on the first message for their tool.
+    """
+    def __init__(self, name, context):
+        self.name = name
+        self.context = context
 
-    websocket_client = None
-    lucy_webview = None
-    sound_manager: SoundManager = None
+    @property
+    def websocket_client(self):
+        return self.context.websocket_client
 
-    def __init__(self, name):
-        self.name = name
+    @property
+    def lucy_webview(self):
+        return self.context.lucy_webview
+
+    @property
+    def sound_manager(self) -> SoundManager:
+        return self.context.sound_manager
 
     def get_lucy_webview(self):
         return self.lucy_webview
@@ -20,6 +33,13 @@ class LucyClientModule:
         """
         raise NotImplementedError("Subclasses must implement handle_message method.")
     
+    async def warm_up(self):
+        """
+        Optional. Runs in the background shortly after startup, for work
+        that would otherwise slow down the first message.
+        """
+        pass
+
     async def send_socket_message(self, data):
         await self.websocket_client.send_tool_message(self.name, data)
 
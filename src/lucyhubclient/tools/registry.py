@@ -0,0 +1,91 @@
+import asyncio
+from importlib.metadata import entry_points, EntryPoint
+
+from .lucy_client_module import LucyClientModule
+
+ENTRY_POINT_GROUP = "lucyhubclient.tools"
+
+# used when running from a source checkout without installed metadata
+BUILTIN_TOOLS = {
+    "spotify": "lucyhubclient.tools.spotify:LSpotifyClient",
+    "clock": "lucyhubclient.tools.clock:LClockClient",
+}
+
+class ToolContext:
+    """What client modules get to talk to the rest of the hub through."""
+    def __init__(self, websocket_client=None, lucy_webview=None, sound_manager=None):
+        self.websocket_client = websocket_client
+        self.lucy_webview = lucy_webview
+        self.sound_manager = sound_manager
+
+class ToolRegistry:
+    """
+    Client modules by tool name, found through the "lucyhubclient.tools"
+    entry point group. Only names on the allowlist are loaded, each on the
+    first message for it. start_warm_up() loads the ones that have a
+    warm_up hook in the background once the hub is up.
+    """
+    def __init__(self, context, allowed):
+        self.context = context
+        self.allowed = list(allowed)
+        self.entry_points = {name: EntryPoint(name, value, ENTRY_POINT_GROUP) for name, value in BUILTIN_TOOLS.items()}
+        self.entry_points.update({entry_point.name: entry_point for entry_point in entry_points(group=ENTRY_POINT_GROUP)})
+        self.modules = {}
+        self.loading = {}
+
+        for name in self.allowed:
+            if name not in self.entry_points:
+                print(f"[TOOLS] No module provides the '{name}' tool")
+
+    async def get(self, name):
+        """The module for a tool, loaded if need be. None if it can't be."""
+        if name in self.modules:
+            return self.modules[name]
+        if name not in self.allowed or name not in self.entry_points:
+            print(f"[TOOLS] Ignoring message for tool '{name}', it isn't enabled")
+            return None
+
+        # concurrent callers wait on the same load
+        if name not in self.loading:
+            self.loading[name] = asyncio.ensure_future(self._load(name))
+        module = await asyncio.shield(self.loading[name])
+        # a failed load is tried again on the next message
+        self.loading.pop(name, None)
+        return module
+
+    async def _load(self, name):
+        try:
+            # importing is the slow part, keep it off the loop
+            module_class = await asyncio.to_thread(self.entry_points[name].load)
+            module = module_class(self.context)
+        except Exception as e:
+            print(f"[TOOLS] Failed to load the '{name}' tool: {e!r}")
+            return None
+        self.modules[name] = module
+        print(f"[TOOLS] Loaded the '{name}' tool")
+        return module
+
+    def start_warm_up(self, delay=2.0):
+        return asyncio.ensure_future(self._warm_up(delay))
+
+    async def _warm_up(self, delay):
+        # after startup, not during it
+        await asyncio.sleep(delay)
+        for name in self.allowed:
+            if name not in self.entry_points or name in self.modules:
+                continue
+            try:
+                module_class = await asyncio.to_thread(self.entry_points[name].load)
+            except Exception as e:
+                print(f"[TOOLS] Failed to load the '{name}' tool: {e!r}")
+                continue
+            if module_class.warm_up is LucyClientModule.warm_up:
+                continue
+
+            module = await self.get(name)
+            if module is None:
+                continue
+            try:
+                await module.warm_up()
+            except Exception as e:
+                print(f"[TOOLS] Warming up the '{name}' tool failed: {e!r}")
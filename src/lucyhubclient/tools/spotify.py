@@ -1,42 +1,121 @@
 from ..tools.lucy_client_module import LucyClientModule
 import asyncio
 import os
+import time
 from ..config import get_http_url
+from .. import metrics
+
+SPOTIFY_INIT_SECONDS = metrics.histogram("lucy_spotify_init_seconds", "INIT_SPOTIFY_STREAMING to reply, by whether the player was already warm")
+SPOTIFY_CONNECT_SECONDS = metrics.histogram("lucy_spotify_connect_seconds", "Loading and connecting the web player, by reason and result")
 
 class LSpotifyClient(LucyClientModule):
-    def __init__(self):
-        super().__init__("spotify")
+    """
+    Keeps the Spotify web player loaded and connected in the kiosk's hidden
+    iframe from shortly after startup, so INIT_SPOTIFY_STREAMING normally
+    finds it ready and can answer right away. The UI pushes the player's
+    flags, a dropped player is reconnected as soon as it reports so and
+    otherwise checked every HEALTH_CHECK_INTERVAL seconds.
+    """
+    HEALTH_CHECK_INTERVAL = 30
+    RETRY_INTERVAL = 10
+    # no reply comes if the kiosk page reloads or drops mid-call
+    JAVASCRIPT_TIMEOUT = 2
 
-    async def handle_message(self, message):
-        if message["message"] == "INIT_SPOTIFY_STREAMING":
-            self.log("Initializing Spotify streaming...")
-            start_time = asyncio.get_event_loop().time()
-            url = f'{get_http_url()}/v1/meewhee/module/spotify/web_player'
-            iframe_url = await self.get_lucy_webview().run_javascript(f"LucyHub.getIFrameURL()")
-            print(f"Current iframe URL: {iframe_url}")
+    def __init__(self, context):
+        super().__init__("spotify", context)
+        self.connect_lock = asyncio.Lock()
+        self.keep_warm_task = None
+
+    def get_player_url(self):
+        return f'{get_http_url()}/v1/meewhee/module/spotify/web_player'
+
+    def is_ready(self):
+        return self.lucy_webview.get_flag("spotify_ready") is True
+
+    async def warm_up(self):
+        self.keep_warm_task = asyncio.ensure_future(self._keep_warm())
+
+    async def _keep_warm(self):
+        while True:
+            try:
+                if not await self.ensure_ready("prewarm"):
+                    await asyncio.sleep(self.RETRY_INTERVAL)
+                    continue
+                # wakes as soon as the player drops, e.g. the kiosk reloaded
+                dropped = await self.lucy_webview.wait_for_flag("spotify_ready", False, timeout=self.HEALTH_CHECK_INTERVAL)
+                if not dropped and not await self._check_health():
+                    self.log("Web player failed its health check, reconnecting.")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.log(f"Keeping the web player warm failed: {e!r}")
+                await asyncio.sleep(self.RETRY_INTERVAL)
+
+    async def _run_javascript(self, script, forget=False):
+        return await asyncio.wait_for(self.lucy_webview.run_javascript(script, forget=forget), self.JAVASCRIPT_TIMEOUT)
+
+    async def _check_health(self):
+        # a round trip to the page, in case it hung or an event went missing
+        webview = self.lucy_webview
+        try:
+            state = await self._run_javascript("[LucyHub.getIFrameURL(), LucyHub.getFlag('spotify_ready')]")
+        except (asyncio.TimeoutError, ConnectionError):
+            state = None
+        healthy = state is not None and state[0] == self.get_player_url() and state[1] is True
+        if not healthy:
+            webview.forget_flag("spotify_ready")
+        return healthy
+
+    async def ensure_ready(self, reason):
+        async with self.connect_lock:
+            if self.is_ready():
+                return True
+            start_time = time.monotonic()
+            is_ready = await self._connect_player()
+            SPOTIFY_CONNECT_SECONDS.observe(time.monotonic() - start_time, reason=reason, result="ready" if is_ready else "failed")
+            return is_ready
+
+    async def _connect_player(self):
+        webview = self.lucy_webview
+        if webview.client is None:
+            return False
+
+        # runs under connect_lock, so nothing in here may wait unbounded
+        try:
+            url = self.get_player_url()
+            iframe_url = await self._run_javascript("LucyHub.getIFrameURL()")
             if iframe_url != url:
-                print(f"Loading new URL: {url}")
-                await self.lucy_webview.run_javascript(f"LucyHub.loadIFrame('{url}', false)", forget=True)
-                print("Waiting for Spotify Web Playback SDK to be ready...")
-                await self.get_lucy_webview().wait_for_var(f"LucyHub.getFlag('spotify_web_playback_sdk_ready')", True, timeout=5)
-                print("Spotify Web Playback SDK is ready.")
+                self.log(f"Loading the web player from {url}")
+                # waited on, so the UI's flags_reset is in before we look at flags
+                await self._run_javascript(f"LucyHub.loadIFrame('{url}', false)")
+                if not await webview.wait_for_flag("spotify_web_playback_sdk_ready", True, timeout=5):
+                    self.log("Web Playback SDK didn't get ready within 5 seconds.")
+                    return False
 
-            print("Sending trigger to IFrame to connect...")
-            await self.lucy_webview.run_javascript("LucyHub.sendTriggerToIFrame('connect')", forget=True)
-            is_ready = await self.get_lucy_webview().wait_for_var("LucyHub.getFlag('spotify_ready')", True, timeout=3)
-            print(f"Spotify ready status: {is_ready}")
+            await self._run_javascript("LucyHub.sendTriggerToIFrame('connect')", forget=True)
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            self.log(f"Lost the kiosk page while connecting the web player: {e!r}")
+            return False
+        return await webview.wait_for_flag("spotify_ready", True, timeout=3)
 
-            end_time = asyncio.get_event_loop().time()
-            self.log(f"Spotify streaming initialized in {end_time - start_time:.2f} seconds.")
+    async def handle_message(self, message):
+        if message["message"] == "INIT_SPOTIFY_STREAMING":
+            start_time = time.monotonic()
+            was_warm = self.is_ready()
+            is_ready = await self.ensure_ready("request")
+            elapsed = time.monotonic() - start_time
+            SPOTIFY_INIT_SECONDS.observe(elapsed, warm=str(was_warm).lower())
+            self.log(f"Spotify streaming initialized in {elapsed:.2f} seconds ({'warm' if was_warm else 'cold'}).")
 
-            await asyncio.sleep(0.5)  # Allow time for the UI to update
+            if not was_warm:
+                await asyncio.sleep(0.5)  # Allow time for the UI to update
 
             if is_ready:
                 await self.send_socket_message({
                     "message": "SPOTIFY_STREAMING_INITIATED"
                 })
             else:
-                self.log("Failed to initialize Spotify streaming within 3 seconds.")
+                self.log("Failed to initialize Spotify streaming.")
                 await self.send_socket_message({
                     "message": "SPOTIFY_STREAMING_FAILED"
                 })
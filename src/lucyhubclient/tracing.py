@@ -0,0 +1,166 @@
+import asyncio
+import collections
+import json
+import os
+import threading
+import time
+import uuid
+
+import numpy as np
+
+from . import metrics
+
+STAGE_SECONDS = metrics.histogram("lucy_interaction_stage_seconds", "Time from the start of an interaction to each of its stages",
+                                  buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 1.5, 2.0, 3.0, 5.0, 7.5, 10.0, 20.0, 30.0))
+INTERACTIONS = metrics.counter("lucy_interactions_total", "Finished interaction traces, by outcome")
+
+# in the order an interaction normally goes through them, anything else
+# sorts after these
+STAGES = [
+    "wake", "user_speaking", "user_done", "transcribed", "request_sent",
+    "first_reply", "tool", "assistant", "tts_start", "first_audio",
+    "playback_start", "stream_end", "done",
+]
+
+def new_trace_id():
+    return uuid.uuid4().hex[:16]
+
+class InteractionTracer:
+    """
+    Follows one interaction at a time from the wake word to the end of the
+    answer. Each stage is stored as milliseconds since the start, from the
+    monotonic clock. mark() is safe to call from any thread, the mixer's
+    included. Finished traces are kept in memory for the debug page and
+    queued for export_periodically() to append to a JSON lines file.
+    """
+    def __init__(self, max_recent=200, clock=time.monotonic):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.current = None
+        self.recent = collections.deque(maxlen=max_recent)
+        # bounded in case nothing exports them
+        self.pending = collections.deque(maxlen=1000)
+
+    def start(self, kind="voice"):
+        """Starts a new trace, ending any unfinished one, and returns its ID."""
+        with self.lock:
+            if self.current is not None:
+                self._finish(self.current, "abandoned")
+            self.current = {
+                "id": new_trace_id(),
+                "kind": kind,
+                "wall": time.time(),
+                "start": self.clock(),
+                "stages": {},
+            }
+            self.current["stages"]["wake" if kind == "voice" else "request"] = 0.0
+            return self.current["id"]
+
+    def current_id(self):
+        trace = self.current
+        return trace["id"] if trace is not None else None
+
+    def mark(self, stage, once=False, trace_id=None):
+        """
+        Records a stage of the current trace. A stage marked again moves to
+        the later time unless once is set. With trace_id, only marks if that
+        trace is still the current one.
+        """
+        now = self.clock()
+        with self.lock:
+            trace = self.current
+            if trace is None or (trace_id is not None and trace["id"] != trace_id):
+                return
+            if once and stage in trace["stages"]:
+                return
+            trace["stages"][stage] = (now - trace["start"]) * 1000
+
+    def has_mark(self, stage):
+        trace = self.current
+        return trace is not None and stage in trace["stages"]
+
+    def finish(self, outcome="done", trace_id=None):
+        with self.lock:
+            trace = self.current
+            if trace is None or (trace_id is not None and trace["id"] != trace_id):
+                return
+            if outcome == "done":
+                trace["stages"]["done"] = (self.clock() - trace["start"]) * 1000
+            self._finish(trace, outcome)
+
+    def _finish(self, trace, outcome):
+        self.current = None
+        stages = sorted(trace["stages"].items(), key=lambda item: item[1])
+        record = {
+            "id": trace["id"],
+            "kind": trace["kind"],
+            "t": round(trace["wall"], 3),
+            "outcome": outcome,
+            "stages": [[name, round(offset, 1)] for name, offset in stages],
+        }
+        self.recent.append(record)
+        self.pending.append(record)
+
+        INTERACTIONS.inc(outcome=outcome)
+        for name, offset in stages:
+            STAGE_SECONDS.observe(offset / 1000, stage=name)
+
+    def summary(self):
+        """
+        Per stage, percentiles of the time since the start and since the
+        stage before it, over the recent traces.
+        """
+        with self.lock:
+            traces = list(self.recent)
+
+        since_start = collections.defaultdict(list)
+        since_previous = collections.defaultdict(list)
+        outcomes = collections.Counter()
+        for trace in traces:
+            outcomes[trace["outcome"]] += 1
+            previous = None
+            for name, offset in trace["stages"]:
+                since_start[name].append(offset)
+                if previous is not None:
+                    since_previous[name].append(offset - previous)
+                previous = offset
+
+        order = {name: i for i, name in enumerate(STAGES)}
+        stages = []
+        for name in sorted(since_start, key=lambda name: (order.get(name, len(STAGES)), name)):
+            start_p50, start_p95 = np.percentile(since_start[name], [50, 95])
+            stage = {"stage": name, "n": len(since_start[name]), "since_start_p50": round(float(start_p50), 1), "since_start_p95": round(float(start_p95), 1)}
+            if since_previous[name]:
+                previous_p50, previous_p95 = np.percentile(since_previous[name], [50, 95])
+                stage.update(since_previous_p50=round(float(previous_p50), 1), since_previous_p95=round(float(previous_p95), 1))
+            stages.append(stage)
+
+        return {"traces": len(traces), "outcomes": dict(outcomes), "stages": stages}
+
+    def to_dict(self, limit=50):
+        recent = list(self.recent)
+        return {"summary": self.summary(), "recent": recent[max(len(recent) - limit, 0):][::-1]}
+
+    def write_pending(self, path, max_bytes=5 * 2**20):
+        with self.lock:
+            pending = list(self.pending)
+            self.pending.clear()
+        if not pending:
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # one old file is kept, so the disk use stays under twice max_bytes
+        if path.exists() and path.stat().st_size > max_bytes:
+            os.replace(path, path.with_suffix(path.suffix + ".1"))
+        with open(path, "a") as f:
+            for record in pending:
+                f.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+    async def export_periodically(self, path, interval=5, max_bytes=5 * 2**20):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.write_pending, path, max_bytes)
+            except OSError as e:
+                print(f"[TRACING] Could not write {path}: {e}")
+
+TRACER = InteractionTracer()
@@ -0,0 +1,69 @@
+import json
+from importlib import resources
+
+from aiohttp import web
+
+from . import build_assets
+
+class TemplateCache:
+    """
+    Serves the web UI from memory. Assets come from the prebuilt
+    templates/dist (see build_assets.py) or, without one, are built once at
+    first use. Hashed assets are cached by the browser for good, entry pages
+    revalidate with their ETag and get a 304 while unchanged.
+    """
+    def __init__(self, package='lucyhubclient.templates'):
+        self.package = package
+        self.assets = None
+
+    def _load(self):
+        if self.assets is not None:
+            return self.assets
+
+        templates = resources.files(self.package)
+        manifest_file = templates / 'dist' / 'manifest.json'
+        if manifest_file.is_file():
+            suffixes = {"identity": "", "gzip": ".gz", "br": ".br"}
+            assets = json.loads(manifest_file.read_text())
+            for asset in assets.values():
+                asset["encoded"] = {encoding: (templates / 'dist' / (asset["path"] + suffixes[encoding])).read_bytes()
+                                    for encoding in asset["encodings"]}
+        else:
+            print("[WEB] No prebuilt assets, building them in memory")
+            assets = build_assets.build(lambda name: (templates / name).read_text())
+
+        # reachable by hashed path and, uncached, by their source name
+        self.assets = {}
+        for name, asset in assets.items():
+            self.assets[asset["path"]] = asset
+            self.assets.setdefault(name, {**asset, "immutable": False})
+        return self.assets
+
+    def response(self, request, path, content_type='text/html'):
+        asset = self._load().get(path)
+        if asset is None:
+            raise web.HTTPNotFound()
+
+        if asset["immutable"]:
+            headers = {"Cache-Control": "public, max-age=31536000, immutable"}
+        else:
+            headers = {"Cache-Control": "no-cache"}
+        headers.update({"ETag": asset["etag"], "Vary": "Accept-Encoding"})
+        if asset["etag"] in request.headers.get("If-None-Match", ""):
+            return web.Response(status=304, headers=headers)
+
+        accepted = request.headers.get("Accept-Encoding", "")
+        encoding = next((e for e in ("br", "gzip") if e in accepted and e in asset["encoded"]), "identity")
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return web.Response(body=asset["encoded"][encoding], content_type=content_type, charset='utf-8', headers=headers)
+
+TEMPLATES = TemplateCache()
+
+async def start_site(app, host, port):
+    # runs on the caller's event loop, there is no server thread
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    return runner